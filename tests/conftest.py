@@ -0,0 +1,89 @@
+import logging
+import os
+import sys
+import time
+import types
+
+import pytest
+import yaml
+
+#the plugin's modules sit at the top of the repository, not in a package
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import ximea_backpressure
+import ximea_rig
+import ximea_sim
+
+logger = logging.getLogger('ximea_tests')
+
+class PupilClock():
+    '''
+    The part of g_pool the recording pipeline uses
+    '''
+    def get_timestamp(self):
+        return(time.monotonic() - 100)
+
+#what cy.yaml's commented example sets for 12 bit packed frames
+PACKED_12 = {'imgdataformat': 'XI_FRM_TRANSPORT_DATA', 'image_data_bit_depth': 'XI_BPP_12',
+             'output_bit_depth': 'XI_BPP_12', 'sensor_bit_depth': 'XI_BPP_12', 'is_output_bit_packing': True,
+             'output_bit_packing_type': 'XI_DATA_PACK_PFNC_LSB_PACKING'}
+
+def write_settings(path, **props):
+    '''
+    cy.yaml with a small frame, so recordings in tests stay a few MB, and any other changes
+    '''
+    with open(os.path.join(ROOT, 'cy.yaml')) as f:
+        settings = yaml.safe_load(f)
+    settings.update(width=64, height=48, framerate=200.0)
+    settings.update(props)
+    with open(path, 'w') as f:
+        yaml.safe_dump(settings, f)
+    return(str(path))
+
+@pytest.fixture
+def settings_file(tmp_path):
+    return(write_settings(tmp_path / 'cam.yaml'))
+
+@pytest.fixture
+def plugin():
+    '''
+    The plugin options a RigCamera reads, recording from a simulated camera
+    '''
+    return(types.SimpleNamespace(imshape=(48, 64), camera_backend=ximea_sim, acquisition_process=False,
+                                 write_in_child=True, ring_slots=32, ring_policy='block', preview_fps=15,
+                                 preview_ximea=False, compression='none', compression_level=1, compression_workers=2,
+                                 ims_per_file=50, write_mode='buffered', sync_interval=5.0, roi_mode='full',
+                                 decimation=1, backpressure=False,
+                                 backpressure_policy=ximea_backpressure.make_policy(None)))
+
+def wait_for(condition, timeout=10, poll=None):
+    '''
+    Wait until condition() is true, calling poll() meanwhile
+    '''
+    t_end = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < t_end, 'timed out'
+        if poll is not None:
+            poll()
+        time.sleep(0.02)
+
+def open_camera(settings_file, plugin, name='ximea'):
+    '''
+    A RigCamera on the simulated camera, once it is open
+    '''
+    cam = ximea_rig.RigCamera(name, 'SIM0001', settings_file, plugin, logger)
+    cam.open()
+    wait_for(lambda: cam.camera_open, poll=cam.poll)
+    return(cam)
+
+def record(cam, save_dir, n_frames):
+    '''
+    Record at least n_frames into save_dir and wait until they are saved
+    '''
+    os.makedirs(save_dir, exist_ok=True)
+    assert cam.start_recording(save_dir, PupilClock())
+    wait_for(lambda: cam.frame_ring.committed >= n_frames)
+    cam.stop_recording()
+    wait_for(lambda: not cam.busy(), poll=cam.poll)
+    return(save_dir)
@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+import ximea_pixels
+from conftest import PACKED_12
+
+@pytest.mark.parametrize('bits', ximea_pixels.PACKED_BITS)
+def test_pack_unpack(bits):
+    fmt = ximea_pixels.frame_format(bits, 'pfnc_lsb')
+    pixels = np.random.default_rng(bits).integers(0, 2**bits, (3, 4, 16), dtype=np.uint16)
+    packed = ximea_pixels.pack(pixels, fmt)
+    assert packed.shape == (3, *ximea_pixels.stored_shape((4, 16), fmt))
+    assert packed.nbytes == pixels.size * bits // 8
+    assert ximea_pixels.pixel_shape(packed.shape[1:], fmt) == (4, 16)
+    assert np.array_equal(ximea_pixels.unpack(packed, fmt), pixels)
+    assert np.array_equal(ximea_pixels.unpack(packed[1], fmt), pixels[1])
+    out = np.zeros_like(pixels)
+    assert np.array_equal(ximea_pixels.unpack_into(packed, fmt, out, rows=3), pixels)
+    assert np.array_equal(ximea_pixels.unpack_msb8(packed, fmt), (pixels >> (bits - 8)).astype(np.uint8))
+
+def test_pfnc_lsb_layout():
+    #Mono12p: the first pixel's low 8 bits, then its high 4 bits under the second pixel's low 4
+    fmt = ximea_pixels.frame_format(12, 'pfnc_lsb')
+    assert list(ximea_pixels.pack(np.array([[0xABC, 0x123]]), fmt)[0]) == [0xBC, 0x3A, 0x12]
+    #Mono10p: 4 pixels in 5 bytes, least significant bits first
+    fmt = ximea_pixels.frame_format(10, 'pfnc_lsb')
+    assert list(ximea_pixels.pack(np.array([[0x3FF, 0, 0, 0x3FF]]), fmt)[0]) == [0xFF, 0x03, 0x00, 0xC0, 0xFF]
+
+def test_raw8_passes_through():
+    frame = np.arange(12, dtype=np.uint8).reshape(3, 4)
+    assert ximea_pixels.stored_shape(frame.shape, ximea_pixels.RAW8) == (3, 4)
+    assert ximea_pixels.unpack_msb8(frame, ximea_pixels.RAW8) is frame
+    assert np.array_equal(ximea_pixels.unpack(frame, ximea_pixels.RAW8), frame)
+
+def test_format_from_settings():
+    assert ximea_pixels.format_from_settings({'imgdataformat': 'XI_RAW8'}) == ximea_pixels.RAW8
+    assert ximea_pixels.format_from_settings(PACKED_12) == ximea_pixels.frame_format(12, 'pfnc_lsb')
+    with pytest.raises(ValueError):
+        ximea_pixels.format_from_settings({'imgdataformat': 'XI_RAW16', 'image_data_bit_depth': 'XI_BPP_12'})
+    with pytest.raises(ValueError):
+        ximea_pixels.format_from_settings(dict(PACKED_12, output_bit_packing_type='XI_DATA_PACK_XI_GROUPING'))
+    with pytest.raises(ValueError):
+        ximea_pixels.row_nbytes(6, ximea_pixels.frame_format(10, 'pfnc_lsb'))
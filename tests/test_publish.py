@@ -0,0 +1,34 @@
+import os
+
+import ximea_publish
+import ximea_rig
+from conftest import logger, wait_for, write_settings
+
+def shared_slot_nbytes(name):
+    sub = ximea_publish.SharedSubscriber(name)
+    try:
+        return(int(sub.header['slot_nbytes']))
+    finally:
+        sub.close()
+
+def test_shares_follow_the_sensor(tmp_path, settings_file, plugin):
+    name = f'ximea_test_{os.getpid()}'
+    cam = ximea_rig.RigCamera('ximea', 'SIM0001', settings_file, plugin, logger)
+    try:
+        #asked for before the camera has read its settings file, as the recording options are
+        assert cam.share(name, 'raw') is None
+        cam.open()
+        wait_for(lambda: cam.camera_open and cam.publisher.shares, poll=cam.poll)
+        assert shared_slot_nbytes(name) == ximea_publish.max_nbytes('raw', (48, 64))
+
+        #the recording options read again make the same block, not a second one
+        cam.share(name, 'raw', n_slots=8)
+        assert len(cam.publisher.shares) == 1 and cam.publisher.shares[0].n_slots == 8
+
+        cam.yaml_loc = write_settings(tmp_path / 'bigger.yaml', width=128, height=96)
+        cam.apply_settings()
+        wait_for(lambda: cam.camera_open, poll=cam.poll)
+        cam.poll()
+        assert shared_slot_nbytes(name) == ximea_publish.max_nbytes('raw', (96, 128))
+    finally:
+        cam.cleanup()
@@ -0,0 +1,100 @@
+import logging
+import os
+
+import numpy as np
+import pytest
+
+import ximea_chunk
+import ximea_compress
+import ximea_metadata
+import ximea_pixels
+import ximea_reader
+import ximea_ring
+import ximea_writer
+from conftest import PACKED_12, write_settings
+
+def write_frames(rec_dir, frames, ims_per_file=4, close=True, codec='none', settings_file=None, write_mode='buffered'):
+    '''
+    Write frames (as stored, packed or not) the way the save thread does, leaving the last chunk open unless close
+    '''
+    frames_dir = os.path.join(rec_dir, 'ximea')
+    os.makedirs(frames_dir)
+    header = ximea_chunk.make_header(frames.shape[1:], codec, settings_file)
+    writer = ximea_writer.ChunkWriter(frames_dir, ims_per_file, header, mode=write_mode,
+                                      extension=ximea_compress.CHUNK_EXTENSIONS[codec])
+    meta = np.zeros(len(frames), dtype=ximea_ring.slot_meta_dtype)
+    meta['nframe'] = np.arange(len(frames)) * 2 + 1
+    meta['tsSec'] = 100 + np.arange(len(frames)) // 4
+    meta['tsUSec'] = np.arange(len(frames)) % 4 * 250000
+    payloads = list(frames)
+    if codec != 'none':
+        compress, _ = ximea_compress.get_codec(codec)
+        payloads = [compress(frame) for frame in frames]
+    t_pupil = 5.0 + np.arange(len(frames)) * 0.25
+    #in batches of 3, so batches straddle chunks
+    for i in range(0, len(frames), 3):
+        writer.write_frames(payloads[i:i + 3], ximea_metadata.make_records(i, meta[i:i + 3], t_pupil[i:i + 3]))
+    if close:
+        writer.close()
+    return(meta)
+
+def test_recording_without_frames(tmp_path):
+    #what a recording stopped before its camera captured anything leaves behind
+    (tmp_path / 'ximea').mkdir()
+    ximea_metadata.records_to_tsv(np.zeros(0, dtype=ximea_metadata.frame_record_dtype),
+                                  str(tmp_path / 'timestamps_ximea.tsv'))
+    records, nframe, cam_times = ximea_reader.load_frame_times(str(tmp_path), 'ximea')
+    assert records is None and len(nframe) == 0 and len(cam_times) == 0
+    assert len(ximea_reader.XimeaRecording(str(tmp_path), 'ximea')) == 0
+
+def test_recover_chunk_that_was_not_closed(tmp_path, caplog):
+    frames = np.random.default_rng(0).integers(0, 256, (10, 6, 8), dtype=np.uint8)
+    meta = write_frames(str(tmp_path), frames, close=False)
+    with caplog.at_level(logging.WARNING, logger='ximea_reader'):
+        rec = ximea_reader.XimeaRecording(str(tmp_path), 'ximea')
+    assert 'was not closed, recovered 2 frames' in caplog.text
+    assert len(rec) == 10
+    assert np.array_equal(rec[:], frames)
+    assert np.array_equal(rec.nframe, meta['nframe'])
+
+@pytest.mark.parametrize('codec, bits, write_mode', [('none', 8, 'buffered'), ('none', 8, 'direct'), ('none', 8, 'sync'),
+                                                     ('zlib', 8, 'buffered'), ('none', 12, 'buffered'),
+                                                     ('zlib', 12, 'direct')])
+def test_round_trip(tmp_path, codec, bits, write_mode):
+    settings_file = write_settings(tmp_path / 'cam.yaml', **(PACKED_12 if bits == 12 else {}))
+    fmt = ximea_pixels.format_from_file(settings_file)
+    pixels = np.random.default_rng(1).integers(0, 2**bits, (10, 6, 8), dtype=np.uint16)
+    stored = ximea_pixels.pack(pixels, fmt)
+    meta = write_frames(str(tmp_path), stored, codec=codec, settings_file=settings_file, write_mode=write_mode)
+
+    names = sorted(os.listdir(tmp_path / 'ximea'))
+    ext = ximea_compress.CHUNK_EXTENSIONS[codec]
+    assert names == sorted(f'frames_{a}_{b}.{ext}' for a, b in ((0, 3), (4, 7), (8, 9)))
+
+    rec = ximea_reader.XimeaRecording(str(tmp_path), 'ximea')
+    assert (rec.imshape, rec.frame_format, rec.codec, len(rec)) == ((6, 8), fmt, codec, 10)
+    assert np.array_equal(rec[:], pixels)
+    assert np.array_equal(rec[3:6], pixels[3:6])
+    assert np.array_equal(rec[[9, 0]], pixels[[9, 0]])
+    assert np.array_equal(rec[-1], pixels[-1])
+    assert np.array_equal(rec.raw(5), stored[5])
+    assert np.array_equal(rec.msb8(slice(None)), (pixels >> (bits - 8)).astype(np.uint8))
+    assert np.array_equal(rec.nframe, meta['nframe'])
+    assert np.allclose(rec.cam_times, meta['tsSec'] + meta['tsUSec'] * 1e-6)
+    assert np.allclose(rec.pupil_times, 5.0 + np.arange(10) * 0.25)
+    assert rec.frame_at_pupil_time(6.1) == 4
+    assert rec.frames_between(5.5, 6.0) == slice(2, 4)
+    with pytest.raises(IndexError):
+        rec.raw(10)
+
+@pytest.mark.parametrize('cut, n_recovered', [(0, 2), (-1, 1), (-ximea_chunk.FRAME_HEADER_DTYPE.itemsize - 48, 1)])
+def test_recover_chunk_cut_short(tmp_path, cut, n_recovered):
+    frames = np.random.default_rng(0).integers(0, 256, (10, 6, 8), dtype=np.uint8)
+    write_frames(str(tmp_path), frames, close=False)
+    #the open chunk is preallocated, cut it where its last frame ends, or inside a frame
+    path = tmp_path / 'ximea' / 'frames_8_11.bin'
+    end = ximea_chunk.HEADER_SIZE + 2 * (ximea_chunk.FRAME_HEADER_DTYPE.itemsize + 48)
+    os.truncate(path, end + cut)
+    rec = ximea_reader.XimeaRecording(str(tmp_path), 'ximea')
+    assert len(rec) == 8 + n_recovered
+    assert np.array_equal(rec[:], frames[:8 + n_recovered])
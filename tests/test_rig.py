@@ -0,0 +1,66 @@
+import os
+import time
+
+import pytest
+
+import ximea_reader
+import ximea_rig
+import ximea_writer
+from conftest import PupilClock, open_camera, wait_for
+
+@pytest.mark.parametrize('acquisition_process', [False, True], ids=['threads', 'process'])
+def test_back_to_back_recordings(tmp_path, settings_file, plugin, monkeypatch, acquisition_process):
+    plugin.acquisition_process = acquisition_process
+    #a writer slower than the camera, so the first recording is still being saved when the second starts
+    #(an acquisition process writes at full speed, but is busy until it has handed the camera back)
+    write_frames = ximea_writer.ChunkWriter.write_frames
+    def slow_write_frames(self, frames, records):
+        #at most 8 frames every 0.1 s, the camera makes 200 a second
+        time.sleep(0.1)
+        return(write_frames(self, frames, records))
+    monkeypatch.setattr(ximea_writer.ChunkWriter, 'write_frames', slow_write_frames)
+
+    cam = open_camera(settings_file, plugin)
+    try:
+        saved = []
+        for k in range(2):
+            save_dir = str(tmp_path / f'{k:03d}' / 'ximea')
+            os.makedirs(save_dir)
+            assert cam.start_recording(save_dir, PupilClock())
+            wait_for(lambda: cam.frame_ring.committed >= 40)
+            cam.stop_recording()
+            if k == 0:
+                #the ring still holds frames of the first recording, it must not be reset
+                assert cam.busy()
+                assert not cam.start_recording(str(tmp_path / 'refused'), PupilClock())
+            wait_for(lambda: not cam.busy() and cam.camera_open, poll=cam.poll)
+            saved.append((save_dir, cam.frame_ring.committed))
+
+        recs = [ximea_reader.XimeaRecording(save_dir, 'ximea') for save_dir, _ in saved]
+        for rec, (_, committed) in zip(recs, saved):
+            assert len(rec) == committed
+            assert (rec.nframe[1:] > rec.nframe[:-1]).all()
+        if not acquisition_process:
+            #no frame of the second recording went into the first one's folder, the
+            #camera stays open between recordings so its frame counter carries on
+            assert recs[0].nframe[-1] < recs[1].nframe[0]
+    finally:
+        cam.cleanup()
+
+def test_preview_gets_the_camera_back_after_acquisition(tmp_path, settings_file, plugin, monkeypatch):
+    plugin.preview_ximea = True
+    #don't wait for the acquisition thread at all, poll() has to hand the camera back
+    monkeypatch.setattr(ximea_rig, 'ACQ_STOP_TIMEOUT_S', 0)
+    cam = open_camera(settings_file, plugin)
+    try:
+        assert cam.start_recording(str(tmp_path / 'ximea'), PupilClock())
+        wait_for(lambda: cam.frame_ring.committed >= 10)
+        cam.stop_recording()
+        #never both grabbing from the camera
+        assert cam.preview._use_ring or not cam.handles.acq_thread.is_alive()
+        wait_for(lambda: not cam.preview._use_ring, poll=cam.poll)
+        assert not cam.handles.acq_thread.is_alive()
+        n_previews = cam.preview.seq
+        wait_for(lambda: cam.preview.seq > n_previews + 2)
+    finally:
+        cam.cleanup()
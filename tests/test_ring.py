@@ -0,0 +1,105 @@
+import multiprocessing
+import threading
+
+import pytest
+
+import ximea_ring
+
+def fill(ring, n, first_nframe=0):
+    '''
+    Commit n frames, each filled with its frame counter
+    Returns:
+        slots (list): slot of each frame, None where it was dropped
+    '''
+    slots = []
+    for k in range(first_nframe, first_nframe + n):
+        slot = ring.acquire(timeout=0.05)
+        if slot is not None:
+            ring.frames[slot] = k
+            ring.commit(slot, k, 0, 0)
+        slots.append(slot)
+    return(slots)
+
+def taken_nframes(ring, slots):
+    return([int(ring.meta[slot]['nframe']) for slot in slots])
+
+def test_frames_come_out_in_order():
+    ring = ximea_ring.FrameRing(4, (2, 3))
+    fill(ring, 3)
+    slots = ring.get_batch(2)
+    assert taken_nframes(ring, slots) == [0, 1]
+    assert ring.depth() == 1 and ring.in_use() == 3
+    ring.release(slots)
+    assert ring.in_use() == 1
+    assert taken_nframes(ring, ring.get_batch(8)) == [2]
+    assert ring.get_batch(8, timeout=0) == []
+
+@pytest.mark.parametrize('policy, kept, evicted', [('block', [0, 1, 2], None), ('drop_newest', [0, 1, 2], None),
+                                                   ('drop_oldest', [2, 3, 4], 1)])
+def test_full_ring(policy, kept, evicted):
+    ring = ximea_ring.FrameRing(3, (2, 3), policy)
+    fill(ring, 5)
+    assert ring.dropped == 2 and ring.committed == len(kept) + (2 if policy == 'drop_oldest' else 0)
+    assert ring.evicted == evicted
+    slots = ring.get_batch(8)
+    assert taken_nframes(ring, slots) == kept
+    assert [int(ring.frames[slot][0, 0]) for slot in slots] == kept
+
+def test_drop_oldest_never_takes_a_slot_being_written():
+    ring = ximea_ring.FrameRing(2, (2, 3), 'drop_oldest')
+    fill(ring, 2)
+    slots = ring.get_batch(2)
+    #both slots are with the writer, nothing can be evicted
+    assert ring.acquire() is None and ring.dropped == 1
+    ring.release(slots)
+    assert ring.acquire() is not None
+
+def test_block_waits_for_the_writer():
+    ring = ximea_ring.FrameRing(1, (2, 3), 'block')
+    fill(ring, 1)
+    slots = ring.get_batch(1)
+    threading.Timer(0.05, ring.release, (slots,)).start()
+    assert ring.acquire(timeout=5) == slots[0]
+    assert ring.dropped == 0
+
+def test_close_wakes_the_writer_and_reset_empties():
+    ring = ximea_ring.FrameRing(4, (2, 3))
+    threading.Timer(0.05, ring.close).start()
+    assert ring.get_batch(4, timeout=5) == []
+    assert ring.closed
+    fill(ring, 2)
+    ring.reset()
+    assert not ring.closed and ring.depth() == 0 and ring.in_use() == 0 and ring.committed == 0
+    assert ring.peek_latest() is None
+
+def test_peek_latest_sees_a_reused_slot():
+    ring = ximea_ring.FrameRing(2, (2, 3), 'drop_oldest')
+    fill(ring, 1)
+    slot, seq = ring.peek_latest()
+    assert ring.still_valid(slot, seq)
+    #the frame is evicted for newer ones before the reader is done with it
+    fill(ring, 2, first_nframe=1)
+    assert not ring.still_valid(slot, seq)
+
+def _produce(ring, n):
+    fill(ring, n)
+    ring.close()
+
+def test_shared_ring_across_processes():
+    ring = ximea_ring.SharedFrameRing(4, (2, 3), 'block')
+    try:
+        child = multiprocessing.get_context('spawn').Process(target=_produce, args=(ring, 10))
+        child.start()
+        nframes = []
+        while True:
+            slots = ring.get_batch(4, timeout=5)
+            if not slots:
+                break
+            assert all(int(ring.frames[slot][0, 0]) == int(ring.meta[slot]['nframe']) for slot in slots)
+            nframes += taken_nframes(ring, slots)
+            ring.release(slots)
+        child.join(10)
+        assert nframes == list(range(10))
+        assert ring.committed == 10 and ring.dropped == 0 and ring.closed
+    finally:
+        ring.destroy()
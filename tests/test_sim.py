@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+import ximea_reader
+import ximea_sim
+import ximea_utils
+from conftest import PACKED_12, open_camera, record, write_settings
+
+@pytest.mark.parametrize('compression, settings', [('none', {}), ('zlib', {}), ('zlib', PACKED_12)],
+                         ids=['uncompressed', 'zlib', 'zlib_12bit'])
+def test_replay(tmp_path, plugin, compression, settings):
+    settings_file = write_settings(tmp_path / 'cam.yaml', **settings)
+    plugin.compression = compression
+    cam = open_camera(settings_file, plugin)
+    try:
+        save_dir = record(cam, str(tmp_path / 'ximea'), 30)
+    finally:
+        cam.cleanup()
+    rec = ximea_reader.XimeaRecording(save_dir, 'ximea')
+    assert rec.codec == compression
+
+    camera = ximea_sim.SimCamera(replay_dir=save_dir, realtime=False, replay_loop=False)
+    camera.open_device()
+    ximea_utils.apply_cam_settings(camera, settings_file)
+    camera.start_acquisition()
+    image = ximea_sim.SimImage()
+    for i in range(len(rec)):
+        camera.get_image(image)
+        assert image.nframe == rec.nframe[i]
+        assert np.array_equal(image.get_image_data_numpy(), rec.raw(i))
+    assert (image.height, image.width) == rec.imshape
+    with pytest.raises(ximea_sim.Xi_error):
+        camera.get_image(image)
+
+def test_replay_of_other_frames(tmp_path, settings_file, plugin):
+    cam = open_camera(settings_file, plugin)
+    try:
+        save_dir = record(cam, str(tmp_path / 'ximea'), 10)
+    finally:
+        cam.cleanup()
+    camera = ximea_sim.SimCamera(replay_dir=save_dir, width=128, height=96)
+    camera.open_device()
+    with pytest.raises(ValueError):
+        camera.start_acquisition()
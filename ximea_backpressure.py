@@ -0,0 +1,251 @@
+"""
+Backing off gracefully when a camera's writer falls behind.
+
+The frame ring keeps memory fixed, but once it fills its policy drops frames wherever
+they happen to fall. BackpressureController runs in the acquisition thread and steps
+through an escalation policy before that happens:
+
+    normal        every frame is stored
+    slow_preview  the preview samples the ring at policy.preview_fps, leaving the CPU to the writer
+    decimate      only one frame in policy.decimation is stored
+    shed          frames are not stored at all while the ring is above the shed threshold
+
+Each step keeps the ones before it. The level goes up one step when the ring's fill
+reaches that step's threshold, or when at the current write rate it would be full
+within policy.horizon_s. It comes down one step once the ring has stayed below
+policy.release_at for policy.hold_s seconds.
+
+Every level change and every run of shed frames is written, with host and Pupil time,
+to {cam_name}_backpressure.tsv next to the recording, as are the frames the ring still
+had to drop. Frames left out by decimation are exactly those whose nframe isn't a
+multiple of policy.decimation (times the ROI decimation) between the level changes, so
+every camera frame missing from the recording is accounted for.
+"""
+
+import os
+import time
+from collections import namedtuple
+
+#steps a policy can use, in the order they escalate
+STEPS = ('slow_preview', 'decimate', 'shed')
+
+#steps (tuple): which of STEPS to use, in order
+#escalate_at (tuple): ring fill (0-1) that moves up to each step
+#release_at (float): ring fill below which the level comes down, after hold_s seconds
+#horizon_s (float): also escalate if the ring would be full within this many seconds
+#preview_fps (float): preview rate from the slow_preview step on
+#decimation (int): store one frame in this many from the decimate step on
+#interval_s (float): seconds between looks at the ring
+backpressure_policy = namedtuple('backpressure_policy',
+                                 'steps escalate_at release_at hold_s horizon_s preview_fps decimation interval_s')
+
+DEFAULT_POLICY = backpressure_policy(steps=STEPS, escalate_at=(0.5, 0.7, 0.85), release_at=0.25, hold_s=2.0,
+                                     horizon_s=1.0, preview_fps=2.0, decimation=2, interval_s=0.25)
+
+#in_use: frames in the ring, waiting for the writer or being written
+LOG_COLUMNS = ('t_host', 't_pupil', 'event', 'level', 'nframe_first', 'nframe_last', 'n_frames',
+               'in_use', 'acquired_fps', 'stored_fps', 'written_fps', 'reason')
+
+def make_policy(options=None):
+    '''
+    A policy from DEFAULT_POLICY with some of its fields changed
+    Params:
+        options (dict): fields to change, e.g. the 'backpressure' entry of a settings file's
+                        'recording' section; steps and escalate_at may leave steps out
+    Returns:
+        policy (backpressure_policy)
+    '''
+    options = dict(options or {})
+    unknown = set(options) - set(backpressure_policy._fields)
+    if unknown:
+        raise ValueError(f'Unknown backpressure options {sorted(unknown)}, use {backpressure_policy._fields}')
+    policy = DEFAULT_POLICY._replace(**options)
+    steps = tuple(policy.steps)
+    if any(step not in STEPS for step in steps) or list(steps) != sorted(steps, key=STEPS.index):
+        raise ValueError(f'Backpressure steps {steps} must be taken from {STEPS}, in that order')
+    escalate_at = tuple(float(f) for f in policy.escalate_at)
+    if 'steps' in options and 'escalate_at' not in options:
+        #keep the default thresholds of the steps that are left
+        escalate_at = tuple(DEFAULT_POLICY.escalate_at[STEPS.index(step)] for step in steps)
+    if len(escalate_at) != len(steps):
+        raise ValueError(f'Backpressure needs one escalate_at threshold per step, got {escalate_at} for {steps}')
+    return(policy._replace(steps=steps, escalate_at=escalate_at, decimation=max(1, int(policy.decimation))))
+
+def level_names(policy):
+    return(('normal',) + tuple(policy.steps))
+
+def preview_fps(policy, level, fps):
+    '''
+    Preview rate to use at a level of a policy, fps when the preview isn't slowed
+    '''
+    if policy is None or 'slow_preview' not in level_names(policy)[1:level + 1]:
+        return(fps)
+    return(min(fps, policy.preview_fps))
+
+class BackpressureController():
+    '''
+    Decides, frame by frame, whether the acquisition thread stores a frame.
+
+    admit() is called from the acquisition thread for every frame that would go into
+    the ring and only looks at the ring every policy.interval_s seconds, so it costs
+    a clock read per frame. level can be read from any thread. When telemetry is given
+    its backpressure_level, backpressure_state, frames_decimated and frames_shed are
+    kept up to date.
+    '''
+    def __init__(self, cam_name, frame_ring, policy, save_dir, g_pool, logger, telemetry=None, base_decimation=1):
+        self.cam_name = cam_name
+        self.frame_ring = frame_ring
+        self.policy = policy
+        self.g_pool = g_pool
+        self.logger = logger
+        self.telemetry = telemetry
+        self.names = level_names(policy)
+        self.level = 0
+        self.max_level = 0
+        #decimation on top of what the ROI geometry already does, by camera frame counter
+        self.keep_every = base_decimation * policy.decimation
+        self.shed_depth = None
+        if 'shed' in policy.steps:
+            self.shed_depth = policy.escalate_at[policy.steps.index('shed')] * frame_ring.n_slots
+
+        self.frames_offered = 0
+        self.frames_decimated = 0
+        self.frames_shed = 0
+        self._decimating = False
+        self._shedding = False
+        #[first nframe, last nframe, count] of frames shed in a row, and of frames the ring
+        #dropped since the last look at it
+        self._runs = {'shed': None, 'dropped': None}
+        self._rates = (0.0, 0.0, 0.0)
+        self._t_next = 0.0
+        self._t_calm = None
+        self._last = (time.monotonic(), 0, frame_ring.committed, frame_ring.taken)
+
+        if telemetry is not None:
+            telemetry.backpressure_state = self.names[0]
+
+        self.log_file_name = os.path.join(save_dir, f'{cam_name}_backpressure.tsv')
+        self._log = open(self.log_file_name, 'w')
+        self._log.write('\t'.join(LOG_COLUMNS) + '\n')
+
+    def admit(self, nframe):
+        '''
+        Returns:
+            store (bool): put this frame in the ring, False if it was decimated or shed
+        '''
+        self.frames_offered += 1
+        now = time.monotonic()
+        if now >= self._t_next:
+            self._evaluate(now, nframe)
+        if self._shedding and self.frame_ring.in_use() >= self.shed_depth:
+            self._mark('shed', nframe)
+            self.frames_shed += 1
+            if self.telemetry is not None:
+                self.telemetry.frames_shed = self.frames_shed
+            return(False)
+        self._end_run('shed')
+        if self._decimating and nframe % self.keep_every:
+            self.frames_decimated += 1
+            if self.telemetry is not None:
+                self.telemetry.frames_decimated = self.frames_decimated
+            return(False)
+        return(True)
+
+    def ring_dropped(self, nframe):
+        '''
+        Called by the acquisition thread when the ring dropped a frame, the new one or (drop_oldest) an older one
+        '''
+        self._mark('dropped', nframe)
+
+    def _mark(self, event, nframe):
+        run = self._runs[event]
+        if run is None:
+            self._runs[event] = [nframe, nframe, 1]
+        else:
+            run[0] = min(run[0], nframe)
+            run[1] = max(run[1], nframe)
+            run[2] += 1
+
+    def _end_run(self, event):
+        run = self._runs[event]
+        if run is None:
+            return
+        self._runs[event] = None
+        if event == 'shed':
+            reason = f'ring holding {self.shed_depth:.0f} frames or more'
+        else:
+            reason = f'ring full, {self.frame_ring.policy}'
+        self._write(event, *run, reason)
+
+    def _evaluate(self, now, nframe):
+        '''
+        Look at the ring's fill and the write rate, move the level up or down a step if needed
+        '''
+        ring = self.frame_ring
+        self._end_run('dropped')
+        t, offered, committed, taken = self._last
+        dt = now - t
+        if dt > 0:
+            self._rates = ((self.frames_offered - offered) / dt, (ring.committed - committed) / dt, (ring.taken - taken) / dt)
+        self._last = (now, self.frames_offered, ring.committed, ring.taken)
+        self._t_next = now + self.policy.interval_s
+        _, stored_fps, written_fps = self._rates
+
+        in_use = ring.in_use()
+        fill = in_use / ring.n_slots
+        time_to_full = (ring.n_slots - in_use) / (stored_fps - written_fps) if stored_fps > written_fps else float('inf')
+        if self.level < len(self.policy.steps):
+            threshold = self.policy.escalate_at[self.level]
+            if fill >= threshold:
+                self._set_level(self.level + 1, nframe, f'ring {fill:.0%} full, at or above {threshold:.0%}')
+                return
+            if fill > self.policy.release_at and time_to_full < self.policy.horizon_s:
+                self._set_level(self.level + 1, nframe, f'ring {fill:.0%} full and filling, full in {time_to_full:.1f} s')
+                return
+        if self.level == 0:
+            return
+        if fill > self.policy.release_at:
+            self._t_calm = None
+        elif self._t_calm is None:
+            self._t_calm = now
+        elif now - self._t_calm >= self.policy.hold_s:
+            self._set_level(self.level - 1, nframe,
+                            f'ring at or below {self.policy.release_at:.0%} for {self.policy.hold_s:.1f} s')
+
+    def _set_level(self, level, nframe, reason):
+        old = self.names[self.level]
+        self.level = level
+        self.max_level = max(self.max_level, level)
+        self._t_calm = None
+        active = self.names[1:level + 1]
+        self._decimating = 'decimate' in active
+        self._shedding = 'shed' in active
+        if self.telemetry is not None:
+            self.telemetry.backpressure_level = level
+            self.telemetry.backpressure_state = self.names[level]
+        if not self._shedding:
+            self._end_run('shed')
+        self._write('level', nframe, nframe, 0, f'{old} -> {self.names[level]}: {reason}')
+        self.logger.info(f'{self.cam_name} writer backpressure {old} -> {self.names[level]} ({reason})')
+
+    def _write(self, event, first, last, n, reason):
+        t_pupil = self.g_pool.get_timestamp() if self.g_pool is not None else float('nan')
+        acquired_fps, stored_fps, written_fps = self._rates
+        self._log.write(f'{time.time():.6f}\t{t_pupil:.6f}\t{event}\t{self.names[self.level]}\t{first}\t{last}\t{n}\t'
+                        f'{self.frame_ring.in_use()}\t{acquired_fps:.1f}\t{stored_fps:.1f}\t{written_fps:.1f}\t{reason}\n')
+
+    def status_text(self):
+        return(f'{self.names[self.level]}, {self.frames_decimated} decimated, {self.frames_shed} shed')
+
+    def close(self):
+        '''
+        Write out a shed run still open and a closing line with the totals
+        '''
+        if self._log is None:
+            return
+        self._end_run('shed')
+        self._end_run('dropped')
+        self._write('end', -1, -1, self.frames_offered,
+                    f'{self.frames_decimated} decimated, {self.frames_shed} shed, highest level {self.names[self.max_level]}')
+        self._log.close()
+        self._log = None
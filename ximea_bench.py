@@ -0,0 +1,255 @@
+"""
+Benchmark the acquisition -> ring -> writer pipeline against a simulated camera.
+
+Every combination of frame size, frame rate, ims_per_file, write mode and target
+directory is recorded for a fixed duration in its own process (so peak RSS is per
+configuration), and the results are written as JSON:
+
+    python ximea_bench.py --sizes 2064x1544,1032x772 --rates 200,400 \
+        --ims-per-file 1,200 --targets /dev/shm,/data/bench --out bench.json
+
+Compare two result files (for example before and after a change):
+
+    python ximea_bench.py --compare old.json new.json
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+import ximea_compress
+import ximea_reader
+import ximea_ring
+import ximea_sim
+import ximea_telemetry
+import ximea_utils
+
+logger = logging.getLogger('ximea_bench')
+
+LATENCY_PERCENTILES = (50, 90, 99, 99.9)
+
+class WriteLatencyStats(ximea_telemetry.PipelineTelemetry):
+    '''
+    Pipeline telemetry that also keeps the exact enqueue-to-disk latency of every frame
+    '''
+    def __init__(self, cam_name, save_dir, frame_ring):
+        super().__init__(cam_name, save_dir, frame_ring)
+        self.latencies = []
+        self.first_write = None
+        self.last_write = None
+
+    def frames_written(self, meta, t_written, nbytes=0):
+        super().frames_written(meta, t_written, nbytes)
+        if self.first_write is None:
+            self.first_write = t_written
+        self.last_write = t_written
+        self.latencies.append(t_written - meta['t_host'])
+
+    def summary(self):
+        lat = np.concatenate(self.latencies) if self.latencies else np.zeros(1)
+        summary = {f'latency_p{p}_ms': float(np.percentile(lat, p) * 1e3) for p in LATENCY_PERCENTILES}
+        summary['latency_max_ms'] = float(lat.max() * 1e3)
+        return(summary)
+
+class _BenchClock():
+    '''
+    Takes the place of Pupil's g_pool for get_sync_string
+    '''
+    @staticmethod
+    def get_timestamp():
+        return(time.monotonic())
+
+def count_missing_frames(save_dir, cam_name):
+    '''
+    Count frames missing from a recording by looking for gaps in the camera frame counter
+    Returns:
+        n_saved (int): frames saved
+        n_missing (int): frames the camera exposed between the first and last saved frame that weren't saved
+    '''
+    _, nframe, _ = ximea_reader.load_frame_times(save_dir, cam_name)
+    if not len(nframe):
+        return(0, 0)
+    gaps = np.diff(nframe.astype(np.int64))
+    return(len(nframe), int(np.sum(gaps[gaps > 1] - 1)))
+
+def time_decode(imshape, n_frames=50):
+    '''
+    Time decode_ximea_frame (grab, demosaic, flip, normalize) on simulated frames
+    Returns:
+        timing (dict): mean and percentiles in milliseconds per frame
+    '''
+    camera = ximea_sim.SimCamera(width=imshape[1], height=imshape[0], realtime=False)
+    image = ximea_sim.SimImage()
+    camera.open_device()
+    camera.start_acquisition()
+    times = []
+    for _ in range(n_frames):
+        t = time.perf_counter()
+        ximea_utils.decode_ximea_frame(camera, image, imshape, logger)
+        times.append(time.perf_counter() - t)
+    times = np.array(times) * 1e3
+    return({'decode_mean_ms': float(times.mean()),
+            'decode_p50_ms': float(np.percentile(times, 50)),
+            'decode_p99_ms': float(np.percentile(times, 99))})
+
+def run_config(config):
+    '''
+    Record from a simulated camera with one configuration and measure the pipeline
+    Params:
+        config (dict): see build_configs
+    Returns:
+        result (dict): config plus measurements
+    '''
+    imshape = (config['height'], config['width'])
+    camera = ximea_sim.SimCamera(framerate=config['framerate'], width=config['width'], height=config['height'],
+                                 jitter=config['jitter'], stall_prob=config['stall_prob'], stall_s=config['stall_s'])
+    image = ximea_sim.SimImage()
+    camera.open_device()
+    camera.start_acquisition()
+    frame_ring = ximea_ring.FrameRing(config['ring_slots'], imshape, config['ring_policy'])
+    compressor = None
+    if config['compression'] != 'none':
+        compressor = ximea_compress.FrameCompressor(config['compression'], config['compression_level'],
+                                                    config['compression_workers'])
+    save_dir = tempfile.mkdtemp(prefix='ximea_bench_', dir=config['target'])
+    stats = WriteLatencyStats('ximea', save_dir, frame_ring)
+    stop_collecting = threading.Event()
+    try:
+        handles = ximea_utils.start_ximea_aquisition(camera, image, frame_ring, save_dir,
+                                                     config['ims_per_file'], stop_collecting,
+                                                     threading.Event(), threading.Event(),
+                                                     _BenchClock, logger, config['write_mode'], stats,
+                                                     compressor)
+        time.sleep(config['duration'])
+        stop_collecting.set()
+        handles.acq_thread.join()
+        handles.save_thread.join()
+
+        n_saved, n_missing = count_missing_frames(save_dir, 'ximea')
+        elapsed = (stats.last_write - stats.first_write) if n_saved > 1 else float('nan')
+        frame_mb = frame_ring.frame_nbytes / 1e6
+        result = dict(config)
+        result.update({
+            'frames_saved': n_saved,
+            'frames_missing': n_missing,
+            'frames_dropped_ring': frame_ring.dropped,
+            'fps': (n_saved - 1) / elapsed,
+            'mb_per_s': (n_saved - 1) * frame_mb / elapsed,
+            'queue_high_water': frame_ring.max_depth,
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        })
+        if compressor is not None:
+            result['compression_ratio'] = compressor.ratio
+            result['compression_worker_mb_per_s'] = compressor.worker_throughput()
+        result.update(stats.summary())
+        if config['decode']:
+            result.update(time_decode(imshape))
+        return(result)
+    finally:
+        camera.close_device()
+        shutil.rmtree(save_dir, ignore_errors=True)
+
+def build_configs(args):
+    '''
+    Expand the command line lists into one config per combination
+    '''
+    configs = []
+    for size, rate, ipf, mode, target, codec in itertools.product(args.sizes.split(','), args.rates.split(','),
+                                                                 args.ims_per_file.split(','), args.write_modes.split(','),
+                                                                 args.targets.split(','), args.compression.split(',')):
+        width, height = (int(v) for v in size.lower().split('x'))
+        configs.append({'width': width, 'height': height, 'framerate': float(rate),
+                        'ims_per_file': int(ipf), 'write_mode': mode, 'target': target,
+                        'compression': codec, 'compression_level': args.compression_level,
+                        'compression_workers': args.compression_workers,
+                        'ring_slots': args.ring_slots, 'ring_policy': args.ring_policy,
+                        'duration': args.duration, 'jitter': args.jitter,
+                        'stall_prob': args.stall_prob, 'stall_s': args.stall_s,
+                        'decode': not args.no_decode})
+    return(configs)
+
+def config_key(config):
+    return((config['width'], config['height'], config['framerate'], config['ims_per_file'],
+            config['write_mode'], config['target'], config.get('compression', 'none')))
+
+def git_version():
+    try:
+        return(subprocess.check_output(['git', 'describe', '--always', '--dirty'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip())
+    except Exception:
+        return(None)
+
+def compare(old_file, new_file):
+    '''
+    Print throughput and latency changes for configurations present in both result files
+    '''
+    with open(old_file) as f:
+        old = {config_key(r): r for r in json.load(f)['results']}
+    with open(new_file) as f:
+        new = json.load(f)['results']
+    for r in new:
+        o = old.get(config_key(r))
+        if o is None:
+            continue
+        print(f"{r['width']}x{r['height']}@{r['framerate']:g} ipf={r['ims_per_file']} {r['write_mode']} {r['target']} {r.get('compression', 'none')}")
+        for k in ('fps', 'mb_per_s', 'frames_missing', 'queue_high_water', 'latency_p99_ms', 'peak_rss_mb',
+                  'decode_mean_ms', 'compression_ratio'):
+            if k in r and k in o:
+                print(f'    {k:>18}: {o[k]:10.2f} -> {r[k]:10.2f}')
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the Ximea acquisition and saving pipeline with a simulated camera')
+    parser.add_argument('--sizes', default='2064x1544', help='comma separated WIDTHxHEIGHT list')
+    parser.add_argument('--rates', default='200', help='comma separated frame rates')
+    parser.add_argument('--ims-per-file', default='200', help='comma separated ims_per_file values')
+    parser.add_argument('--write-modes', default='direct', help='comma separated write modes')
+    parser.add_argument('--targets', default=tempfile.gettempdir(), help='comma separated directories to record into')
+    parser.add_argument('--compression', default='none', help='comma separated codecs, see ximea_compress.available_codecs')
+    parser.add_argument('--compression-level', type=int, default=1)
+    parser.add_argument('--compression-workers', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=5.0, help='seconds to record per configuration')
+    parser.add_argument('--ring-slots', type=int, default=64)
+    parser.add_argument('--ring-policy', default='drop_oldest', choices=ximea_ring.RING_POLICIES)
+    parser.add_argument('--jitter', type=float, default=0.0, help='frame delivery jitter in seconds')
+    parser.add_argument('--stall-prob', type=float, default=0.0, help='chance per frame of a delivery stall')
+    parser.add_argument('--stall-s', type=float, default=0.05, help='length of a stall in seconds')
+    parser.add_argument('--no-decode', action='store_true', help='skip timing decode_ximea_frame')
+    parser.add_argument('--out', default='ximea_bench.json', help='where to write the results')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two result files and exit')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    #run every configuration in a fresh process so memory use doesn't carry over
+    ctx = multiprocessing.get_context('spawn')
+    results = []
+    for config in build_configs(args):
+        with ctx.Pool(1) as pool:
+            result = pool.apply(run_config, (config,))
+        results.append(result)
+        print(f"{config['width']}x{config['height']}@{config['framerate']:g} ipf={config['ims_per_file']} "
+              f"{config['write_mode']} {config['target']} {config['compression']}: {result['fps']:.1f} fps {result['mb_per_s']:.0f} MB/s "
+              f"missing={result['frames_missing']} high_water={result['queue_high_water']} "
+              f"p99={result['latency_p99_ms']:.1f} ms rss={result['peak_rss_mb']:.0f} MB")
+
+    with open(args.out, 'w') as f:
+        json.dump({'version': git_version(), 'host': platform.node(), 'python': platform.python_version(),
+                   'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'results': results}, f, indent=2)
+    print(f'Results written to {args.out}')
+
+if __name__ == '__main__':
+    main()
@@ -10,22 +10,24 @@ See COPYING and COPYING.LESSER for license details.
 """
 
 from plugin import Plugin
-from pyglui.cygl.utils import draw_points_norm, RGBA, draw_gl_texture
+from pyglui.cygl.utils import draw_points_norm, draw_polyline_norm, RGBA, Named_Texture
 from pyglui import ui
 import gl_utils
-import numpy as np
 
-from video_overlay.plugins.generic_overlay import Video_Overlay
-
-import threading
 import ximea_utils
+import ximea_writer
+import ximea_sim
+import ximea_compress
+import ximea_reader
+import ximea_backpressure
+import ximea_rig
+import ximea_roi
 
 #logging
 import logging
 logger = logging.getLogger(__name__)
 
 import os
-import cv2
 
 
 class Ximea_Capture(Plugin):
@@ -41,47 +43,137 @@ class Ximea_Capture(Plugin):
     def __init__(self, g_pool,
     record_ximea=True, preview_ximea=False,
     serial_num='XECAS1930001', subject='TEST_SUBJECT', task='TEST_TASK',
-     yaml_loc='/home/vasha/cy.yaml', imshape=(1544, 2064), ims_per_file=200):
+     yaml_loc='/home/vasha/cy.yaml', imshape=(1544, 2064), ims_per_file=200,
+     ring_slots=64, ring_policy='drop_oldest', write_mode='direct', simulate_camera=False,
+     compression='none', compression_level=1, compression_workers=4, preview_fps=15,
+     acquisition_process=False, write_in_child=True, cameras=None, sync_interval=5.0,
+     roi_mode='full', decimation=1, backpressure=True, backpressure_policy=None):
         super().__init__(g_pool)
         self.order = 0.1
         #self.pupil_display_list = []
 
         self.record_ximea = record_ximea
         self.preview_ximea = preview_ximea
-        self.serial_num = serial_num
-        self.yaml_loc = yaml_loc
         self.subject = subject
         self.task = task
         self.imshape = imshape
         self.ims_per_file = ims_per_file
-
-        self.camera = None
-        self.image_handle = None
-        self.camera_open = False
-        self.save_queue =  None
+        self.ring_slots = ring_slots
+        self.ring_policy = ring_policy
+        self.write_mode = write_mode
+        #use a simulated camera instead of xiapi, for testing without hardware
+        self.camera_backend = ximea_sim if simulate_camera else None
+        self.compression = compression
+        self.compression_level = compression_level
+        self.compression_workers = compression_workers
+        #record from a child process through a shared memory ring instead of threads in this process
+        self.acquisition_process = acquisition_process
+        self.write_in_child = write_in_child
+        self.preview_fps = preview_fps
+        #seconds between camera clock sync samples while recording
+        self.sync_interval = sync_interval
+        #what part of each camera's sensor, and one in how many frames, is recorded (see ximea_roi)
+        self.roi_mode = roi_mode
+        self.decimation = decimation
+        #clicking a camera's preview centres its ROI there
+        self.place_roi = False
+        #back off step by step when a writer falls behind, see ximea_backpressure
+        self.backpressure = backpressure
+        self.backpressure_policy = ximea_backpressure.make_policy(backpressure_policy)
         self.blink_counter = 0
+        self.save_dir = None
+        #(save_dir, cameras) of recordings whose frame index is written once their cameras have saved
+        self.pending_indexes = []
+        self.recorded = []
+        self.new_camera_name = 'cam_2'
 
         #self.save_folder = g_pool.rec_dir
 
-        self.stop_collecting_event = threading.Event()
-        self.currently_recording =  threading.Event()
-        self.currently_saving =  threading.Event()
-
-        try:
-            self.camera, self.image_handle, self.camera_open = ximea_utils.init_camera(self.serial_num, self.yaml_loc, logger)
-        except Exception as e:
-            logger.info(f'Problem with Opening Camera: {e}')
-            self.preview_ximea = False
-            self.record_ximea = False
+        #each camera is a dict with name, serial_num, yaml_loc and optionally save_root and
+        #roi (x, y, width, height), a single camera is called ximea and saves where recordings always have
+        if cameras is None:
+            cameras = [{'name': 'ximea', 'serial_num': serial_num, 'yaml_loc': yaml_loc}]
+        self.cameras = [ximea_rig.RigCamera(c['name'], c['serial_num'], c['yaml_loc'], self, logger, c.get('save_root', ''),
+                                            c.get('roi'))
+                        for c in cameras]
+        #cameras open in the background, their previews start from gl_display once they're ready
+        for cam in self.cameras:
+            cam.open()
+        self.load_recording_options()
         #time sync protocol
         # def get_timestamp():
         #     return get_time_monotonic() - g_pool.timebase.value
         # g_pool.get_timestamp = get_timestamp
         # g_pool.get_now = get_time_monotonic
 
+    def start_preview(self):
+        for cam in self.cameras:
+            cam.start_preview()
+
+    def stop_preview(self):
+        for cam in self.cameras:
+            cam.stop_preview()
+
+    def busy(self):
+        return(any(cam.busy() for cam in self.cameras))
+
+    def camera(self, cam_name):
+        '''
+        The RigCamera called cam_name, None if there is none
+        '''
+        return(next((cam for cam in self.cameras if cam.name == cam_name), None))
+
+    def subscribe(self, cam_name='ximea', kind='raw', decimation=1, step=1, copy=True):
+        '''
+        Live frames of a camera while it records, for other plugins, see ximea_publish
+        Returns:
+            subscription (ximea_publish.Subscription): wait() for frames, close() when done
+        '''
+        cam = self.camera(cam_name)
+        if cam is None:
+            raise ValueError(f'No camera called {cam_name}, there are {[cam.name for cam in self.cameras]}')
+        return(cam.publisher.subscribe(kind, decimation, step, copy))
+
+    def load_recording_options(self):
+        '''
+        Take pipeline options from the 'recording' section of the first camera's yaml file, if it has one
+        '''
+        yaml_loc = self.cameras[0].yaml_loc
+        try:
+            options = ximea_utils.read_recording_options(yaml_loc)
+        except Exception as e:
+            logger.info(f'Could not read recording options from {yaml_loc}: {e}')
+            return
+        for key in ('compression', 'compression_level', 'compression_workers', 'sync_interval'):
+            if key in options:
+                setattr(self, key, options[key])
+        if 'backpressure' in options:
+            try:
+                self.backpressure_policy = ximea_backpressure.make_policy(options['backpressure'])
+            except (TypeError, ValueError) as e:
+                logger.info(f'Could not read the backpressure policy in {yaml_loc}, using the default: {e}')
+        #frames shared with other processes, each entry names a camera and the block to share its frames in
+        for share in options.get('publish', None) or []:
+            share = dict(share)
+            cam = self.camera(share.pop('camera', self.cameras[0].name))
+            try:
+                cam.share(**share)
+            except (TypeError, ValueError, OSError, AttributeError) as e:
+                logger.info(f'Could not share frames as {share}: {e}')
+        if self.compression not in ximea_compress.available_codecs():
+            logger.info(f'Compression {self.compression} is not available here, recording uncompressed')
+            self.compression = 'none'
+
     def init_ui(self):
         self.add_menu()
         self.menu.label = "Ximea Cpature"
+        self.build_menu()
+
+    def build_menu(self):
+        '''
+        (Re)build the menu, it has a section per camera
+        '''
+        self.menu.elements[:] = []
 
         def set_record(record_ximea):
             self.record_ximea = record_ximea
@@ -94,8 +186,10 @@ class Ximea_Capture(Plugin):
             #     self.record_ximea = False
         def set_preview(preview_ximea):
             self.preview_ximea = preview_ximea
-            if(self.currently_recording.is_set() & self.preview_ximea):
-                logger.info('Cant preview while recording')
+            if(self.preview_ximea):
+                self.start_preview()
+            else:
+                self.stop_preview()
             # try:
             #     self.camera, self.image_handle, self.camera_open = ximea_utils.init_camera(self.serial_num, self.yaml_loc, logger)
             # except Exception as e:
@@ -103,72 +197,220 @@ class Ximea_Capture(Plugin):
             #     logger.info(f'Error: {e}')
             #     self.preview_ximea = False
             #     self.record_ximea = False
-        def set_serial_num(new_serial_num):
-            self.serial_num = new_serial_num
-            if not self.camera == None:
-                self.camera.close_device()
-            try:
-                self.camera, self.image_handle, self.camera_open = ximea_utils.init_camera(self.serial_num, self.yaml_loc, logger)
-            except Exception as e:
-                logger.info(f'Problem with Serial Number: {e}')
-                self.preview_ximea = False
-                self.record_ximea = False
+        def set_acquisition_process(acquisition_process):
+            if self.busy():
+                logger.info('Can not change where acquisition runs while recording')
+                return
+            self.acquisition_process = acquisition_process
+            for cam in self.cameras:
+                cam.alloc_frame_ring()
+        def set_roi_mode(roi_mode):
+            if self.busy():
+                logger.info('Can not change the ROI mode while recording')
+                return
+            self.roi_mode = roi_mode
+            for cam in self.cameras:
+                cam.apply_roi()
+        def set_decimation(decimation):
+            if self.busy():
+                logger.info('Can not change decimation while recording')
+                return
+            self.decimation = int(decimation)
+        def total_rate():
+            rates = [cam.data_rate() for cam in self.cameras]
+            if None in rates:
+                return('unknown, a settings file has no framerate')
+            return(f'{sum(rates):.0f} MB/s, {sum(rates) * 3.6:.0f} GB/h')
         def set_subject_id(new_subject):
             self.subject = new_subject
         def set_task_name(new_task_name):
             self.task = new_task_name
-        def set_yaml_loc(new_yaml_loc):
-            self.yaml_loc = new_yaml_loc
-            if not self.camera == None:
-                self.camera.close_device()
-            try:
-                self.camera, self.image_handle, self.camera_open = ximea_utils.init_camera(self.serial_num, self.yaml_loc, logger)
-            except Exception as e:
-                logger.info(r'Problem with Yaml File: {e}')
-                self.preview_ximea = False
-                self.record_ximea = False
+        def add_camera():
+            if self.busy():
+                logger.info('Can not add a camera while recording')
+                return
+            if self.new_camera_name in [cam.name for cam in self.cameras]:
+                logger.info(f'There already is a camera called {self.new_camera_name}')
+                return
+            first = self.cameras[0]
+            cam = ximea_rig.RigCamera(self.new_camera_name, first.serial_num, first.yaml_loc, self, logger)
+            self.cameras.append(cam)
+            cam.open()
+            self.new_camera_name = f'cam_{len(self.cameras) + 1}'
+            self.build_menu()
         help_str = "Ximea Capture Captures frames from Ximea Cameras in Parallel with Record."
         self.menu.append(ui.Info_Text(help_str))
-        self.menu.append(ui.Text_Input("serial_num", self, setter=set_serial_num, label="Serial Number"))
         self.menu.append(ui.Switch("preview_ximea",self, setter=set_preview, label="Preview Ximea Cameras"))
-        self.menu.append(ui.Text_Input("yaml_loc", self, setter=set_yaml_loc, label="Cam Settings Location"))
         self.menu.append(ui.Text_Input("subject", self, setter=set_subject_id, label="Subject ID"))
         self.menu.append(ui.Text_Input("task", self, setter=set_task_name, label="Task Name"))
         self.menu.append(ui.Switch("record_ximea",self, setter=set_record, label="Record From Ximea Cameras"))
+        self.menu.append(ui.Switch("acquisition_process", self, setter=set_acquisition_process, label="Acquire in Separate Process"))
+        self.menu.append(ui.Switch("write_in_child", self, label="Write from Acquisition Process"))
+        self.menu.append(ui.Selector("write_mode", self, selection=list(ximea_writer.WRITE_MODES), label="Disk Write Mode"))
+        self.menu.append(ui.Selector("compression", self, selection=ximea_compress.available_codecs(), label="Compression"))
+        self.menu.append(ui.Slider("compression_level", self, min=1, max=9, step=1, label="Compression Level"))
+        self.menu.append(ui.Slider("compression_workers", self, min=1, max=16, step=1, label="Compression Workers"))
+        self.menu.append(ui.Slider("sync_interval", self, min=1, max=60, step=1, label="Clock Sync Every (s)"))
+        self.menu.append(ui.Switch("backpressure", self, label="Back Off When Writing Falls Behind"))
+        self.menu.append(ui.Selector("roi_mode", self, setter=set_roi_mode, selection=list(ximea_roi.ROI_MODES), label="ROI Mode"))
+        self.menu.append(ui.Slider("decimation", self, setter=set_decimation, min=1, max=10, step=1, label="Record One Frame In"))
+        self.menu.append(ui.Switch("place_roi", self, label="Place ROI by Clicking Preview"))
+        self.menu.append(ui.Text_Input("total_rate", self, label="Total Data Rate", setter=lambda _: None, getter=total_rate))
+        for cam in self.cameras:
+            self.menu.append(self.camera_menu(cam))
+        self.menu.append(ui.Text_Input("new_camera_name", self, label="New Camera Name"))
+        self.menu.append(ui.Button("Add Camera", add_camera))
 
         # set_save_dir()
 
+    def camera_menu(self, cam):
+        '''
+        Settings and live status of one camera
+        '''
+        def reopen():
+            #the preview starts again once the camera is open
+            cam.close()
+            cam.open()
+        def set_serial_num(new_serial_num):
+            if cam.busy():
+                logger.info('Can not change camera while recording')
+                return
+            cam.serial_num = new_serial_num
+            reopen()
+        def set_yaml_loc(new_yaml_loc):
+            if cam.busy():
+                logger.info('Can not change camera settings while recording')
+                return
+            cam.yaml_loc = new_yaml_loc
+            #only the parameters that differ are set, the camera stays open
+            cam.apply_settings()
+            if cam is self.cameras[0]:
+                self.load_recording_options()
+        def get_roi():
+            g = cam.placed_roi()
+            if cam.roi is None:
+                return('full sensor')
+            return(f'{g.x},{g.y},{g.width},{g.height}')
+        def set_roi(roi):
+            if cam.busy():
+                logger.info('Can not change the ROI while recording')
+                return
+            try:
+                cam.roi = tuple(int(v) for v in roi.split(',')) if roi.strip() and roi.strip() != 'full sensor' else None
+                if cam.roi is not None and len(cam.roi) != 4:
+                    raise ValueError('give x,y,width,height')
+            except ValueError as e:
+                logger.info(f'Could not read ROI {roi}: {e}')
+                cam.roi = None
+            cam.apply_roi()
+        def remove_camera():
+            if self.busy() or len(self.cameras) == 1:
+                logger.info('Can not remove a camera while recording, or the last camera')
+                return
+            cam.cleanup()
+            self.cameras.remove(cam)
+            self.build_menu()
+        menu = ui.Growing_Menu(f'Camera {cam.name}')
+        menu.collapsed = len(self.cameras) > 1
+        menu.append(ui.Text_Input("status", cam, label="Status", setter=lambda _: None, getter=cam.status_text))
+        menu.append(ui.Text_Input("serial_num", cam, setter=set_serial_num, label="Serial Number"))
+        menu.append(ui.Text_Input("yaml_loc", cam, setter=set_yaml_loc, label="Cam Settings Location"))
+        menu.append(ui.Text_Input("save_root", cam, label="Save Frames To (blank: recording)"))
+        menu.append(ui.Text_Input("roi", cam, label="ROI x,y,w,h (blank: full)", setter=set_roi, getter=get_roi))
+        menu.append(ui.Text_Input("rate", cam, label="Data Rate", setter=lambda _: None, getter=cam.rate_text))
+        menu.append(ui.Text_Input("compression_status", cam, label="Compression Stats",
+                                  setter=lambda _: None, getter=cam.compression_status))
+        menu.append(ui.Text_Input("live_frames", cam, label="Live Frames",
+                                  setter=lambda _: None, getter=cam.publisher.status_text))
+        for key, label in (('rates', 'Frame Rates'), ('queue', 'Queue Depth'), ('dropped', 'Dropped Frames'),
+                           ('backpressure', 'Backpressure'), ('latency', 'Write Latency'), ('disk', 'Disk')):
+            menu.append(ui.Text_Input(f'telemetry_{key}', cam, label=label, setter=lambda _: None,
+                                      getter=lambda key=key: cam.telemetry_status(key)))
+        if len(self.cameras) > 1:
+            menu.append(ui.Button("Remove Camera", remove_camera))
+        return(menu)
+
     def gl_display(self):
         # blink?
         if int(self.blink_counter / 10) % 2 == 1:
-            if self.currently_recording.is_set():
+            if any(cam.currently_recording.is_set() for cam in self.cameras):
                 draw_points_norm([(0.01,0.1)], size=35, color=RGBA(0.1, 1.0, 0.1, 0.8))
-            if self.currently_saving.is_set():
+            if any(cam.currently_saving.is_set() for cam in self.cameras):
                 draw_points_norm([(0.01,0.01)], size=35, color=RGBA(1.0, 0.1, 0.1, 0.8))
         self.blink_counter += 1
 
         if(self.preview_ximea):
-            if(self.currently_recording.is_set()):
-                #if we are currently saving, don't grab images
-                im = np.ones((*self.imshape,3)).astype(np.uint8)
-                alp=0
-            elif(not self.camera_open):
-                logger.info(f'Unable to Open Camera!')
-                self.preview_ximea = False
-                im = np.zeros((*self.imshape,3)).astype(np.uint8)
-                alp = 0.5
-            else:
-                im = ximea_utils.decode_ximea_frame(self.camera, self.image_handle, self.imshape, logger)
-                alp=1
-            #cv2.imshow('image',im)
-            #cv2.imwrite('/home/vasha/img.png', im)
+            #the preview threads do the grabbing and debayering, only upload new images here
+            #cameras are shown side by side, a camera that isn't open yet leaves its place empty
             gl_utils.make_coord_system_norm_based()
-            draw_gl_texture(im, interpolation=True, alpha=alp)
+            n = len(self.cameras)
+            for i, cam in enumerate(self.cameras):
+                if cam.preview is None:
+                    continue
+                seq, im = cam.preview.latest()
+                if im is None:
+                    continue
+                if cam.preview_texture is None:
+                    cam.preview_texture = Named_Texture()
+                if seq != cam.preview_seq:
+                    cam.preview_texture.update_from_ndarray(im)
+                    cam.preview_seq = seq
+                cam.preview_texture.draw(quad=((i / n, 0.), ((i + 1) / n, 0.), ((i + 1) / n, 1.), (i / n, 1.)))
+                self.draw_roi(cam, i, n)
 
-        if(self.record_ximea):
-            if not self.camera_open:
-                logger.info('Camera Not Open!')
-                self.record_ximea = False
+        #also opens cameras that came ready and reconnects lost ones
+        for cam in self.cameras:
+            cam.poll()
+        for save_dir, cams in list(self.pending_indexes):
+            if not any(cam.busy() for cam in cams):
+                self.pending_indexes.remove((save_dir, cams))
+                self.write_frame_index(save_dir, cams)
+
+    def draw_roi(self, cam, i, n):
+        '''
+        Outline the camera's ROI on its preview (tile i of n) while the preview shows the whole sensor
+        '''
+        g = cam.placed_roi()
+        if cam.roi is None or g.mode == 'hardware' or cam.currently_recording.is_set() or cam.acq_process is not None:
+            return
+        corners = [ximea_roi.sensor_to_preview(g, x, y)
+                   for x, y in ((g.x, g.y), (g.x + g.width, g.y), (g.x + g.width, g.y + g.height), (g.x, g.y + g.height))]
+        verts = [((i + fx) / n, fy) for fx, fy in corners]
+        draw_polyline_norm(verts + verts[:1], 2, RGBA(1.0, 0.8, 0.1, 0.9))
+
+    def on_click(self, pos, button, action):
+        '''
+        With "Place ROI by Clicking Preview" on, centre the ROI of the camera clicked on there
+        '''
+        #action 1 is GLFW_PRESS
+        if not (self.place_roi and self.preview_ximea) or action != 1 or self.roi_mode == 'hardware':
+            return
+        width, height = self.g_pool.capture.frame_size
+        n = len(self.cameras)
+        #pos is in world frame pixels from the top left, the previews are laid out bottom up
+        nx, fy = pos[0] / width, 1 - pos[1] / height
+        if not (0 <= nx < 1 and 0 <= fy <= 1):
+            return
+        i = int(nx * n)
+        cam = self.cameras[i]
+        if cam.busy():
+            return
+        g = cam.placed_roi()
+        x, y = ximea_roi.preview_to_sensor(g, nx * n - i, fy)
+        roi_w, roi_h = (g.width, g.height) if cam.roi is not None else (g.sensor_shape[1] // 2, g.sensor_shape[0] // 2)
+        cam.roi = (x - roi_w // 2, y - roi_h // 2, roi_w, roi_h)
+        cam.apply_roi()
+
+    def write_frame_index(self, save_dir, cams):
+        '''
+        Line up the frames of every camera of a recording in Pupil time
+        '''
+        names = [cam.name for cam in cams]
+        try:
+            index_file_name = ximea_reader.write_frame_index(save_dir, names)
+            logger.info(f'Wrote cross camera frame index {index_file_name}')
+        except Exception as e:
+            logger.info(f'Could not write the cross camera frame index: {e}')
 
     def get_init_dict(self):
         return {}
@@ -181,17 +423,21 @@ class Ximea_Capture(Plugin):
             self.save_dir = os.path.join(notification.get("rec_path"),'ximea')
 
             if(self.record_ximea):
+                self.recorded = []
+                for cam in self.cameras:
+                    #a camera still saving the last recording has frames of it in its ring
+                    if cam.busy():
+                        logger.info(f'Camera {cam.name} is still saving the last recording, recording without it')
+                    elif not cam.camera_open:
+                        logger.info(f'Camera {cam.name} is not ready ({cam.status_text()}), recording without it')
+                    else:
+                        self.recorded.append(cam)
+                if not self.recorded:
+                    return
                 logger.info('Starting Recording from Ximea Cameras...')
                 logger.info(f'Saving Ximea Frames at {self.save_dir}...')
-                self.stop_collecting_event.clear()
                 os.mkdir(self.save_dir)
-                self.save_queue = ximea_utils.start_ximea_aquisition(self.camera, self.image_handle,
-                                                   self.save_dir, self.ims_per_file,
-                                                   self.stop_collecting_event,
-                                                   self.currently_recording,
-                                                   self.currently_saving,
-                                                   self.g_pool,
-                                                   logger)
+                self.recorded = [cam for cam in self.recorded if cam.start_recording(self.save_dir, self.g_pool)]
                 ximea_utils.write_user_info(self.save_dir, self.subject, self.task)
 
             else:
@@ -200,7 +446,11 @@ class Ximea_Capture(Plugin):
         elif notification.get("subject") == 'recording.stopped':
             if(self.record_ximea):
                 logger.info('Stopping Recording from Ximea Cameras...')
-                self.stop_collecting_event.set()
+                for cam in self.recorded:
+                    cam.stop_recording()
+                #written from gl_display once every camera has saved its frames
+                if len(self.recorded) > 1:
+                    self.pending_indexes.append((self.save_dir, list(self.recorded)))
             else:
                 logger.info('Did NOT Record from Ximea Cameras')
 
@@ -237,5 +487,5 @@ class Ximea_Capture(Plugin):
         This happens either voluntarily or forced.
         if you have an gui or glfw window destroy it here.
         """
-        if not self.camera == None:
-            self.camera.close_device()
+        for cam in self.cameras:
+            cam.cleanup()
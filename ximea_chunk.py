@@ -0,0 +1,256 @@
+"""
+Self-describing frame chunk files, as written by ximea_writer.ChunkWriter.
+
+A chunk is laid out as
+
+    header  HEADER_SIZE bytes: frame size, pixel format, bit depth and packing, codec, hash of the
+            camera settings file, the recording index of the chunk's first frame and
+            where the frames lie on the sensor (see ximea_roi)
+    frames  for every frame a FRAME_HEADER_DTYPE record (frame counter, camera, host and
+            Pupil timestamps, stored size) followed by the frame's bytes
+    index   written when the chunk is closed: a ximea_metadata.frame_record_dtype record
+            per frame, with the offset of its bytes, then a TRAILER_DTYPE pointing at them
+
+so a chunk can be read without the camera settings or any other file of the recording.
+Readers find every frame through the index; a chunk whose recording was cut short has no
+index and is recovered by scanning the frame records from the start.
+"""
+
+import hashlib
+import mmap
+import os
+
+import numpy as np
+
+import ximea_metadata
+import ximea_pixels
+import ximea_roi
+import ximea_settings
+
+MAGIC = b'XIMCHUNK'
+FRAME_MAGIC = b'XFRM'
+INDEX_MAGIC = b'XIMINDEX'
+#version 1 chunks have no ROI geometry, their frames are the whole sensor;
+#versions 1 and 2 have no packing, their frames are 8 bit
+VERSION = 3
+#one whole O_DIRECT block, so the header never shares a block with frames
+HEADER_SIZE = 4096
+
+HEADER_DTYPE = np.dtype([
+    ('magic', 'S8'),
+    ('version', '<u4'),
+    ('header_size', '<u4'),
+    ('height', '<u4'),         #frame size in pixels
+    ('width', '<u4'),
+    ('bit_depth', '<u4'),
+    ('pixel_format', 'S32'),   #imgdataformat from the settings file, e.g. XI_RAW8
+    ('codec', 'S8'),           #see ximea_compress.CHUNK_EXTENSIONS
+    ('frame_nbytes', '<u8'),   #bytes of an uncompressed (but packed) frame
+    ('first_index', '<u8'),    #recording frame number of the chunk's first frame
+    ('settings_hash', 'S64'),  #sha256 of the camera settings file, empty if there was none
+    ('roi_mode', 'S8'),        #see ximea_roi.ROI_MODES
+    ('sensor_height', '<u4'),  #frame size without a ROI
+    ('sensor_width', '<u4'),
+    ('roi_x', '<u4'),          #sensor position of the frames' top left pixel
+    ('roi_y', '<u4'),
+    ('decimation', '<u4'),     #one camera frame in this many was recorded
+    ('packing', 'S16'),        #see ximea_pixels.frame_format
+])
+
+FRAME_HEADER_DTYPE = np.dtype([
+    ('magic', 'S4'),
+    ('nbytes', '<u4'),
+    ('index', '<u8'),
+    ('nframe', '<u8'),
+    ('tsSec', '<u4'),
+    ('tsUSec', '<u4'),
+    ('t_host', '<f8'),
+    ('t_pupil', '<f8'),
+])
+
+TRAILER_DTYPE = np.dtype([('index_offset', '<u8'), ('n_frames', '<u8'), ('magic', 'S8')])
+
+def settings_hash(settings_file):
+    '''
+    sha256 of a camera settings file, '' if there is none
+    '''
+    if not settings_file or not os.path.exists(settings_file):
+        return('')
+    with open(settings_file, 'rb') as f:
+        return(hashlib.sha256(f.read()).hexdigest())
+
+def make_header(imshape, codec='none', settings_file=None, geometry=None):
+    '''
+    Describe the frames of a recording for its chunk headers
+    Params:
+        imshape (tuple): (height, width) of a frame as stored, width in bytes for packed frames
+        codec (str): compression codec of the frames
+        settings_file (str): camera .yaml, for the pixel format, bit depth, packing and settings hash
+        geometry (roi_geometry): ROI and decimation of the frames, whole sensor frames if None
+    Returns:
+        header (np.array): one HEADER_DTYPE record, first_index is filled in per chunk
+    '''
+    cam_props = {}
+    if settings_file and os.path.exists(settings_file):
+        cam_props = ximea_settings.load_settings(settings_file)
+    fmt = ximea_pixels.format_from_settings(cam_props)
+    pixel_shape = ximea_pixels.pixel_shape(imshape, fmt)
+    header = np.zeros(1, dtype=HEADER_DTYPE)
+    header['magic'] = MAGIC
+    header['version'] = VERSION
+    header['header_size'] = HEADER_SIZE
+    header['height'], header['width'] = pixel_shape
+    header['bit_depth'] = fmt.bits
+    header['packing'] = fmt.packing.encode()
+    header['pixel_format'] = str(cam_props.get('imgdataformat', 'XI_RAW8')).encode()
+    header['codec'] = codec.encode()
+    header['frame_nbytes'] = int(np.prod(imshape))
+    header['settings_hash'] = settings_hash(settings_file).encode()
+    if geometry is None:
+        geometry = ximea_roi.make_geometry('full', pixel_shape)
+    header['roi_mode'] = geometry.mode.encode()
+    header['sensor_height'], header['sensor_width'] = geometry.sensor_shape
+    header['roi_x'] = geometry.x
+    header['roi_y'] = geometry.y
+    header['decimation'] = geometry.decimation
+    return(header)
+
+def header_bytes(header, first_index):
+    '''
+    The header of a chunk starting at frame first_index, padded out to HEADER_SIZE
+    '''
+    header = header.copy()
+    header['first_index'] = first_index
+    buf = np.zeros(HEADER_SIZE, dtype=np.uint8)
+    buf[:HEADER_DTYPE.itemsize] = header.view(np.uint8)
+    return(buf)
+
+def frame_headers(records):
+    '''
+    In-band FRAME_HEADER_DTYPE records for frame_record_dtype records
+    '''
+    headers = np.empty(len(records), dtype=FRAME_HEADER_DTYPE)
+    headers['magic'] = FRAME_MAGIC
+    for name in FRAME_HEADER_DTYPE.names[1:]:
+        headers[name] = records[name]
+    return(headers)
+
+def index_bytes(records, index_offset):
+    '''
+    The index written when a chunk is closed: its records followed by the trailer
+    '''
+    trailer = np.array([(index_offset, len(records), INDEX_MAGIC)], dtype=TRAILER_DTYPE)
+    return(records.tobytes() + trailer.tobytes())
+
+def is_chunk_file(path):
+    with open(path, 'rb') as f:
+        return(f.read(len(MAGIC)) == MAGIC)
+
+class ChunkFile():
+    '''
+    A memory mapped chunk. records has one ximea_metadata.frame_record_dtype record per
+    frame, read from the index or, for a chunk that was never closed, by scanning it
+    (recovered is then True). imshape is the frame size in pixels and frame_format
+    (ximea_pixels.frame_format) how they are stored, frames is an (n, *stored_shape)
+    view of uncompressed frames and geometry (ximea_roi.roi_geometry) places them on the sensor.
+    '''
+    def __init__(self, path):
+        self.path = path
+        size = os.path.getsize(path)
+        if size < HEADER_SIZE:
+            raise ValueError(f'{path} is too short to be a chunk file')
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.buffer = np.frombuffer(self._mmap, dtype=np.uint8)
+        self.header = self.buffer[:HEADER_DTYPE.itemsize].view(HEADER_DTYPE)[0]
+        if self.header['magic'] != MAGIC:
+            raise ValueError(f'{path} is not a Ximea chunk file')
+        if self.header['version'] not in range(1, VERSION + 1):
+            raise ValueError(f'{path} has unsupported chunk version {self.header["version"]}')
+        self.imshape = (int(self.header['height']), int(self.header['width']))
+        if self.header['version'] < 3:
+            self.frame_format = ximea_pixels.RAW8
+        else:
+            self.frame_format = ximea_pixels.frame_format(int(self.header['bit_depth']), self.header['packing'].decode())
+        self.stored_shape = ximea_pixels.stored_shape(self.imshape, self.frame_format)
+        self.frame_nbytes = int(self.header['frame_nbytes'])
+        self.codec = self.header['codec'].decode()
+        self.first_index = int(self.header['first_index'])
+        if self.header['version'] == 1:
+            self.geometry = ximea_roi.make_geometry('full', self.imshape)
+        else:
+            h = self.header
+            self.geometry = ximea_roi.roi_geometry(h['roi_mode'].decode(), (int(h['sensor_height']), int(h['sensor_width'])),
+                                                   int(h['roi_x']), int(h['roi_y']), self.imshape[1], self.imshape[0],
+                                                   int(h['decimation']))
+        self.recovered = False
+        self.records = self._read_index()
+        if self.records is None:
+            self.recovered = True
+            self.records = self._scan()
+        self.frames = self._frame_view()
+
+    def _read_index(self):
+        size = len(self.buffer)
+        if size < HEADER_SIZE + TRAILER_DTYPE.itemsize:
+            return(None)
+        trailer = self.buffer[size - TRAILER_DTYPE.itemsize:].view(TRAILER_DTYPE)[0]
+        index_offset, n = int(trailer['index_offset']), int(trailer['n_frames'])
+        if trailer['magic'] != INDEX_MAGIC or index_offset + n * ximea_metadata.frame_record_dtype.itemsize + TRAILER_DTYPE.itemsize != size:
+            return(None)
+        return(self.buffer[index_offset:index_offset + n * ximea_metadata.frame_record_dtype.itemsize]
+               .view(ximea_metadata.frame_record_dtype).copy())
+
+    def _scan(self):
+        '''
+        Walk the frame records from the start, stopping at the first one that isn't whole
+        '''
+        found = []
+        pos = int(self.header['header_size'])
+        size = len(self.buffer)
+        while pos + FRAME_HEADER_DTYPE.itemsize <= size:
+            frame_header = self.buffer[pos:pos + FRAME_HEADER_DTYPE.itemsize].view(FRAME_HEADER_DTYPE)[0]
+            end = pos + FRAME_HEADER_DTYPE.itemsize + int(frame_header['nbytes'])
+            if frame_header['magic'] != FRAME_MAGIC or end > size:
+                break
+            found.append((frame_header, pos + FRAME_HEADER_DTYPE.itemsize))
+            pos = end
+        records = np.zeros(len(found), dtype=ximea_metadata.frame_record_dtype)
+        for i, (frame_header, offset) in enumerate(found):
+            for name in FRAME_HEADER_DTYPE.names[1:]:
+                records[name][i] = frame_header[name]
+            records['chunk'][i] = self.first_index
+            records['offset'][i] = offset
+        return(records)
+
+    def _frame_view(self):
+        '''
+        Strided view over the frames, None if they are compressed (or not evenly spaced)
+        '''
+        if self.codec != 'none' or not len(self.records):
+            return(None)
+        offsets = self.records['offset'].astype(np.int64)
+        stride = FRAME_HEADER_DTYPE.itemsize + self.frame_nbytes
+        if np.any(np.diff(offsets) != stride) or np.any(self.records['nbytes'] != self.frame_nbytes):
+            return(None)
+        return(np.ndarray((len(offsets), *self.stored_shape), dtype=np.uint8, buffer=self._mmap, offset=int(offsets[0]),
+                          strides=(stride, self.stored_shape[1], 1)))
+
+    def __len__(self):
+        return(len(self.records))
+
+    def payload(self, j):
+        '''
+        The stored bytes of the chunk's j-th frame
+        '''
+        record = self.records[j]
+        return(self.buffer[int(record['offset']):int(record['offset']) + int(record['nbytes'])])
+
+def load_records(paths):
+    '''
+    Records of every frame in a list of chunk files, in order
+    '''
+    records = [ChunkFile(path).records for path in paths if os.path.getsize(path) >= HEADER_SIZE]
+    if not records:
+        return(np.zeros(0, dtype=ximea_metadata.frame_record_dtype))
+    return(np.concatenate(records))
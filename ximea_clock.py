@@ -0,0 +1,163 @@
+"""
+Camera clock to Pupil time synchronisation during a recording.
+
+A sync sample reads the camera clock between two reads of Pupil time (and wall time),
+the gap between the two Pupil reads bounds how wrong the sample can be. ClockSync takes
+a sample every interval seconds from the acquisition thread, keeps the tightest of a few
+tries, drops samples whose bracket is much wider than usual, and maintains a least
+squares fit pupil_time = offset + drift * cam_time that the save thread uses to give
+every frame its Pupil timestamp as it is written.
+
+A sample far off the current fit means one of the clocks jumped; the fit then starts
+over from that sample so later frames follow the new offset.
+"""
+
+import threading
+import time
+
+import numpy as np
+
+def bracketed_sample(camera, g_pool):
+    '''
+    Read the camera clock between two reads of Pupil time
+    Returns:
+        t_sync (float): Pupil time, middle of the two reads
+        t_cam (float): camera time in seconds
+        t_wall (float): time.time(), middle of the two reads
+        bracket (float): seconds between the two Pupil time reads
+    '''
+    t_wall_1 = time.time()
+    t_sync_1 = g_pool.get_timestamp()
+    t_cam = camera.get_param('timestamp')
+    t_cam = t_cam/(1e9) #this is returned in nanoseconds, change to seconds
+    t_sync_2 = g_pool.get_timestamp()
+    t_wall_2 = time.time()
+    return((t_sync_1 + t_sync_2) / 2, t_cam, (t_wall_1 + t_wall_2) / 2, t_sync_2 - t_sync_1)
+
+def parse_sync_string(sync_string):
+    '''
+    Split a line of timestamp_camsync_{cam}.tsv
+    Returns:
+        label (str), t_sync, t_cam, t_wall (float), bracket (float or None for files without it)
+    '''
+    fields = sync_string.rstrip('\n').split('\t')
+    bracket = float(fields[4]) if len(fields) > 4 else None
+    return(fields[0], float(fields[1]), float(fields[2]), float(fields[3]), bracket)
+
+class ClockSync():
+    '''
+    Online offset plus drift fit of Pupil time against camera time.
+
+    The acquisition thread calls maybe_sample() once per frame, which costs a clock
+    read until a sample is due. Samples are also fed in from elsewhere with add_sample()
+    (e.g. from an acquisition process). to_pupil() can be called from any thread.
+    '''
+    def __init__(self, cam_name, camera=None, g_pool=None, interval=5.0, n_tries=3, jump_s=0.002,
+                 max_bracket_factor=4.0, logger=None):
+        self.cam_name = cam_name
+        self.camera = camera
+        self.g_pool = g_pool
+        self.interval = interval
+        self.n_tries = n_tries
+        self.jump_s = jump_s
+        self.max_bracket_factor = max_bracket_factor
+        self.logger = logger
+
+        self.n_samples = 0
+        self.n_jumps = 0
+        self.n_rejected = 0
+        self._next_sample = time.monotonic() + interval
+        #running sums for the current fit, both times relative to its first sample
+        self._t0 = None
+        self._y0 = None
+        self._sums = np.zeros(5) #n, x, y, xx, xy
+        self._brackets = []
+        #(t0, offset, drift) swapped in whole so readers never see a half updated fit
+        self._fit = None
+        self._lock = threading.Lock()
+
+    def sample(self, label, force=False):
+        '''
+        Take the tightest of n_tries bracketed samples and add it to the fit
+        Params:
+            force (bool): keep the sample even if its bracket is unusually wide
+        Returns:
+            sync_string (str): line for timestamp_camsync_{cam}.tsv, None if the sample was dropped
+        '''
+        best = min((bracketed_sample(self.camera, self.g_pool) for _ in range(self.n_tries)), key=lambda s: s[3])
+        self._next_sample = time.monotonic() + self.interval
+        if not self.add_sample(*best, force=force):
+            return(None)
+        t_sync, t_cam, t_wall, bracket = best
+        return(f'{label}\t{t_sync}\t{t_cam}\t{t_wall}\t{bracket}\n')
+
+    def maybe_sample(self, label):
+        '''
+        sample() if interval seconds have passed since the last one
+        Returns:
+            sync_string (str) or None
+        '''
+        if time.monotonic() < self._next_sample:
+            return(None)
+        return(self.sample(label))
+
+    def add_sample(self, t_sync, t_cam, t_wall=None, bracket=None, force=False):
+        '''
+        Add a sample to the fit
+        Returns:
+            accepted (bool): False if the bracket was too wide to trust
+        '''
+        with self._lock:
+            if (not force and bracket is not None and len(self._brackets) >= 3
+                    and bracket > self.max_bracket_factor * np.median(self._brackets)):
+                self.n_rejected += 1
+                return(False)
+            if self._fit is not None and self._sums[0] >= 2:
+                residual = t_sync - self.to_pupil(t_cam)
+                if abs(residual) > self.jump_s:
+                    self.n_jumps += 1
+                    if self.logger is not None:
+                        self.logger.info(f'{self.cam_name} clock jumped by {residual * 1e3:.1f} ms, restarting clock fit')
+                    self._t0 = None
+            if self._t0 is None:
+                self._t0 = t_cam
+                self._y0 = t_sync
+                self._sums[:] = 0
+            x = t_cam - self._t0
+            y = t_sync - self._y0
+            self._sums += (1, x, y, x * x, x * y)
+            self.n_samples += 1
+            if bracket is not None:
+                self._brackets.append(bracket)
+            n, sx, sy, sxx, sxy = self._sums
+            var = n * sxx - sx * sx
+            if n >= 2 and var > 0:
+                drift = (n * sxy - sx * sy) / var
+            else:
+                drift = 1.0
+            offset = (sy - drift * sx) / n
+            self._fit = (self._t0, self._y0 + offset, drift)
+            return(True)
+
+    @property
+    def fit(self):
+        '''
+        (offset, drift) with pupil_time = offset + drift * cam_time, None before the first sample
+        '''
+        if self._fit is None:
+            return(None)
+        t0, offset, drift = self._fit
+        return(offset - drift * t0, drift)
+
+    def to_pupil(self, cam_times):
+        '''
+        Pupil time of camera times (float or array), NaN before the first sample
+        '''
+        fit = self._fit
+        if fit is None:
+            return(np.full(np.shape(cam_times), np.nan) if np.ndim(cam_times) else np.nan)
+        t0, offset, drift = fit
+        return(offset + drift * (np.asarray(cam_times) - t0))
+
+    def median_bracket(self):
+        return(float(np.median(self._brackets)) if self._brackets else float('nan'))
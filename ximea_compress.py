@@ -0,0 +1,129 @@
+"""
+Lossless compression of raw frames between the frame ring and the chunk writer.
+
+Frames are compressed on a pool of threads. zlib, lz4 and zstd all release the GIL
+while they compress, so the pool scales across cores without copying frames into
+other processes. lz4 and zstd are optional (pip install lz4 / zstandard), zlib is
+always available.
+
+Compressed chunks are written as frames_{start}_{end}.{codec}; where every frame
+starts and how long it is is kept in the chunk itself, in each frame's record and
+in the index written when the chunk is closed (see ximea_chunk).
+"""
+
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import lz4.block
+except ImportError:
+    lz4 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+#codec name -> file extension of its chunks
+CHUNK_EXTENSIONS = {'none': 'bin', 'zlib': 'zlib', 'lz4': 'lz4', 'zstd': 'zst'}
+
+def available_codecs():
+    '''
+    Codecs that can be used with the packages installed here
+    '''
+    codecs = ['none', 'zlib']
+    if lz4 is not None:
+        codecs.append('lz4')
+    if zstandard is not None:
+        codecs.append('zstd')
+    return(codecs)
+
+def get_codec(codec, level=1):
+    '''
+    Compression and decompression functions for a codec
+    Params:
+        codec (str): one of available_codecs()
+        level (int): compression level, low is fast, high compresses best for every codec
+    Returns:
+        compress (function): buffer -> bytes
+        decompress (function): bytes -> bytes
+    '''
+    if codec == 'zlib':
+        return(lambda b: zlib.compress(b, level), zlib.decompress)
+    if codec == 'lz4' and lz4 is not None:
+        #level 1 is lz4's fast mode, higher levels are its high compression mode at that level
+        #store the size so decompression needs nothing but the payload
+        if level <= 1:
+            return(lambda b: lz4.block.compress(b, mode='fast', store_size=True), lz4.block.decompress)
+        return(lambda b: lz4.block.compress(b, mode='high_compression', compression=level, store_size=True),
+               lz4.block.decompress)
+    if codec == 'zstd' and zstandard is not None:
+        #zstd contexts aren't thread safe, keep one per worker thread
+        local = threading.local()
+        def compress(b):
+            if not hasattr(local, 'cctx'):
+                local.cctx = zstandard.ZstdCompressor(level=level)
+            return(local.cctx.compress(b))
+        def decompress(b):
+            if not hasattr(local, 'dctx'):
+                local.dctx = zstandard.ZstdDecompressor()
+            return(local.dctx.decompress(b))
+        return(compress, decompress)
+    raise ValueError(f'Codec {codec} not available, use one of {available_codecs()}')
+
+class FrameCompressor():
+    '''
+    Pool of threads compressing frames. submit() returns a future for the compressed
+    bytes; the caller must keep the source frame untouched until it is done.
+
+    Tracks the overall compression ratio and the input throughput of each worker so the
+    pool can be sized to the frame rate.
+    '''
+    def __init__(self, codec='lz4', level=1, n_workers=4):
+        self.codec = codec
+        self.level = level
+        self.n_workers = n_workers
+        self.extension = CHUNK_EXTENSIONS[codec]
+        self._compress, _ = get_codec(codec, level)
+        self._pool = ThreadPoolExecutor(max_workers=n_workers, thread_name_prefix='ximea_compress')
+        self.bytes_in = 0
+        self.bytes_out = 0
+        #thread name -> [bytes in, seconds busy], each entry only updated by its own thread
+        self.worker_stats = {}
+
+    def _run(self, frame):
+        t = time.perf_counter()
+        out = self._compress(frame)
+        stats = self.worker_stats.setdefault(threading.current_thread().name, [0, 0.0])
+        stats[0] += frame.nbytes
+        stats[1] += time.perf_counter() - t
+        return(out)
+
+    def submit(self, frame):
+        return(self._pool.submit(self._run, frame))
+
+    def count(self, n_in, n_out):
+        '''
+        Add a finished frame to the ratio, called by the writer in frame order
+        '''
+        self.bytes_in += n_in
+        self.bytes_out += n_out
+
+    @property
+    def ratio(self):
+        return(self.bytes_in / self.bytes_out if self.bytes_out else 0.0)
+
+    def worker_throughput(self):
+        '''
+        MB/s each worker compresses while busy
+        '''
+        return({name: b / s / 1e6 for name, (b, s) in sorted(self.worker_stats.items()) if s > 0})
+
+    def status_text(self):
+        rates = ' '.join(f'{r:.0f}' for r in self.worker_throughput().values())
+        return(f'{self.codec} ratio {self.ratio:.2f}, worker MB/s: {rates}')
+
+    def shutdown(self):
+        self._pool.shutdown(wait=True)
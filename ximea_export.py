@@ -0,0 +1,188 @@
+"""
+Export a recorded camera to a video or an image sequence, with the Pupil time of every frame.
+
+    python ximea_export.py REC/ximea --out ximea.mp4
+    python ximea_export.py REC/ximea --cam cam_od --out cam_od_frames --format png --start 1000 --stop 2000
+    python ximea_export.py REC/ximea --out frames_16bit --format tiff --bits16
+
+Frames are read through XimeaRecording in batches and demosaiced (as decode_ximea_frame
+does) on a pool of worker threads. Memory mapped reads, decompression and OpenCV all
+release the GIL, so the threads use every core without frames being copied between
+processes. Image sequences are encoded by the workers too; video goes through a single
+VideoWriter in frame order. At most two batches per worker are in flight, so memory
+use doesn't grow with the length of the recording.
+
+10 and 12 bit recordings are exported from the top 8 bits of each pixel, read straight
+from the packed frames. With bits16, png and tiff sequences keep every bit instead: the
+frames are unpacked, demosaiced at full depth and scaled up to fill 16 bits.
+
+Next to the output, a timestamps file lists every exported frame's index, camera frame
+counter, camera time and Pupil time.
+"""
+
+import argparse
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+import ximea_reader
+import ximea_ring
+
+#container -> fourcc used when none is given
+VIDEO_FORMATS = {'mp4': 'mp4v', 'avi': 'MJPG', 'mkv': 'XVID'}
+IMAGE_FORMATS = ('png', 'jpg', 'tiff', 'bmp')
+#image formats that can hold 16 bit frames
+IMAGE_FORMATS_16 = ('png', 'tiff')
+
+def export_batch(rec, indices, flip=True, norm=False, scale=1.0, image_pattern=None, bits16=False):
+    '''
+    Read, demosaic and (for image sequences) write one batch of frames
+    Params:
+        rec (XimeaRecording): recording to read from
+        indices (range): frames of the batch
+        image_pattern (str): write each frame to image_pattern.format(index) rather than returning it
+        bits16 (bool): uint16 frames with every recorded bit, rather than uint8
+    Returns:
+        bgr (np.array): (n, H, W, 3) frames, None when they were written as images
+    '''
+    key = slice(indices.start, indices.stop, indices.step)
+    raw = rec[key] if bits16 else rec.msb8(key)
+    if raw.ndim == 2:
+        raw = raw[None]
+    if bits16:
+        raw = raw.astype(np.uint16, copy=False)
+    bgr = ximea_reader.demosaic_frames(raw, flip, norm)
+    if bits16 and not norm:
+        bgr <<= 16 - rec.frame_format.bits
+    if scale != 1.0:
+        bgr = np.stack([cv2.resize(im, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA) for im in bgr])
+    if image_pattern is None:
+        return(bgr)
+    for i, im in zip(indices, bgr):
+        cv2.imwrite(image_pattern.format(i), im)
+    return(None)
+
+def write_timestamps(rec, indices, file_name):
+    '''
+    Write the timestamps sidecar for the exported frames
+    '''
+    try:
+        pupil_times = rec.pupil_times[indices]
+    except (OSError, ValueError) as e:
+        print(f'No Pupil times for this recording ({e}), leaving them out')
+        pupil_times = np.full(len(indices), np.nan)
+    with open(file_name, 'w') as f:
+        f.write('i\tframe\tcamtime\tpupiltime\n')
+        np.savetxt(f, np.rec.fromarrays([indices, rec.nframe[indices], rec.cam_times[indices], pupil_times]),
+                   fmt='%d\t%d\t%.6f\t%.6f')
+
+def export_recording(rec_dir, out, cam_name='ximea', imshape=None, fmt=None, fourcc=None, fps=None,
+                     start=0, stop=None, step=1, flip=True, norm=False, scale=1.0, workers=None, batch=16,
+                     bits16=False):
+    '''
+    Export frames of a recording to a video file or a folder of images
+    Params:
+        rec_dir (str): the recording's ximea folder
+        out (str): video file, or folder for an image sequence
+        imshape (tuple): (height, width), only needed for recordings made before chunks had headers
+        fmt (str): one of VIDEO_FORMATS or IMAGE_FORMATS, from the extension of out by default
+        fourcc (str): video codec, VIDEO_FORMATS[fmt] by default
+        fps (float): video frame rate, the recorded rate by default
+        start, stop, step (int): frames to export
+        workers (int): demosaic threads, one per core by default
+        batch (int): frames per batch
+        bits16 (bool): write 16 bit png or tiff images with every recorded bit
+    Returns:
+        n_frames (int): frames exported
+    '''
+    rec = ximea_reader.XimeaRecording(rec_dir, cam_name, imshape)
+    fmt = (fmt or os.path.splitext(out)[1][1:] or 'png').lower()
+    if fmt not in VIDEO_FORMATS and fmt not in IMAGE_FORMATS:
+        raise ValueError(f'Unknown format {fmt}, use one of {list(VIDEO_FORMATS) + list(IMAGE_FORMATS)}')
+    if bits16 and fmt not in IMAGE_FORMATS_16:
+        raise ValueError(f'16 bit frames can only be written as {IMAGE_FORMATS_16}, not {fmt}')
+    indices = np.arange(len(rec))[start:stop:step]
+    workers = workers or os.cpu_count()
+
+    image_pattern = None
+    writer = None
+    if fmt in IMAGE_FORMATS:
+        os.makedirs(out, exist_ok=True)
+        image_pattern = os.path.join(out, f'frame_{{:06d}}.{fmt}')
+        timestamps_file = os.path.join(out, 'timestamps.tsv')
+    else:
+        if fps is None:
+            dt = np.median(np.diff(rec.cam_times[indices])) if len(indices) > 1 else 0
+            fps = step / dt if dt > 0 else 30.0
+        size = (int(round(rec.imshape[1] * scale)), int(round(rec.imshape[0] * scale)))
+        writer = cv2.VideoWriter(out, cv2.VideoWriter_fourcc(*(fourcc or VIDEO_FORMATS[fmt])), fps, size)
+        if not writer.isOpened():
+            raise RuntimeError(f'Could not open {out} for writing with codec {fourcc or VIDEO_FORMATS[fmt]}')
+        timestamps_file = os.path.splitext(out)[0] + '_timestamps.tsv'
+    write_timestamps(rec, indices, timestamps_file)
+
+    batches = [range(int(indices[i]), int(indices[min(i + batch, len(indices)) - 1]) + 1, step)
+               for i in range(0, len(indices), batch)]
+    t_start = time.perf_counter()
+    n_done = 0
+
+    def finish(done_batch, future):
+        bgr = future.result()
+        if writer is not None:
+            for im in bgr:
+                writer.write(im)
+        return(len(done_batch))
+
+    #futures in frame order, never more than two batches per worker
+    in_flight = deque()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ximea_export') as pool:
+        for k, b in enumerate(batches):
+            in_flight.append((b, pool.submit(export_batch, rec, b, flip, norm, scale, image_pattern, bits16)))
+            if len(in_flight) >= 2 * workers:
+                n_done += finish(*in_flight.popleft())
+            if k % 20 == 19:
+                print(f'{n_done}/{len(indices)} frames, {n_done / (time.perf_counter() - t_start):.0f} fps')
+        while in_flight:
+            n_done += finish(*in_flight.popleft())
+    if writer is not None:
+        writer.release()
+    print(f'Exported {n_done} frames to {out} in {time.perf_counter() - t_start:.1f} s, timestamps in {timestamps_file}')
+    return(n_done)
+
+def main():
+    parser = argparse.ArgumentParser(description='Export a recorded Ximea camera to video or images')
+    parser.add_argument('rec_dir', help="the recording's ximea folder")
+    parser.add_argument('--cam', default='ximea', help='camera name')
+    parser.add_argument('--out', required=True, help='video file, or folder for an image sequence')
+    parser.add_argument('--format', help=f'one of {list(VIDEO_FORMATS) + list(IMAGE_FORMATS)}, from --out by default')
+    parser.add_argument('--fourcc', help='video codec, e.g. mp4v, avc1, MJPG')
+    parser.add_argument('--fps', type=float, help='video frame rate, the recorded rate by default')
+    parser.add_argument('--size', default=None, help='WIDTHxHEIGHT of the frames of recordings without chunk headers')
+    parser.add_argument('--settings', default=None, help='camera .yaml to take that frame size from')
+    parser.add_argument('--start', type=int, default=0)
+    parser.add_argument('--stop', type=int, default=None)
+    parser.add_argument('--step', type=int, default=1)
+    parser.add_argument('--no-flip', action='store_true', help="don't rotate frames 180 degrees")
+    parser.add_argument('--norm', action='store_true', help='stretch each frame to its full range')
+    parser.add_argument('--scale', type=float, default=1.0, help='resize frames by this factor')
+    parser.add_argument('--workers', type=int, default=None, help='demosaic threads, one per core by default')
+    parser.add_argument('--batch', type=int, default=16, help='frames per batch')
+    parser.add_argument('--bits16', action='store_true', help='write 16 bit png or tiff images with every recorded bit')
+    args = parser.parse_args()
+
+    imshape = None
+    if args.settings:
+        imshape = ximea_ring.frame_shape_from_yaml(args.settings)
+    if args.size:
+        width, height = (int(v) for v in args.size.split('x'))
+        imshape = (height, width)
+    export_recording(args.rec_dir, args.out, args.cam, imshape, args.format, args.fourcc, args.fps,
+                     args.start, args.stop, args.step, not args.no_flip, args.norm, args.scale,
+                     args.workers, args.batch, args.bits16)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""
+Per frame metadata records.
+
+Every saved frame has a fixed size frame_record_dtype record. The records are stored in
+the index of each frame chunk (see ximea_chunk); recordings made before that kept them
+in a separate binary log, timestamps_{cam}.bin: a 16 byte header (magic, format
+version, record size) followed by one record per saved frame, read by load_metadata.
+The timestamps_{cam}.tsv that older tools read is written from the records when a
+recording finishes (records_to_tsv), or from an old log by hand:
+
+    python ximea_metadata.py timestamps_ximea.bin timestamps_ximea.tsv
+"""
+
+import os
+import sys
+
+import numpy as np
+
+MAGIC = b'XIMEMETA'
+VERSION = 2
+HEADER_DTYPE = np.dtype([('magic', 'S8'), ('version', '<u4'), ('record_size', '<u4')])
+
+frame_record_dtype = np.dtype([
+    ('index', '<u8'),   #frame number within the recording
+    ('nframe', '<u8'),  #camera frame counter
+    ('tsSec', '<u4'),   #camera timestamp, seconds part
+    ('tsUSec', '<u4'),  #camera timestamp, microseconds part
+    ('t_host', '<f8'),  #host time.time() when the frame was received
+    ('chunk', '<u8'),   #first frame index of the chunk file holding the frame
+    ('offset', '<u8'),  #byte offset of the frame in that chunk file
+    ('nbytes', '<u4'),  #bytes stored for the frame
+    ('t_pupil', '<f8'), #Pupil time from the clock fit when the frame was written, NaN if there was none yet
+])
+
+#version 1 logs, before frames had a Pupil time
+frame_record_dtype_v1 = np.dtype(frame_record_dtype.descr[:-1])
+
+def meta_file_name(save_folder, cam_name):
+    return(os.path.join(save_folder, f'timestamps_{cam_name}.bin'))
+
+def make_records(first_index, slot_meta, t_pupil=None):
+    '''
+    Build records for a batch of frames about to be written, ChunkWriter.write_frames
+    fills in where each frame is stored (chunk, offset, nbytes)
+    Params:
+        first_index (int): recording frame number of the first frame in the batch
+        slot_meta (np.array): FrameRing.meta entries of the frames
+        t_pupil (np.array): Pupil time of each frame, NaN if not given
+    Returns:
+        records (np.array): frame_record_dtype records
+    '''
+    records = np.zeros(len(slot_meta), dtype=frame_record_dtype)
+    records['index'] = np.arange(first_index, first_index + len(slot_meta))
+    records['nframe'] = slot_meta['nframe']
+    records['tsSec'] = slot_meta['tsSec']
+    records['tsUSec'] = slot_meta['tsUSec']
+    records['t_host'] = slot_meta['t_host']
+    records['t_pupil'] = np.nan if t_pupil is None else t_pupil
+    return(records)
+
+def load_metadata(file_name):
+    '''
+    Read every record of a metadata log
+    Returns:
+        records (np.array): frame_record_dtype records, one per saved frame
+    '''
+    header = np.fromfile(file_name, dtype=HEADER_DTYPE, count=1)
+    if len(header) == 0 or header['magic'][0] != MAGIC:
+        raise ValueError(f'{file_name} is not a Ximea metadata log')
+    dtypes = {1: frame_record_dtype_v1, VERSION: frame_record_dtype}
+    dtype = dtypes.get(int(header['version'][0]))
+    if dtype is None or header['record_size'][0] != dtype.itemsize:
+        raise ValueError(f'{file_name} has unsupported metadata version {header["version"][0]}')
+    records = np.fromfile(file_name, dtype=np.uint8, offset=HEADER_DTYPE.itemsize)
+    #drop a partly written last record if the recording was cut short
+    n = len(records) // dtype.itemsize
+    records = records[:n * dtype.itemsize].view(dtype)
+    if dtype is not frame_record_dtype:
+        upgraded = np.empty(n, dtype=frame_record_dtype)
+        for name in dtype.names:
+            upgraded[name] = records[name]
+        upgraded['t_pupil'] = np.nan
+        records = upgraded
+    return(records)
+
+def cam_times(records):
+    '''
+    Camera time in seconds of every record
+    '''
+    return(records['tsSec'] + records['tsUSec'] * 1e-6)
+
+def records_to_tsv(records, ts_file_name):
+    '''
+    Write the timestamps_{cam}.tsv that earlier versions wrote frame by frame
+    '''
+    with open(ts_file_name, 'w') as ts_file:
+        ts_file.write(f"i\tframe\tcamtime\tpupiltime\n")
+        columns = [records['index'], records['nframe'], records['tsSec'], records['tsUSec'], records['t_pupil']]
+        np.savetxt(ts_file, np.rec.fromarrays(columns), fmt='%d\t%d\t%d.%06d\t%.6f')
+
+def metadata_to_tsv(meta_file, ts_file_name):
+    records_to_tsv(load_metadata(meta_file), ts_file_name)
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print('usage: python ximea_metadata.py timestamps_CAM.bin timestamps_CAM.tsv')
+        sys.exit(1)
+    metadata_to_tsv(sys.argv[1], sys.argv[2])
@@ -0,0 +1,199 @@
+"""
+Pixel formats of recorded frames: 8 bit, or 10 and 12 bit packed.
+
+For more than 8 bits the camera is set to hand over its transport format with bit
+packing (imgdataformat: XI_FRM_TRANSPORT_DATA, is_output_bit_packing: true,
+output_bit_packing_type: XI_DATA_PACK_PFNC_LSB_PACKING, output_bit_depth: XI_BPP_10
+or XI_BPP_12). Pixels then follow each other without padding, least significant bit
+first (GenICam PFNC Mono10p / Mono12p): 4 pixels in 5 bytes, or 2 pixels in 3 bytes.
+Frames stay packed all the way to disk, so a 12 bit recording writes 1.5 times the
+bytes of an 8 bit one rather than twice as many. A packed frame is kept as a
+(height, width * bits / 8) uint8 array, see stored_shape().
+
+Frames are unpacked where they are looked at:
+    unpack(packed, fmt)            uint16 pixels of one frame or a whole (n, H, W') batch
+    unpack_into(src, fmt, out)     the same a block of rows at a time, for memory mapped
+                                   frames: temporaries stay small and pages are read in order
+    unpack_msb8(packed, fmt, out)  just the top 8 bits, straight from the packed bytes,
+                                   for the preview and 8 bit exports
+"""
+
+import os
+from collections import namedtuple
+
+import numpy as np
+
+import ximea_settings
+
+#bits per pixel, packing: 'none' (one byte per pixel) or 'pfnc_lsb'
+frame_format = namedtuple('frame_format', 'bits packing')
+
+RAW8 = frame_format(8, 'none')
+PACKED_BITS = (10, 12)
+#settings file value of output_bit_packing_type -> packing
+PACKING_TYPES = {'XI_DATA_PACK_PFNC_LSB_PACKING': 'pfnc_lsb'}
+#pixels and bytes in one packed group
+GROUPS = {10: (4, 5), 12: (2, 3)}
+
+def format_from_settings(props):
+    '''
+    The format frames arrive in with a camera settings file
+    Params:
+        props (dict): settings, from ximea_settings.load_settings
+    Returns:
+        fmt (frame_format)
+    '''
+    packed = props.get('imgdataformat') == 'XI_FRM_TRANSPORT_DATA' and bool(props.get('is_output_bit_packing'))
+    if not packed:
+        #without packing the camera hands over image_data_bit_depth, 8 bit for XI_RAW8
+        depth = props.get('image_data_bit_depth', 'XI_BPP_8')
+        if depth != 'XI_BPP_8':
+            raise ValueError(f'{depth} frames need packing, set imgdataformat: XI_FRM_TRANSPORT_DATA, '
+                             'is_output_bit_packing: true and output_bit_depth')
+        return(RAW8)
+    bits = int(str(props.get('output_bit_depth', 'XI_BPP_8')).replace('XI_BPP_', ''))
+    #the camera's own default is XI_DATA_PACK_XI_GROUPING, so it has to be asked for
+    packing_type = props.get('output_bit_packing_type', 'XI_DATA_PACK_XI_GROUPING')
+    if packing_type not in PACKING_TYPES:
+        raise ValueError(f'Unsupported output_bit_packing_type {packing_type}, use one of {list(PACKING_TYPES)}')
+    if bits not in PACKED_BITS:
+        raise ValueError(f'Packed frames must be {PACKED_BITS} bit, not {bits}')
+    return(frame_format(bits, PACKING_TYPES[packing_type]))
+
+def format_from_file(settings_file):
+    '''
+    format_from_settings() of a camera .yaml, 8 bit if there is none
+    '''
+    if not settings_file or not os.path.exists(settings_file):
+        return(RAW8)
+    return(format_from_settings(ximea_settings.load_settings(settings_file)))
+
+def bytes_per_pixel(fmt):
+    return(fmt.bits / 8 if fmt.packing != 'none' else 1)
+
+def row_nbytes(width, fmt):
+    '''
+    Bytes of one row of width pixels
+    '''
+    if fmt.packing == 'none':
+        return(width)
+    n_pixels, n_bytes = GROUPS[fmt.bits]
+    if width % n_pixels:
+        raise ValueError(f'{fmt.bits} bit packed rows must be a multiple of {n_pixels} pixels wide, not {width}')
+    return(width // n_pixels * n_bytes)
+
+def stored_shape(imshape, fmt):
+    '''
+    (height, bytes per row) of a frame of imshape (height, width) pixels as it is kept in the ring and on disk
+    '''
+    return((imshape[0], row_nbytes(imshape[1], fmt)))
+
+def pixel_shape(shape, fmt):
+    '''
+    (height, width) in pixels of a frame stored as shape (height, bytes per row)
+    '''
+    if fmt.packing == 'none':
+        return(tuple(shape))
+    n_pixels, n_bytes = GROUPS[fmt.bits]
+    return((shape[0], shape[1] // n_bytes * n_pixels))
+
+def _groups(packed, fmt):
+    n_pixels, n_bytes = GROUPS[fmt.bits]
+    return(packed.reshape(*packed.shape[:-1], packed.shape[-1] // n_bytes, n_bytes))
+
+def unpack(packed, fmt, out=None):
+    '''
+    Unpack frames to one uint16 per pixel
+    Params:
+        packed (np.array): (..., bytes per row) uint8, a frame or a batch of frames
+        out (np.array): optional (..., width) uint16 to unpack into
+    Returns:
+        pixels (np.array): (..., width) uint16, values 0 to 2**bits - 1
+    '''
+    if fmt.packing == 'none':
+        if out is None:
+            return(packed.astype(np.uint16))
+        np.copyto(out, packed)
+        return(out)
+    n_pixels, _ = GROUPS[fmt.bits]
+    g = _groups(packed, fmt)
+    if out is None:
+        out = np.empty((*packed.shape[:-1], g.shape[-2] * n_pixels), dtype=np.uint16)
+    o = out.reshape(*g.shape[:-1], n_pixels)
+    b = [g[..., i].astype(np.uint16) for i in range(g.shape[-1])]
+    if fmt.bits == 10:
+        o[..., 0] = b[0] | ((b[1] & 0x03) << 8)
+        o[..., 1] = (b[1] >> 2) | ((b[2] & 0x0F) << 6)
+        o[..., 2] = (b[2] >> 4) | ((b[3] & 0x3F) << 4)
+        o[..., 3] = (b[3] >> 6) | (b[4] << 2)
+    else:
+        o[..., 0] = b[0] | ((b[1] & 0x0F) << 8)
+        o[..., 1] = (b[1] >> 4) | (b[2] << 4)
+    return(out)
+
+def unpack_into(src, fmt, out, rows=64):
+    '''
+    unpack() a block of rows at a time, for memory mapped frames
+    Params:
+        src (np.array): (n, H, bytes per row) or (H, bytes per row) packed frames, e.g. a chunk view
+        out (np.array): uint16 array of the unpacked shape
+        rows (int): rows per block
+    Returns:
+        out (np.array)
+    '''
+    src2 = src.reshape(-1, src.shape[-1])
+    out2 = out.reshape(-1, out.shape[-1])
+    for r in range(0, len(src2), rows):
+        unpack(src2[r:r + rows], fmt, out2[r:r + rows])
+    return(out)
+
+def unpack_msb8(packed, fmt, out=None):
+    '''
+    The top 8 bits of every pixel as uint8, worked out from the packed bytes without unpacking
+    Params:
+        packed (np.array): (..., bytes per row) uint8
+        out (np.array): optional (..., width) uint8 to write into
+    Returns:
+        pixels (np.array): (..., width) uint8, packed itself for 8 bit frames unless out is given
+    '''
+    if fmt.packing == 'none':
+        if out is None:
+            return(packed)
+        np.copyto(out, packed)
+        return(out)
+    n_pixels, _ = GROUPS[fmt.bits]
+    g = _groups(packed, fmt)
+    if out is None:
+        out = np.empty((*packed.shape[:-1], g.shape[-2] * n_pixels), dtype=np.uint8)
+    o = out.reshape(*g.shape[:-1], n_pixels)
+    #uint8 arithmetic wraps, so the bits shifted past the top simply drop out
+    if fmt.bits == 10:
+        o[..., 0] = (g[..., 0] >> 2) | (g[..., 1] << 6)
+        o[..., 1] = (g[..., 1] >> 4) | (g[..., 2] << 4)
+        o[..., 2] = (g[..., 2] >> 6) | (g[..., 3] << 2)
+        o[..., 3] = g[..., 4]
+    else:
+        o[..., 0] = (g[..., 0] >> 4) | (g[..., 1] << 4)
+        o[..., 1] = g[..., 2]
+    return(out)
+
+def pack(pixels, fmt):
+    '''
+    Pack uint16 pixels the way the camera does, for the simulated camera and for checking unpack()
+    '''
+    if fmt.packing == 'none':
+        return(pixels.astype(np.uint8))
+    n_pixels, n_bytes = GROUPS[fmt.bits]
+    p = pixels.astype(np.uint16).reshape(*pixels.shape[:-1], pixels.shape[-1] // n_pixels, n_pixels)
+    out = np.empty((*p.shape[:-1], n_bytes), dtype=np.uint8)
+    if fmt.bits == 10:
+        out[..., 0] = p[..., 0]
+        out[..., 1] = (p[..., 0] >> 8) | (p[..., 1] << 2)
+        out[..., 2] = (p[..., 1] >> 6) | (p[..., 2] << 4)
+        out[..., 3] = (p[..., 2] >> 4) | (p[..., 3] << 6)
+        out[..., 4] = p[..., 3] >> 2
+    else:
+        out[..., 0] = p[..., 0]
+        out[..., 1] = (p[..., 0] >> 8) | (p[..., 1] << 4)
+        out[..., 2] = p[..., 1] >> 4
+    return(out.reshape(*pixels.shape[:-1], -1))
@@ -0,0 +1,184 @@
+import threading
+import time
+
+import cv2
+import numpy as np
+
+import ximea_pixels
+import ximea_utils
+
+def bin_bayer_rg(raw, out, tmp, step=1, flip=True):
+    '''
+    Debayer an RG Bayer frame by 2x2 binning straight into a reduced size BGR image.
+    Each 2x2 cell becomes one pixel from its two colour sites and the mean of its two
+    greens, with the same channel order cv2.COLOR_BayerRG2BGR (and so decode_ximea_frame)
+    gives. Much cheaper than a full resolution demosaic followed by a resize.
+    Params:
+        raw (np.array): (H, W) uint8 RG Bayer frame
+        out (np.array): (H//(2*step), W//(2*step), 3) uint8 output, written in place
+        tmp (np.array): uint16 scratch the shape of one output channel
+        step (int): additionally keep only every step-th Bayer cell
+        flip (bool): rotate 180 degrees to match decode_ximea_frame
+    Returns:
+        out (np.array)
+    '''
+    h, w = out.shape[:2]
+    s = 2 * step
+    #opencv's BayerRG names the pattern from the second row and column, so (0, 0) is blue
+    b = raw[0:h*s:s, 0:w*s:s]
+    g1 = raw[0:h*s:s, 1:w*s:s]
+    g2 = raw[1:h*s:s, 0:w*s:s]
+    r = raw[1:h*s:s, 1:w*s:s]
+    if flip:
+        r, g1, g2, b = (c[::-1, ::-1] for c in (r, g1, g2, b))
+    np.add(g1, g2, out=tmp, dtype=np.uint16)
+    np.right_shift(tmp, 1, out=tmp)
+    out[..., 0] = b
+    out[..., 1] = tmp
+    out[..., 2] = r
+    return(out)
+
+class PreviewWorker():
+    '''
+    Produces a reduced resolution BGR preview on a background thread so the GUI never
+    waits on the camera or a demosaic.
+
+    When not recording the worker grabs frames from the camera itself. While recording
+    (after use_ring()) it leaves the camera to the acquisition thread and samples the
+    newest frame in the frame ring instead. Preview images are written into two
+    preallocated buffers in turn; latest() returns the last finished one. 10 and 12 bit
+    packed frames (frame_format, see ximea_pixels) are previewed from their top 8 bits.
+    '''
+    def __init__(self, camera, image_handle, frame_ring, currently_recording, logger,
+                 max_fps=15, step=1, norm=True, frame_format=ximea_pixels.RAW8):
+        self.camera = camera
+        self.image_handle = image_handle
+        self.frame_ring = frame_ring
+        self.currently_recording = currently_recording
+        self.logger = logger
+        self.max_fps = max_fps
+        self.step = step
+        self.norm = norm
+        self.frame_format = frame_format
+
+        self.seq = 0
+        #grabs in a row that failed, a camera that keeps failing has probably been unplugged
+        self.errors = 0
+        self._buffers = None
+        self._ready = None
+        self._raw = None
+        self._raw8 = None
+        self._use_ring = False
+        self._camera_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _alloc(self, imshape):
+        s = 2 * self.step
+        shape = (imshape[0] // s, imshape[1] // s)
+        if self._buffers is None or self._buffers[0].shape[:2] != shape:
+            self._buffers = [np.zeros((*shape, 3), dtype=np.uint8) for _ in range(2)]
+            self._tmp = np.zeros(shape, dtype=np.uint16)
+            self._ready = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='ximea_preview', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def use_ring(self):
+        '''
+        Stop grabbing from the camera, returns once any grab in progress has finished
+        '''
+        with self._camera_lock:
+            self._use_ring = True
+
+    def use_camera(self, camera=None, image_handle=None):
+        '''
+        Go back to grabbing from the camera, optionally from a newly opened handle
+        '''
+        with self._camera_lock:
+            if camera is not None:
+                self.camera = camera
+                self.image_handle = image_handle
+            self.errors = 0
+            self._use_ring = False
+
+    def latest(self):
+        '''
+        Returns:
+            (seq, image): seq increases with every new preview image, image is None until the first one
+        '''
+        if self._ready is None:
+            return(self.seq, None)
+        return(self.seq, self._buffers[self._ready])
+
+    def _next_buffer(self, imshape):
+        self._alloc(imshape)
+        return(1 if self._ready == 0 else 0)
+
+    def _to_8bit(self, frame, fmt):
+        '''
+        frame itself if it is 8 bit, else the top 8 bits of its pixels in a reused buffer
+        '''
+        if fmt.packing == 'none':
+            return(frame)
+        imshape = ximea_pixels.pixel_shape(frame.shape, fmt)
+        if self._raw8 is None or self._raw8.shape != imshape:
+            self._raw8 = np.zeros(imshape, dtype=np.uint8)
+        return(ximea_pixels.unpack_msb8(frame, fmt, self._raw8))
+
+    def _from_ring(self):
+        ring = self.frame_ring
+        fmt = self.frame_format
+        latest = ring.peek_latest() if ring is not None else None
+        if latest is None:
+            return(None)
+        slot, seq = latest
+        raw = self._to_8bit(ring.frames[slot], fmt)
+        i = self._next_buffer(raw.shape)
+        bin_bayer_rg(raw, self._buffers[i], self._tmp, self.step)
+        #the producer may have reused the slot while we were reading it
+        if not ring.still_valid(slot, seq):
+            return(None)
+        return(i)
+
+    def _from_camera(self):
+        with self._camera_lock:
+            if self._use_ring or self.camera is None or self.currently_recording.is_set():
+                return(None)
+            fmt = self.frame_format
+            self.camera.get_image(self.image_handle)
+            shape = ximea_pixels.stored_shape((self.image_handle.height, self.image_handle.width), fmt)
+            if self._raw is None or self._raw.shape != shape:
+                self._raw = np.zeros(shape, dtype=np.uint8)
+            ximea_utils.copy_image_into(self.image_handle, self._raw, frame_format=fmt)
+        raw = self._to_8bit(self._raw, fmt)
+        i = self._next_buffer(raw.shape)
+        bin_bayer_rg(raw, self._buffers[i], self._tmp, self.step)
+        return(i)
+
+    def _run(self):
+        while not self._stop.is_set():
+            t = time.perf_counter()
+            try:
+                i = self._from_ring() if self._use_ring else self._from_camera()
+            except Exception as e:
+                if not self.errors:
+                    self.logger.info(f'Preview problem: {e}')
+                self.errors += 1
+                i = None
+            else:
+                self.errors = 0
+            if i is not None:
+                if self.norm:
+                    cv2.normalize(self._buffers[i], self._buffers[i], 0, 255, cv2.NORM_MINMAX)
+                self._ready = i
+                self.seq += 1
+            self._stop.wait(max(0.0, 1.0 / self.max_fps - (time.perf_counter() - t)))
@@ -0,0 +1,368 @@
+"""
+Camera acquisition in a dedicated child process.
+
+The acquisition thread (and by default the save thread too) normally runs inside the
+Pupil Capture world process and competes with it for the GIL. AcquisitionProcess
+starts a child process for the length of one recording instead. The child opens the
+camera itself and copies frames into a SharedFrameRing, which the save thread (in the
+child, or in the plugin with write_in_child=False) and the preview read without copying.
+
+The plugin and the child talk over a Pipe:
+    plugin -> child: ('stop',)
+    child -> plugin: ('log', level, message)
+                     ('state', 'recording' or 'saving', is_set)
+                     ('sync', sync_string)
+                     ('status', telemetry status, acquisition counters)
+                     ('finished', acquisition counters)
+"""
+
+import importlib
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+
+import ximea_clock
+import ximea_compress
+import ximea_pixels
+import ximea_roi
+import ximea_telemetry
+import ximea_utils
+
+#the plugin runs inside an OpenGL process, never fork it
+mp_context = multiprocessing.get_context('spawn')
+
+class PupilClock():
+    '''
+    Stands in for g_pool in the child process. Pupil time is the monotonic clock
+    (uvc.get_time_monotonic) minus Pupil's timebase, so the child only needs the offset.
+    '''
+    def __init__(self, offset):
+        self.offset = offset
+
+    def get_timestamp(self):
+        return(time.monotonic() + self.offset)
+
+def measure_clock_offset(g_pool):
+    '''
+    Offset between Pupil time and time.monotonic(), for a PupilClock
+    '''
+    t_0 = time.monotonic()
+    t_pupil = g_pool.get_timestamp()
+    t_1 = time.monotonic()
+    return(t_pupil - (t_0 + t_1) / 2)
+
+class _PipeSender():
+    '''
+    Connection.send from several threads at once, quietly giving up once the plugin is gone
+    '''
+    def __init__(self, conn):
+        self.conn = conn
+        self._lock = threading.Lock()
+
+    def send(self, message):
+        with self._lock:
+            try:
+                self.conn.send(message)
+            except (BrokenPipeError, EOFError, OSError):
+                pass
+
+class _PipeLogHandler(logging.Handler):
+    def __init__(self, sender):
+        super().__init__()
+        self.sender = sender
+
+    def emit(self, record):
+        self.sender.send(('log', record.levelno, self.format(record)))
+
+class _ReportedEvent(threading.Event):
+    '''
+    threading.Event that tells the plugin whenever it is set or cleared
+    '''
+    def __init__(self, name, sender):
+        super().__init__()
+        self.name = name
+        self.sender = sender
+
+    def set(self):
+        super().set()
+        self.sender.send(('state', self.name, True))
+
+    def clear(self):
+        super().clear()
+        self.sender.send(('state', self.name, False))
+
+class _ReportedQueue(queue.Queue):
+    '''
+    Sync string queue that also sends every sync string to the plugin
+    '''
+    def __init__(self, sender):
+        super().__init__()
+        self.sender = sender
+
+    def put(self, item, block=True, timeout=None):
+        super().put(item, block, timeout)
+        self.sender.send(('sync', item))
+
+def acquisition_counters(telemetry):
+    return({'frames_acquired': telemetry.frames_acquired,
+            'nframe_gaps': telemetry.nframe_gaps,
+            'frames_missing': telemetry.frames_missing,
+            'backpressure_level': telemetry.backpressure_level,
+            'backpressure_state': telemetry.backpressure_state,
+            'frames_decimated': telemetry.frames_decimated,
+            'frames_shed': telemetry.frames_shed})
+
+def _child_main(conn, cam_name, cam_id, settings_file, backend_name, frame_ring, save_dir, ims_per_file, write_mode,
+                write_in_child, compression, clock_offset, sync_interval, geometry=None, backpressure=None):
+    '''
+    Body of the child process: open the camera, record until told to stop, close the camera
+    '''
+    sender = _PipeSender(conn)
+    logger = logging.getLogger(f'ximea_process.{cam_name}')
+    logger.setLevel(logging.INFO)
+    logger.addHandler(_PipeLogHandler(sender))
+    logger.propagate = False
+
+    stop_collecting = threading.Event()
+    currently_recording = _ReportedEvent('recording', sender)
+    currently_saving = _ReportedEvent('saving', sender)
+    camera = None
+    telemetry = None
+    try:
+        backend = importlib.import_module(backend_name) if backend_name else None
+        camera, image_handle, camera_open = ximea_utils.init_camera(cam_id, settings_file, logger, backend)
+        if not camera_open:
+            frame_ring.close()
+            return
+        if geometry is not None:
+            ximea_roi.apply_hardware_roi(camera, geometry, acquiring=True)
+
+        telemetry = ximea_telemetry.PipelineTelemetry(cam_name, save_dir, frame_ring)
+        compressor = None
+        if write_in_child and compression[0] != 'none':
+            compressor = ximea_compress.FrameCompressor(*compression)
+        if write_in_child:
+            handles = ximea_utils.start_ximea_aquisition(camera, image_handle, frame_ring, save_dir, ims_per_file,
+                                                         stop_collecting, currently_recording, currently_saving,
+                                                         PupilClock(clock_offset), logger, write_mode,
+                                                         telemetry=telemetry, compressor=compressor,
+                                                         sync_queue=_ReportedQueue(sender), cam_name=cam_name,
+                                                         sync_interval=sync_interval, settings_file=settings_file,
+                                                         geometry=geometry, backpressure=backpressure)
+            threads = (handles.acq_thread, handles.save_thread)
+        else:
+            clock = ximea_clock.ClockSync(cam_name, camera, PupilClock(clock_offset), interval=sync_interval, logger=logger)
+            acq_thread = threading.Thread(target=ximea_utils.aquire_camera_worker,
+                                          args=(camera, image_handle, cam_name, _ReportedQueue(sender), frame_ring,
+                                                save_dir, stop_collecting, currently_recording,
+                                                PupilClock(clock_offset), logger),
+                                          kwargs={'telemetry': telemetry, 'clock': clock, 'geometry': geometry,
+                                                  'backpressure': backpressure,
+                                                  'frame_format': ximea_pixels.format_from_file(settings_file)})
+            acq_thread.start()
+            threads = (acq_thread,)
+
+        while any(t.is_alive() for t in threads):
+            if conn.poll(0.5):
+                try:
+                    message = conn.recv()
+                except EOFError:
+                    message = ('stop',) #the plugin is gone, finish the recording anyway
+                if message[0] == 'stop':
+                    stop_collecting.set()
+            status = telemetry.status()
+            if compressor is not None:
+                status['compression'] = compressor.status_text()
+            sender.send(('status', status, acquisition_counters(telemetry)))
+        for t in threads:
+            t.join()
+
+    except Exception as e:
+        logger.info(f'Acquisition process failed: {e}')
+        frame_ring.close()
+
+    finally:
+        if camera is not None:
+            try:
+                camera.stop_acquisition()
+                camera.close_device()
+            except Exception as e:
+                logger.info(f'Problem closing camera: {e}')
+        sender.send(('finished', None if telemetry is None else acquisition_counters(telemetry)))
+        conn.close()
+
+class AcquisitionProcess():
+    '''
+    Records one camera from a child process, for one recording.
+
+    start() hands the camera over to the child, so the caller must have closed its own
+    camera handle first; once done() the camera is free to be opened again. The child
+    only captures once it has opened and set up the camera, start_delay seconds after
+    start() (None until then). State and
+    log messages from the child are applied on a receiver thread: currently_recording
+    and currently_saving are set and cleared like the in-process threads would.
+    '''
+    def __init__(self, cam_id, settings_file, frame_ring, save_dir, ims_per_file, currently_recording,
+                 currently_saving, g_pool, logger, write_mode='direct', write_in_child=True,
+                 compression=('none', 1, 4), backend_name=None, cam_name='ximea', sync_interval=5.0, geometry=None,
+                 backpressure=None):
+        self.cam_id = cam_id
+        self.cam_name = cam_name
+        self.settings_file = settings_file
+        self.frame_ring = frame_ring
+        self.save_dir = save_dir
+        self.ims_per_file = ims_per_file
+        self.currently_recording = currently_recording
+        self.currently_saving = currently_saving
+        self.g_pool = g_pool
+        self.logger = logger
+        self.write_mode = write_mode
+        self.write_in_child = write_in_child
+        self.compression = compression
+        self.backend_name = backend_name
+        self.sync_interval = sync_interval
+        self.geometry = geometry
+        self.backpressure = backpressure
+
+        self.sync_strings = []
+        #monotonic time of start(), and seconds from then until the child began capturing
+        self.t_started = None
+        self.start_delay = None
+        #refitted here from the child's samples, for a save thread in this process
+        self.clock = ximea_clock.ClockSync(cam_name, logger=logger)
+        self.counters = None
+        self.telemetry = None
+        self.compressor = None
+        self._status = None
+        self._finished = threading.Event()
+        self._conn = None
+        self._process = None
+        self._receiver = None
+        self._save_thread = None
+        self._stop_collecting = threading.Event()
+
+    def start(self):
+        if not os.path.exists(self.save_dir):
+            os.makedirs(self.save_dir)
+        self.frame_ring.reset()
+        self.t_started = time.monotonic()
+        self._conn, child_conn = mp_context.Pipe()
+        self._process = mp_context.Process(target=_child_main, name=f'ximea_acquisition_{self.cam_name}', daemon=True,
+                                           args=(child_conn, self.cam_name, self.cam_id, self.settings_file, self.backend_name,
+                                                 self.frame_ring, self.save_dir, self.ims_per_file, self.write_mode,
+                                                 self.write_in_child, tuple(self.compression),
+                                                 measure_clock_offset(self.g_pool), self.sync_interval, self.geometry,
+                                                 self.backpressure))
+        self._process.start()
+        child_conn.close()
+        self._receiver = threading.Thread(target=self._receive, name='ximea_acquisition_events', daemon=True)
+        self._receiver.start()
+
+        if not self.write_in_child:
+            if self.compression[0] != 'none':
+                self.compressor = ximea_compress.FrameCompressor(*self.compression)
+            self.telemetry = ximea_telemetry.PipelineTelemetry(self.cam_name, self.save_dir, self.frame_ring)
+            self._save_thread = threading.Thread(target=ximea_utils.save_queue_worker,
+                                                 args=(self.cam_name, self.frame_ring, self.save_dir, self.ims_per_file,
+                                                       self._stop_collecting, self.currently_saving, self.logger,
+                                                       self.write_mode),
+                                                 kwargs={'telemetry': self.telemetry, 'compressor': self.compressor,
+                                                         'clock': self.clock, 'settings_file': self.settings_file,
+                                                         'geometry': self.geometry},
+                                                 daemon=True)
+            self._save_thread.start()
+
+    def _receive(self):
+        while True:
+            try:
+                message = self._conn.recv()
+            except (EOFError, OSError):
+                break
+            kind = message[0]
+            if kind == 'log':
+                self.logger.log(message[1], message[2])
+            elif kind == 'state':
+                event = self.currently_recording if message[1] == 'recording' else self.currently_saving
+                if message[2]:
+                    event.set()
+                else:
+                    event.clear()
+                if message[1] == 'recording' and message[2] and self.start_delay is None:
+                    #the child opens and sets up the camera first, frames before this weren't captured
+                    self.start_delay = time.monotonic() - self.t_started
+                    self.logger.info(f'Camera {self.cam_name} began capturing {self.start_delay:.1f} s '
+                                     f'after its recording started')
+            elif kind == 'sync':
+                self.sync_strings.append(message[1])
+                _, t_sync, t_cam, t_wall, bracket = ximea_clock.parse_sync_string(message[1])
+                self.clock.add_sample(t_sync, t_cam, t_wall, bracket, force=True)
+            elif kind == 'status':
+                self._status = message[1]
+                self._apply_counters(message[2])
+            elif kind == 'finished':
+                self._apply_counters(message[1])
+                break
+        #the child can die without telling us, never leave the flags or the writer hanging
+        self.currently_recording.clear()
+        if self.write_in_child:
+            self.currently_saving.clear()
+        self.frame_ring.close()
+        self._finished.set()
+
+    def _apply_counters(self, counters):
+        if counters is None:
+            return
+        self.counters = counters
+        if self.telemetry is not None:
+            self.telemetry.update_acquired(counters)
+
+    def stop(self):
+        '''
+        Ask the child to stop acquiring, it drains the ring and exits by itself
+        '''
+        if self._conn is not None and not self._finished.is_set():
+            if self.start_delay is None:
+                self.logger.info(f'Recording of camera {self.cam_name} stopped before its acquisition process began '
+                                 f'capturing, it saved no frames')
+            try:
+                self._conn.send(('stop',))
+            except (BrokenPipeError, OSError):
+                pass
+
+    def done(self):
+        '''
+        True once the child has exited and everything is on disk
+        '''
+        if not self._finished.is_set():
+            return(False)
+        if self._save_thread is not None and self._save_thread.is_alive():
+            return(False)
+        return(not self._process.is_alive())
+
+    def join(self, timeout=None):
+        self._finished.wait(timeout)
+        if self._save_thread is not None:
+            self._save_thread.join(timeout)
+        self._process.join(timeout)
+        if self._process.is_alive():
+            self.logger.info('Acquisition process did not exit, terminating it')
+            self._process.terminate()
+            self._process.join()
+
+    def status(self):
+        '''
+        Latest telemetry status strings, in the same form as PipelineTelemetry.status()
+        '''
+        if self.telemetry is not None:
+            return(self.telemetry.status())
+        if self._status is None:
+            return(dict.fromkeys(('rates', 'queue', 'dropped', 'backpressure', 'latency', 'disk'), 'starting'))
+        return(self._status)
+
+    def compression_status(self):
+        if self.compressor is not None:
+            return(self.compressor.status_text())
+        return(self.status().get('compression', 'off'))
@@ -0,0 +1,503 @@
+"""
+Live frames for other Pupil plugins and for local processes, straight from the frame ring.
+
+While a camera records, every frame its acquisition thread (or process) puts in the
+frame ring is published. Subscribers read from the ring slot itself, so nothing is
+copied or converted for a subscriber that isn't there, and they never hold up the
+camera or the writer: each gets the newest frame it can keep up with (latest frame
+wins) and simply misses the ones in between.
+
+In process, e.g. from another plugin (Ximea_Capture.subscribe() finds the camera):
+
+    sub = publisher.subscribe('debayered', step=2)
+    frame = sub.wait(timeout=0.1)        #published_frame(image, meta), None on timeout
+    frame.meta['nframe'], frame.meta['t_pupil']
+
+    kinds
+        raw        frames as recorded (packed bytes for 10 and 12 bit, see ximea_pixels),
+                   copied out of the ring slot, or with copy=False the slot itself: check
+                   still_valid() once done with it, the camera may have reused the slot
+        debayered  BGR from the top 8 bits, one pixel per 2x2 Bayer cell and every
+                   step-th cell (see ximea_preview.bin_bayer_rg)
+    decimation keeps one frame in that many, by camera frame counter.
+
+Other processes on the same machine: share() copies a subscription's frames into a
+shared memory block of a few slots under a name, and sends every process that asked
+for them a short UDP datagram on 127.0.0.1 per frame:
+
+    sub = ximea_publish.SharedSubscriber('ximea_cam_od')
+    frame = sub.wait(timeout=0.1)
+
+Each frame's meta is a PUBLISHED_META_DTYPE record: seq counts the frames published
+for the camera, with the camera frame counter, camera time, host time and Pupil time.
+"""
+
+import socket
+import struct
+import threading
+import time
+from collections import namedtuple
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import ximea_pixels
+import ximea_preview
+
+KINDS = ('raw', 'debayered')
+
+PUBLISHED_META_DTYPE = np.dtype([
+    ('seq', '<u8'),       #published frame number, from 1
+    ('nframe', '<i8'),    #camera frame counter
+    ('tsSec', '<i8'),     #camera time
+    ('tsUSec', '<i8'),
+    ('t_host', '<f8'),    #time.time() the frame was in the ring
+    ('t_pupil', '<f8'),   #Pupil time, NaN before the first clock sync sample
+])
+
+#image (np.array) and meta (PUBLISHED_META_DTYPE record) of a published frame
+published_frame = namedtuple('published_frame', 'image meta')
+
+SHARED_MAGIC = b'XIMPUB'
+SHARED_HEADER_DTYPE = np.dtype([
+    ('magic', 'S8'),
+    ('port', '<u4'),          #UDP port on 127.0.0.1 that takes subscriptions
+    ('n_slots', '<u4'),
+    ('slot_nbytes', '<u8'),
+    ('data_at', '<u8'),       #offset of the first slot's frame
+])
+SHARED_SLOT_DTYPE = np.dtype([
+    ('meta', PUBLISHED_META_DTYPE),   #meta['seq'] is 0 while the slot is being written
+    ('ndim', '<u4'),
+    ('shape', '<u4', (3,)),
+    ('dtype', 'S4'),
+])
+#datagrams: a subscriber's hello (repeated every KEEPALIVE_S) and goodbye, and the publisher's (seq, slot)
+HELLO = b'XSUB'
+BYE = b'XBYE'
+NOTICE = struct.Struct('<QI')
+KEEPALIVE_S = 2.0
+#a subscriber not heard from for this long is dropped
+CLIENT_TIMEOUT_S = 10.0
+
+def max_nbytes(kind, sensor_shape, step=1):
+    '''
+    Largest frame of a kind a camera with this sensor can publish, at up to 12 bits packed
+    '''
+    height, width = sensor_shape
+    if kind == 'raw':
+        return(height * width * max(ximea_pixels.PACKED_BITS) // 8)
+    return((height // (2 * step)) * (width // (2 * step)) * 3)
+
+class FramePublisher():
+    '''
+    Publishes one camera's frames. attach() points it at the frame ring of a recording,
+    with the ClockSync that gives Pupil times; a thread of its own picks new frames up
+    when wake() is called from the acquisition thread or, for a ring filled by another
+    process, every poll_s seconds. It only runs while there are subscribers.
+    '''
+    def __init__(self, cam_name, logger, poll_s=0.001):
+        self.cam_name = cam_name
+        self.logger = logger
+        self.poll_s = poll_s
+        self.frame_format = ximea_pixels.RAW8
+        self.published = 0
+        self.subscriptions = []
+        self.shares = []
+        self._ring = None
+        self._clock = None
+        #(ring, slot, ring seq, meta) of the newest frame
+        self._latest = None
+        self._lock = threading.Lock()
+        self._new_frame = threading.Condition(self._lock)
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def attach(self, frame_ring, clock=None, frame_format=ximea_pixels.RAW8):
+        with self._lock:
+            self._ring = frame_ring
+            self._clock = clock
+            self.frame_format = frame_format
+            self._latest = None
+        self._wake.set()
+
+    def detach(self):
+        '''
+        Stop publishing from the ring, before it is freed
+        '''
+        with self._lock:
+            self._ring = None
+            self._latest = None
+
+    def wake(self):
+        '''
+        Called by the acquisition thread after every frame it commits
+        '''
+        if self.subscriptions:
+            self._wake.set()
+
+    def subscribe(self, kind='raw', decimation=1, step=1, copy=True):
+        '''
+        Returns:
+            subscription (Subscription): call close() on it when done
+        '''
+        sub = Subscription(self, kind, decimation, step, copy)
+        with self._lock:
+            self.subscriptions.append(sub)
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name=f'ximea_publish_{self.cam_name}', daemon=True)
+            self._thread.start()
+        self._wake.set()
+        return(sub)
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            if sub in self.subscriptions:
+                self.subscriptions.remove(sub)
+            sub.closed = True
+            self._new_frame.notify_all()
+
+    def share(self, name, kind='debayered', decimation=1, step=1, n_slots=4, sensor_shape=(1544, 2064)):
+        '''
+        Publish a subscription's frames to other processes under name, see SharedPublication.
+        A block already shared under name is closed first.
+        '''
+        self.unshare(name)
+        publication = SharedPublication(self, name, kind, decimation, step, n_slots, sensor_shape)
+        self.shares.append(publication)
+        self.logger.info(f'Sharing {self.cam_name} {kind} frames as {name} on port {publication.port}')
+        return(publication)
+
+    def unshare(self, name):
+        '''
+        Stop sharing frames under name and free its block
+        '''
+        for publication in [p for p in self.shares if p.name == name]:
+            publication.close()
+            self.shares.remove(publication)
+
+    def status_text(self):
+        return(f'{self.published} published, {len(self.subscriptions)} subscribers ({len(self.shares)} shared)')
+
+    def close(self):
+        for publication in self.shares:
+            publication.close()
+        self.shares = []
+        for sub in list(self.subscriptions):
+            self.unsubscribe(sub)
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        last = None
+        while not self._stop.is_set():
+            self._wake.wait(self.poll_s if self.subscriptions else None)
+            self._wake.clear()
+            ring, clock = self._ring, self._clock
+            latest = ring.peek_latest() if ring is not None else None
+            if latest is None or (ring, *latest) == last:
+                continue
+            slot, seq = latest
+            ring_meta = ring.meta[slot].copy()
+            if not ring.still_valid(slot, seq):
+                continue
+            last = (ring, slot, seq)
+            meta = np.zeros((), dtype=PUBLISHED_META_DTYPE)
+            for name in ('nframe', 'tsSec', 'tsUSec', 't_host'):
+                meta[name] = ring_meta[name]
+            meta['t_pupil'] = np.nan if clock is None else clock.to_pupil(ring_meta['tsSec'] + ring_meta['tsUSec'] * 1e-6)
+            with self._lock:
+                if self._ring is not ring:
+                    continue
+                self.published += 1
+                meta['seq'] = self.published
+                self._latest = (ring, slot, seq, meta)
+                self._new_frame.notify_all()
+
+class Subscription():
+    '''
+    One subscriber's view of a FramePublisher, made by FramePublisher.subscribe().
+    wait() returns the newest frame the subscriber hasn't had yet, converted to its
+    kind in the subscriber's own thread. The image is a buffer of the subscription's
+    that the next wait() overwrites (or, for raw with copy=False, the ring slot).
+    '''
+    def __init__(self, publisher, kind='raw', decimation=1, step=1, copy=True):
+        if kind not in KINDS:
+            raise ValueError(f'Unknown kind of published frame {kind}, use one of {KINDS}')
+        self.publisher = publisher
+        self.kind = kind
+        self.decimation = max(1, int(decimation))
+        self.step = max(1, int(step))
+        self.copy = copy
+        self.closed = False
+        self.delivered = 0
+        self._seen = 0
+        self._slot = None
+        self._image = None
+        self._raw8 = None
+        self._tmp = None
+
+    def _wanted(self, latest):
+        return(latest is not None and latest[3]['seq'] > self._seen and latest[3]['nframe'] % self.decimation == 0)
+
+    def wait(self, timeout=None):
+        '''
+        Returns:
+            frame (published_frame): None if timeout seconds passed without a new frame, or the subscription was closed
+        '''
+        pub = self.publisher
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with pub._new_frame:
+                remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+                if not pub._new_frame.wait_for(lambda: self.closed or self._wanted(pub._latest), remaining):
+                    return(None)
+                if self.closed:
+                    return(None)
+                ring, slot, seq, meta = pub._latest
+                fmt = pub.frame_format
+            self._seen = int(meta['seq'])
+            image = self._convert(ring.frames[slot], fmt)
+            #the camera may have reused the slot while it was read, then wait for the next frame
+            if ring.still_valid(slot, seq):
+                break
+        self._slot = (ring, slot, seq)
+        self.delivered += 1
+        return(published_frame(image, meta.copy()))
+
+    def still_valid(self):
+        '''
+        True if the ring slot of the last frame, for copy=False, still holds it
+        '''
+        if self._slot is None:
+            return(False)
+        ring, slot, seq = self._slot
+        return(ring.still_valid(slot, seq))
+
+    def _convert(self, frame, fmt):
+        if self.kind == 'raw':
+            if not self.copy:
+                return(frame)
+            if self._image is None or self._image.shape != frame.shape:
+                self._image = np.empty_like(frame)
+            np.copyto(self._image, frame)
+            return(self._image)
+        if fmt.packing != 'none':
+            shape = ximea_pixels.pixel_shape(frame.shape, fmt)
+            if self._raw8 is None or self._raw8.shape != shape:
+                self._raw8 = np.empty(shape, dtype=np.uint8)
+            frame = ximea_pixels.unpack_msb8(frame, fmt, self._raw8)
+        s = 2 * self.step
+        shape = (frame.shape[0] // s, frame.shape[1] // s)
+        if self._image is None or self._image.shape[:2] != shape:
+            self._image = np.empty((*shape, 3), dtype=np.uint8)
+            self._tmp = np.empty(shape, dtype=np.uint16)
+        return(ximea_preview.bin_bayer_rg(frame, self._image, self._tmp, self.step))
+
+    def close(self):
+        self.publisher.unsubscribe(self)
+
+def _untrack(shm):
+    '''
+    Keep this process's resource tracker from unlinking a block it only attached to when it exits
+    '''
+    try:
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    except Exception:
+        pass
+
+class SharedPublication():
+    '''
+    A subscription's frames in a named shared memory block, for SharedSubscriber in other
+    local processes. The block holds a SHARED_HEADER_DTYPE header, n_slots
+    SHARED_SLOT_DTYPE records and n_slots frames of up to max_nbytes() bytes, written in
+    turn. After each frame every subscriber gets a NOTICE datagram with its seq and slot,
+    sent without blocking: a subscriber that doesn't read them loses them, and a slot it
+    is slow to read is overwritten n_slots frames later, which it notices from the
+    slot's seq.
+    '''
+    def __init__(self, publisher, name, kind='debayered', decimation=1, step=1, n_slots=4, sensor_shape=(1544, 2064)):
+        self.name = name
+        self.logger = publisher.logger
+        self.n_slots = int(n_slots)
+        self.slot_nbytes = max_nbytes(kind, sensor_shape, step)
+        self.written = 0
+        self.too_big = 0
+        self.clients = {}
+        slots_at = SHARED_HEADER_DTYPE.itemsize
+        data_at = -(-(slots_at + self.n_slots * SHARED_SLOT_DTYPE.itemsize) // 4096) * 4096
+        self._shm = shared_memory.SharedMemory(name=name, create=True, size=data_at + self.n_slots * self.slot_nbytes)
+        buf = self._shm.buf
+        self.header = np.ndarray((), dtype=SHARED_HEADER_DTYPE, buffer=buf)
+        self.slots = np.ndarray(self.n_slots, dtype=SHARED_SLOT_DTYPE, buffer=buf, offset=slots_at)
+        self.data = np.ndarray((self.n_slots, self.slot_nbytes), dtype=np.uint8, buffer=buf, offset=data_at)
+        self.slots[:] = np.zeros(1, dtype=SHARED_SLOT_DTYPE)
+
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.bind(('127.0.0.1', 0))
+        self._sock.setblocking(False)
+        self.port = self._sock.getsockname()[1]
+        self.header['port'] = self.port
+        self.header['n_slots'] = self.n_slots
+        self.header['slot_nbytes'] = self.slot_nbytes
+        self.header['data_at'] = data_at
+        self.header['magic'] = SHARED_MAGIC
+
+        self.subscription = publisher.subscribe(kind, decimation, step)
+        self._thread = threading.Thread(target=self._run, name=f'ximea_share_{name}', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self.subscription.closed:
+            self._take_requests()
+            frame = self.subscription.wait(timeout=0.2)
+            if frame is not None:
+                self._write(frame)
+
+    def _take_requests(self):
+        now = time.monotonic()
+        while True:
+            try:
+                msg, addr = self._sock.recvfrom(64)
+            except (BlockingIOError, ConnectionResetError):
+                break
+            except OSError:
+                return
+            if msg == HELLO:
+                self.clients[addr] = now
+            elif msg == BYE:
+                self.clients.pop(addr, None)
+        for addr, t in list(self.clients.items()):
+            if now - t > CLIENT_TIMEOUT_S:
+                del self.clients[addr]
+
+    def _write(self, frame):
+        image = frame.image
+        if image.nbytes > self.slot_nbytes:
+            if not self.too_big:
+                self.logger.info(f'{image.shape} frames are too big to share as {self.name}, '
+                                 f'which has room for {self.slot_nbytes} bytes')
+            self.too_big += 1
+            return
+        k = self.written % self.n_slots
+        slot = self.slots[k]
+        slot['meta']['seq'] = 0
+        self.data[k, :image.nbytes] = np.ascontiguousarray(image).reshape(-1).view(np.uint8)
+        slot['ndim'] = image.ndim
+        slot['shape'][:] = 0
+        slot['shape'][:image.ndim] = image.shape
+        slot['dtype'] = image.dtype.str.encode()
+        slot['meta'] = frame.meta
+        self.written += 1
+        notice = NOTICE.pack(int(frame.meta['seq']), k)
+        for addr in list(self.clients):
+            try:
+                self._sock.sendto(notice, addr)
+            except OSError:
+                pass #full socket buffer or a subscriber that went away, it loses this frame
+
+    def close(self):
+        self.subscription.close()
+        self._thread.join()
+        self._sock.close()
+        self.header = self.slots = self.data = None
+        try:
+            self._shm.close()
+        except BufferError:
+            pass
+        self._shm.unlink()
+
+class SharedSubscriber():
+    '''
+    Reads a SharedPublication from another process by its name. wait() returns the
+    newest frame announced since the last call, copied out of the shared block.
+    '''
+    def __init__(self, name):
+        self.name = name
+        self._shm = shared_memory.SharedMemory(name=name)
+        _untrack(self._shm)
+        buf = self._shm.buf
+        self.header = np.ndarray((), dtype=SHARED_HEADER_DTYPE, buffer=buf)
+        if self.header['magic'] != SHARED_MAGIC:
+            raise ValueError(f'{name} is not a shared Ximea frame publication')
+        n_slots, slot_nbytes = int(self.header['n_slots']), int(self.header['slot_nbytes'])
+        self.slots = np.ndarray(n_slots, dtype=SHARED_SLOT_DTYPE, buffer=buf, offset=SHARED_HEADER_DTYPE.itemsize)
+        self.data = np.ndarray((n_slots, slot_nbytes), dtype=np.uint8, buffer=buf, offset=int(self.header['data_at']))
+        self.received = 0
+        self.missed = 0
+        self._publisher = ('127.0.0.1', int(self.header['port']))
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.bind(('127.0.0.1', 0))
+        self._t_hello = 0.0
+        self._hello()
+
+    def _hello(self):
+        self._sock.sendto(HELLO, self._publisher)
+        self._t_hello = time.monotonic()
+
+    def _newest_notice(self, timeout):
+        '''
+        Wait up to timeout seconds for a notice, then take any others already queued and keep the last
+        '''
+        self._sock.settimeout(timeout)
+        try:
+            msg = self._sock.recv(64)
+        except (socket.timeout, ConnectionResetError):
+            return(None)
+        self._sock.setblocking(False)
+        while True:
+            try:
+                msg = self._sock.recv(64)
+            except (BlockingIOError, ConnectionResetError):
+                break
+            self.missed += 1
+        return(NOTICE.unpack(msg))
+
+    def wait(self, timeout=None):
+        '''
+        Returns:
+            frame (published_frame): None if no frame arrived within timeout seconds
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if time.monotonic() - self._t_hello > KEEPALIVE_S:
+                self._hello()
+            wait_s = KEEPALIVE_S if deadline is None else min(KEEPALIVE_S, max(0.0, deadline - time.monotonic()))
+            notice = self._newest_notice(wait_s)
+            if notice is not None:
+                frame = self._read(*notice)
+                if frame is not None:
+                    self.received += 1
+                    return(frame)
+                self.missed += 1
+            elif deadline is not None and time.monotonic() >= deadline:
+                return(None)
+
+    def _read(self, seq, k):
+        slot = self.slots[k]
+        if slot['meta']['seq'] != seq:
+            return(None)
+        ndim = int(slot['ndim'])
+        shape = tuple(int(n) for n in slot['shape'][:ndim])
+        dtype = np.dtype(slot['dtype'].decode())
+        image = self.data[k, :int(np.prod(shape)) * dtype.itemsize].view(dtype).reshape(shape).copy()
+        meta = slot['meta'].copy()
+        #overwritten while it was copied
+        if slot['meta']['seq'] != seq:
+            return(None)
+        return(published_frame(image, meta))
+
+    def close(self):
+        try:
+            self._sock.sendto(BYE, self._publisher)
+        except OSError:
+            pass
+        self._sock.close()
+        self.header = self.slots = self.data = None
+        self._shm.close()
@@ -0,0 +1,448 @@
+"""
+Random access to recorded Ximea sessions without loading them into memory.
+
+    rec = XimeaRecording('/path/to/recording/ximea')
+    rec.imshape                        #(H, W), from the chunk headers
+    rec.geometry                       #ROI and decimation the frames were recorded with
+    rec.frame_format                   #bit depth and packing, see ximea_pixels
+    rec[1000]                          #(H, W) uint8 view straight into the chunk file, uint16 pixels
+                                       #unpacked from it for 10 and 12 bit recordings
+    rec[1000:1200]                     #(200, H, W), a view if it doesn't cross a chunk boundary
+    rec.msb8(1000)                     #the top 8 bits of a 10 or 12 bit frame, as uint8
+    i = rec.frame_at_pupil_time(12.5)  #index of the frame closest to a Pupil timestamp
+    bgr = rec.get(slice(i, i + 10), demosaic=True)
+
+With several cameras, frame_index.tsv lines their frames up in Pupil time:
+
+    python ximea_reader.py /path/to/recording/ximea cam_od cam_os cam_cy
+"""
+
+import glob
+import logging
+import os
+import re
+import sys
+import warnings
+
+import cv2
+import numpy as np
+
+import ximea_chunk
+import ximea_compress
+import ximea_metadata
+import ximea_pixels
+import ximea_roi
+
+logger = logging.getLogger(__name__)
+
+def list_chunks(frames_dir):
+    '''
+    Find the frame chunks of a recording and put them in frame order
+    Params:
+        frames_dir (str): folder holding frames_{start}_{end}.bin or frame_{i}.bin files
+                          (or the same with a compression codec's extension)
+    Returns:
+        chunks (list of tuple): (first frame index, file path) sorted by first frame
+    '''
+    chunks = []
+    for path in glob.glob(os.path.join(frames_dir, 'frame*.*')):
+        m = re.match(r'frames?_(\d+)(_\d+)?\.\w+$', os.path.basename(path))
+        if m:
+            chunks.append((int(m.group(1)), path))
+    return(sorted(chunks))
+
+def chunk_files_of(frames_dir):
+    '''
+    Paths of the self-describing chunks of a recording (see ximea_chunk), in frame order,
+    empty for recordings made before chunks had headers
+    '''
+    paths = [path for _, path in list_chunks(frames_dir) if os.path.getsize(path) > 0]
+    if not paths or not ximea_chunk.is_chunk_file(paths[0]):
+        return([])
+    return([path for path in paths if os.path.getsize(path) >= ximea_chunk.HEADER_SIZE])
+
+def demosaic_frames(raw, flip=True, norm=False, out=None):
+    '''
+    Bayer demosaic a batch of raw frames the same way decode_ximea_frame does
+    Params:
+        raw (np.array): (n, H, W) uint8 or uint16 RG Bayer frames
+        flip (bool): rotate 180 degrees, as the camera is mounted upside down
+        norm (bool): stretch each frame to the whole range of its dtype, 0-255 for uint8
+        out (np.array): optional preallocated (n, H, W, 3) output
+    Returns:
+        bgr (np.array): (n, H, W, 3) BGR frames, the dtype of raw
+    '''
+    if out is None:
+        out = np.empty((*raw.shape, 3), dtype=raw.dtype)
+    top = np.iinfo(out.dtype).max
+    for i, im in enumerate(raw):
+        cv2.cvtColor(np.ascontiguousarray(im), cv2.COLOR_BayerRG2BGR, dst=out[i])
+        if flip:
+            cv2.flip(out[i], -1, dst=out[i])
+        if norm:
+            cv2.normalize(out[i], out[i], 0, top, cv2.NORM_MINMAX)
+    return(out)
+
+def fit_clock_sync(sync_file_name):
+    '''
+    Fit Pupil time as a linear function of camera time from the camsync samples
+    Params:
+        sync_file_name (str): timestamp_camsync_{cam}.tsv
+    Returns:
+        offset, drift (float): pupil_time = offset + drift * cam_time
+    '''
+    t_sync, t_cam = [], []
+    with open(sync_file_name, 'r') as f:
+        next(f)
+        for line in f:
+            fields = line.split('\t')
+            if len(fields) >= 3:
+                t_sync.append(float(fields[1]))
+                t_cam.append(float(fields[2]))
+    t_sync, t_cam = np.array(t_sync), np.array(t_cam)
+    if len(t_cam) >= 2 and np.ptp(t_cam) > 0:
+        drift, offset = np.polyfit(t_cam, t_sync, 1)
+    elif len(t_cam):
+        drift, offset = 1.0, float(np.mean(t_sync - t_cam))
+    else:
+        raise ValueError(f'No clock sync samples in {sync_file_name}')
+    return(float(offset), float(drift))
+
+def load_frame_times(rec_dir, cam_name):
+    '''
+    Camera frame counters and timestamps of every saved frame
+    Returns:
+        records (np.array): frame_record_dtype records, None for recordings that only have the tsv
+        nframe (np.array): camera frame counter of each frame
+        cam_times (np.array): camera time of each frame in seconds
+    '''
+    #the records are in the chunk indexes, older recordings have a binary log or only the tsv
+    meta_file = ximea_metadata.meta_file_name(rec_dir, cam_name)
+    ts_file_name = os.path.join(rec_dir, f'timestamps_{cam_name}.tsv')
+    chunk_files = chunk_files_of(os.path.join(rec_dir, cam_name))
+    if chunk_files:
+        records = ximea_chunk.load_records(chunk_files)
+        return(records, records['nframe'], ximea_metadata.cam_times(records))
+    if os.path.exists(meta_file):
+        records = ximea_metadata.load_metadata(meta_file)
+        return(records, records['nframe'], ximea_metadata.cam_times(records))
+    if os.path.exists(ts_file_name):
+        with warnings.catch_warnings():
+            #a recording that saved no frames has nothing but the header
+            warnings.simplefilter('ignore', UserWarning)
+            ts = np.loadtxt(ts_file_name, skiprows=1, ndmin=2)
+        if not len(ts):
+            return(None, np.zeros(0), np.zeros(0))
+        return(None, ts[:, 1], ts[:, 2])
+    return(None, np.zeros(0), np.zeros(0))
+
+def pupil_times_from(records, cam_times, sync_file_name):
+    '''
+    Pupil timestamps of frames: the ones stored as each frame was written where there are
+    any, otherwise a fit to every sample in the camsync file
+    '''
+    n = len(cam_times)
+    t_pupil = records['t_pupil'][:n] if records is not None else np.full(n, np.nan)
+    missing = np.isnan(t_pupil)
+    if missing.any():
+        offset, drift = fit_clock_sync(sync_file_name)
+        t_pupil = np.where(missing, offset + drift * cam_times, t_pupil)
+    return(t_pupil)
+
+def frame_pupil_times(rec_dir, cam_name):
+    '''
+    Pupil timestamp of every saved frame of one camera, without opening its chunks
+    '''
+    records, _, cam_times = load_frame_times(rec_dir, cam_name)
+    return(pupil_times_from(records, cam_times, os.path.join(rec_dir, f'timestamp_camsync_{cam_name}.tsv')))
+
+def match_frames(pupil_times, tolerance=None):
+    '''
+    Line up the frames of several cameras in Pupil time. Every frame of the first
+    camera gets a row, with the index of the closest frame of each other camera.
+    Params:
+        pupil_times (list of np.array): Pupil timestamps of each camera's frames, first is the reference
+        tolerance (float): most seconds apart two frames can be and still match, half the
+                           reference camera's median frame interval by default
+    Returns:
+        matches (np.array): (n reference frames, n cameras) int64 frame indices, -1 where nothing matched
+    '''
+    reference = pupil_times[0]
+    if tolerance is None:
+        tolerance = np.median(np.diff(reference)) / 2 if len(reference) > 1 else np.inf
+    matches = np.full((len(reference), len(pupil_times)), -1, dtype=np.int64)
+    matches[:, 0] = np.arange(len(reference))
+    for c, times in enumerate(pupil_times[1:], 1):
+        if len(times) == 0:
+            continue
+        #nearest neighbour of every reference frame, the frame before or the frame after it
+        i = np.searchsorted(times, reference)
+        lo = np.clip(i - 1, 0, len(times) - 1)
+        hi = np.clip(i, 0, len(times) - 1)
+        nearest = np.where(np.abs(reference - times[lo]) <= np.abs(times[hi] - reference), lo, hi)
+        ok = np.abs(times[nearest] - reference) <= tolerance
+        matches[ok, c] = nearest[ok]
+    return(matches)
+
+def write_frame_index(rec_dir, cam_names, tolerance=None):
+    '''
+    Write frame_index.tsv, the cross camera frame index of a recording: one row per frame
+    of the first camera with its Pupil time and the matching frame of every camera
+    Params:
+        rec_dir (str): folder holding every camera's timestamps and camsync files
+        cam_names (list of str): cameras to match, the first one is the reference
+    Returns:
+        index_file_name (str)
+    '''
+    pupil_times = [frame_pupil_times(rec_dir, cam_name) for cam_name in cam_names]
+    matches = match_frames(pupil_times, tolerance)
+    index_file_name = os.path.join(rec_dir, 'frame_index.tsv')
+    with open(index_file_name, 'w') as f:
+        f.write('\t'.join(['pupil_time'] + list(cam_names)) + '\n')
+        np.savetxt(f, np.column_stack([pupil_times[0], matches]), delimiter='\t',
+                   fmt=['%.6f'] + ['%d'] * len(cam_names))
+    return(index_file_name)
+
+def load_frame_index(index_file_name):
+    '''
+    Read frame_index.tsv
+    Returns:
+        pupil_times (np.array): Pupil time of each row
+        matches (dict): camera name -> frame index of each row, -1 where that camera has no frame
+    '''
+    with open(index_file_name, 'r') as f:
+        cam_names = f.readline().rstrip('\n').split('\t')[1:]
+    table = np.loadtxt(index_file_name, skiprows=1, ndmin=2).reshape(-1, len(cam_names) + 1)
+    return(table[:, 0], {name: table[:, c + 1].astype(np.int64) for c, name in enumerate(cam_names)})
+
+class XimeaRecording():
+    '''
+    A recorded session: the frame chunks in {rec_dir}/{cam_name}/ plus
+    timestamp_camsync_{cam_name}.tsv in rec_dir.
+
+    Chunks describe themselves (see ximea_chunk): the frame size, codec and every
+    frame's record are read from them, and a chunk left without an index by a recording
+    that was cut short is recovered by scanning it. Every chunk is memory mapped, so
+    frames are only read from disk when touched. Indexing with an int gives a view into
+    the chunk file, indexing with a slice gives a view when the slice stays within one
+    chunk and a copy otherwise. Compressed frames are decompressed when accessed.
+
+    10 and 12 bit recordings stay packed on disk (frame_format, see ximea_pixels).
+    Indexing them gives uint16 pixels, unpacked a block of rows at a time from the memory
+    map; raw() gives the stored bytes as views like 8 bit frames, and msb8() the top 8
+    bits of every pixel for viewing and 8 bit exports.
+
+    Recordings made before chunks had headers are read too, with their frame size from
+    imshape and their records from timestamps_{cam_name}.bin or .tsv.
+
+    geometry (ximea_roi.roi_geometry) says which part of the sensor the frames cover
+    and how many camera frames there are per recorded frame; to_sensor() maps frame
+    pixels back to sensor pixels.
+    '''
+    def __init__(self, rec_dir, cam_name='ximea', imshape=None):
+        self.rec_dir = rec_dir
+        self.cam_name = cam_name
+        self.chunk_arrays = []
+        self.chunk_starts = []
+
+        frames_dir = os.path.join(rec_dir, cam_name)
+        chunk_files = chunk_files_of(frames_dir)
+        if chunk_files:
+            self._open_chunk_files(chunk_files)
+        else:
+            self._open_headerless(frames_dir, (1544, 2064) if imshape is None else imshape)
+        self.chunk_starts = np.array(self.chunk_starts, dtype=np.int64)
+
+        self._sync = None
+        self._pupil_times = None
+        self.sync_file_name = os.path.join(rec_dir, f'timestamp_camsync_{cam_name}.tsv')
+
+    def _open_chunk_files(self, paths):
+        self.chunk_files = [ximea_chunk.ChunkFile(path) for path in paths]
+        first = self.chunk_files[0]
+        self.imshape = first.imshape
+        self.geometry = first.geometry
+        self.frame_format = first.frame_format
+        self.stored_shape = first.stored_shape
+        self.frame_nbytes = first.frame_nbytes
+        self.codec = first.codec
+        self._decompress = None if self.codec == 'none' else ximea_compress.get_codec(self.codec)[1]
+        n = 0
+        for chunk in self.chunk_files:
+            if chunk.imshape != self.imshape or chunk.codec != self.codec or chunk.frame_format != self.frame_format:
+                raise ValueError(f'{chunk.path} holds {chunk.imshape} {chunk.frame_format} {chunk.codec} frames, '
+                                 f'{paths[0]} holds {self.imshape} {self.frame_format} {self.codec}')
+            if chunk.recovered:
+                logger.warning(f'{chunk.path} was not closed, recovered {len(chunk)} frames')
+            if not len(chunk):
+                continue
+            if chunk.codec == 'none' and chunk.frames is None:
+                raise ValueError(f'{chunk.path} has uncompressed frames of uneven size')
+            #compressed frames are read through the records, uncompressed ones through a view
+            self.chunk_arrays.append(chunk.buffer if chunk.frames is None else chunk.frames)
+            self.chunk_starts.append(n)
+            n += len(chunk)
+        self.records = np.concatenate([chunk.records for chunk in self.chunk_files])
+        self.n_frames = n
+        self.nframe = self.records['nframe'].astype(np.int64)
+        self.cam_times = ximea_metadata.cam_times(self.records)
+
+    def _open_headerless(self, frames_dir, imshape):
+        self.chunk_files = []
+        self.imshape = tuple(imshape)
+        self.geometry = ximea_roi.make_geometry('full', self.imshape)
+        self.frame_format = ximea_pixels.RAW8
+        self.stored_shape = self.imshape
+        self.frame_nbytes = int(np.prod(self.imshape))
+
+        self.records, nframe, cam_times = load_frame_times(self.rec_dir, self.cam_name)
+
+        chunks = list_chunks(frames_dir)
+        extensions = {os.path.splitext(path)[1][1:] for _, path in chunks}
+        if len(extensions) > 1:
+            raise ValueError(f'Mixed chunk types {extensions} in {self.rec_dir}')
+        self.codec = {ext: codec for codec, ext in ximea_compress.CHUNK_EXTENSIONS.items()}.get(extensions.pop() if extensions else 'bin')
+        if self.codec != 'none' and self.records is None:
+            raise ValueError(f'Compressed recording {self.rec_dir} has no metadata log to index it')
+        self._decompress = None if self.codec == 'none' else ximea_compress.get_codec(self.codec)[1]
+
+        n = 0
+        for start, path in chunks:
+            if self.codec == 'none':
+                #use the real file length, the last chunk of a recording is usually short
+                count = os.path.getsize(path) // self.frame_nbytes
+                if count == 0:
+                    continue
+                self.chunk_arrays.append(np.memmap(path, dtype=np.uint8, mode='r', shape=(count, *self.imshape)))
+            else:
+                count = int(np.count_nonzero(self.records['chunk'] == start))
+                if count == 0 or os.path.getsize(path) == 0:
+                    continue
+                self.chunk_arrays.append(np.memmap(path, dtype=np.uint8, mode='r'))
+            self.chunk_starts.append(n)
+            n += count
+
+        self.n_frames = min(n, len(nframe)) if len(nframe) else n
+        self.nframe = nframe[:self.n_frames].astype(np.int64)
+        self.cam_times = cam_times[:self.n_frames]
+
+    def __len__(self):
+        return(self.n_frames)
+
+    def to_sensor(self, x, y):
+        '''
+        Sensor pixel of pixel (x, y) of a raw (unflipped) recorded frame
+        '''
+        return(x + self.geometry.x, y + self.geometry.y)
+
+    @property
+    def shape(self):
+        return((self.n_frames, *self.imshape))
+
+    @property
+    def dtype(self):
+        return(np.dtype(np.uint8 if self.frame_format.packing == 'none' else np.uint16))
+
+    def _locate(self, i):
+        c = int(np.searchsorted(self.chunk_starts, i, side='right')) - 1
+        return(c, i - int(self.chunk_starts[c]))
+
+    def __getitem__(self, key):
+        frames = self.raw(key)
+        if self.frame_format.packing == 'none':
+            return(frames)
+        out = np.empty((*frames.shape[:-1], self.imshape[1]), dtype=np.uint16)
+        return(ximea_pixels.unpack_into(frames, self.frame_format, out))
+
+    def msb8(self, key):
+        '''
+        The top 8 bits of frames by index, slice or list of indices, as uint8
+        '''
+        return(ximea_pixels.unpack_msb8(self.raw(key), self.frame_format))
+
+    def raw(self, key):
+        '''
+        Frames by index, slice or list of indices as stored, (..., H, bytes per row) uint8 for packed frames
+        '''
+        if isinstance(key, (int, np.integer)):
+            i = int(key) + self.n_frames if key < 0 else int(key)
+            if not 0 <= i < self.n_frames:
+                raise IndexError(f'frame {key} out of range for {self.n_frames} frames')
+            c, j = self._locate(i)
+            if self._decompress is not None:
+                record = self.records[i]
+                payload = self.chunk_arrays[c][record['offset']:record['offset'] + record['nbytes']]
+                return(np.frombuffer(self._decompress(payload), dtype=np.uint8).reshape(self.stored_shape))
+            return(self.chunk_arrays[c][j])
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.n_frames)
+            if start >= stop:
+                return(np.empty((0, *self.stored_shape), dtype=np.uint8))
+            c0, j0 = self._locate(start)
+            c1, _ = self._locate(stop - 1)
+            if c0 == c1 and self._decompress is None:
+                return(self.chunk_arrays[c0][j0:j0 + stop - start:step])
+            return(np.stack([self.raw(i) for i in range(start, stop, step)]))
+        return(np.stack([self.raw(int(i)) for i in np.asarray(key).ravel()]))
+
+    def get(self, key, demosaic=False, flip=True, norm=False, msb8=False):
+        '''
+        Frames by index, slice or list of indices, optionally demosaiced to BGR and,
+        with msb8, cut down to their top 8 bits first
+        '''
+        frames = self.msb8(key) if msb8 else self[key]
+        if not demosaic:
+            return(frames)
+        if frames.ndim == 2:
+            return(demosaic_frames(frames[None], flip, norm)[0])
+        return(demosaic_frames(frames, flip, norm))
+
+    @property
+    def sync(self):
+        '''
+        (offset, drift) mapping camera time to Pupil time, fitted on first use
+        '''
+        if self._sync is None:
+            self._sync = fit_clock_sync(self.sync_file_name)
+        return(self._sync)
+
+    @property
+    def pupil_times(self):
+        '''
+        Pupil timestamp of every frame
+        '''
+        if self._pupil_times is None:
+            self._pupil_times = pupil_times_from(self.records, self.cam_times, self.sync_file_name)
+        return(self._pupil_times)
+
+    def frame_at_cam_time(self, t):
+        '''
+        Index of the frame whose camera time is closest to t (seconds)
+        '''
+        return(self._nearest(self.cam_times, t))
+
+    def frame_at_pupil_time(self, t):
+        '''
+        Index of the frame closest to Pupil timestamp t
+        '''
+        return(self._nearest(self.pupil_times, t))
+
+    def frames_between(self, t0, t1, clock='pupil'):
+        '''
+        Slice of the frames recorded from t0 up to t1 on the 'pupil' or 'cam' clock
+        '''
+        times = self.pupil_times if clock == 'pupil' else self.cam_times
+        return(slice(int(np.searchsorted(times, t0)), int(np.searchsorted(times, t1))))
+
+    @staticmethod
+    def _nearest(times, t):
+        if len(times) < 2:
+            return(0)
+        i = int(np.clip(np.searchsorted(times, t), 1, len(times) - 1))
+        return(i - 1 if abs(t - times[i - 1]) <= abs(times[i] - t) else i)
+
+if __name__ == '__main__':
+    if len(sys.argv) < 4:
+        print('usage: python ximea_reader.py REC_DIR CAM_NAME CAM_NAME [CAM_NAME ...]   (writes REC_DIR/frame_index.tsv)')
+        sys.exit(1)
+    print(write_frame_index(sys.argv[1], sys.argv[2:]))
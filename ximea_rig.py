@@ -0,0 +1,564 @@
+"""
+The cameras recorded by the Ximea_Capture plugin.
+
+Each RigCamera owns one camera handle, its frame ring and preview and, while recording,
+its own acquisition thread and save thread (or acquisition process), so cameras never
+wait on each other's writes. All cameras of a recording save into the same folder,
+every file named after the camera (timestamps_{name}.tsv, frames in {name}/ ...) which
+is what XimeaRecording(rec_dir, name) reads. A camera with a save_root writes its
+frames onto that disk instead and links them into the recording folder.
+
+Cameras are opened, configured and started on a background thread so Pupil Capture
+never waits on them. A camera that fails to open, or stops delivering preview frames
+(unplugged), is closed and opened again after a backoff that doubles up to
+RECONNECT_MAX_S seconds.
+
+What a camera records is set by the plugin's ROI mode and decimation and the camera's
+own roi, see ximea_roi: the frame ring holds frames of the ROI's size and the camera's
+readout window is set to the ROI in 'hardware' mode (the whole sensor otherwise).
+Frames are kept in the ring, and written, in the bit depth and packing the settings
+file asks the camera for (see ximea_pixels). While recording, each camera's publisher
+hands the frames in its ring to live subscribers (see ximea_publish).
+"""
+
+import os
+import threading
+import time
+
+import ximea_backpressure
+import ximea_compress
+import ximea_preview
+import ximea_pixels
+import ximea_process
+import ximea_publish
+import ximea_ring
+import ximea_roi
+import ximea_settings
+import ximea_telemetry
+import ximea_utils
+
+RECONNECT_MIN_S = 1.0
+RECONNECT_MAX_S = 30.0
+#failed preview grabs in a row before a camera is taken to be disconnected
+DISCONNECT_ERRORS = 5
+#longest stop_recording() waits for the acquisition thread's last grab, poll() hands the camera back later
+ACQ_STOP_TIMEOUT_S = 1.0
+
+class RigCamera():
+    '''
+    One camera of the rig. Pipeline options (ring size, write mode, compression,
+    acquisition process, ...) are read from the plugin whenever the camera is opened
+    or starts recording, so the plugin menu applies to every camera.
+
+    open() only starts the opening thread, poll() (called from the GUI thread) takes
+    the opened camera over, starts its preview and reconnects cameras that failed.
+    status is one of closed, opening, configuring, starting, ready, recording,
+    disconnected or error: ...
+
+    roi is (x, y, width, height) in sensor pixels, None for the whole sensor.
+    '''
+    def __init__(self, name, serial_num, yaml_loc, plugin, logger, save_root='', roi=None):
+        self.name = name
+        self.serial_num = serial_num
+        self.yaml_loc = yaml_loc
+        self.save_root = save_root
+        self.roi = roi
+        self.plugin = plugin
+        self.logger = logger
+
+        self.camera = None
+        self.image_handle = None
+        self.camera_open = False
+        self.imshape = tuple(plugin.imshape)
+        #frame size without a ROI, from the settings file
+        self.sensor_shape = tuple(plugin.imshape)
+        #bit depth and packing of the frames, from the settings file
+        self.frame_format = ximea_pixels.RAW8
+        self.frame_ring = None
+        self.preview = None
+        self.preview_texture = None
+        self.preview_seq = -1
+        self.telemetry = None
+        self.compressor = None
+        self.acq_process = None
+        self.handles = None
+        #set by stop_recording() until the preview has the camera back
+        self._camera_to_return = False
+        #backpressure policy of the current recording, None if it has none
+        self.backpressure = None
+        #live frames for other plugins and processes, kept for the camera's whole life
+        self.publisher = ximea_publish.FramePublisher(name, logger)
+        #name -> options of the frames shared with other processes, and the names still to be (re)made
+        self.shares = {}
+        self._shares_pending = set()
+
+        self.status = 'closed'
+        self._opener = None
+        #bumped by close(), a camera opened for an older generation is closed again
+        self._generation = 0
+        self._opener_generation = None
+        #(generation, init_camera result) of finished opening threads
+        self._open_results = []
+        self._retry_at = None
+        self._backoff = RECONNECT_MIN_S
+
+        self.stop_collecting_event = threading.Event()
+        self.currently_recording = threading.Event()
+        self.currently_saving = threading.Event()
+
+    def open(self):
+        '''
+        Start opening the camera in the background, poll() picks it up once it's ready
+        '''
+        if self.camera_open or (self._opener is not None and self._opener.is_alive()
+                                and self._opener_generation == self._generation):
+            return
+        self._retry_at = None
+        self.status = 'opening'
+        self._opener_generation = self._generation
+        self._opener = threading.Thread(target=self._open_worker, args=(self._generation,),
+                                        name=f'ximea_open_{self.name}', daemon=True)
+        self._opener.start()
+
+    def _open_worker(self, generation):
+        def set_status(status):
+            if generation == self._generation:
+                self.status = status
+        try:
+            result = ximea_utils.init_camera(self.serial_num, self.yaml_loc, self.logger, self.plugin.camera_backend,
+                                             on_status=set_status)
+        except Exception as e:
+            set_status(f'error: {e}')
+            result = (None, None, False)
+        self._open_results.append((generation, result))
+
+    def _take_open_result(self, generation, result):
+        '''
+        Take over a camera the opening thread has finished with, or schedule another try
+        '''
+        camera, image_handle, camera_open = result
+        if generation != self._generation:
+            if camera is not None:
+                camera.stop_acquisition()
+                camera.close_device()
+            return
+        if not camera_open:
+            self._retry_at = time.monotonic() + self._backoff
+            self._backoff = min(2 * self._backoff, RECONNECT_MAX_S)
+            return
+        self.camera, self.image_handle, self.camera_open = camera, image_handle, True
+        self._backoff = RECONNECT_MIN_S
+        self.status = 'ready'
+        self.alloc_frame_ring()
+        self.set_readout()
+        if self.preview is not None:
+            self.preview.use_camera(self.camera, self.image_handle)
+        elif self.plugin.preview_ximea:
+            self.start_preview()
+
+    def disconnected(self):
+        '''
+        Drop a camera that stopped answering and try to open it again shortly
+        '''
+        self.logger.info(f'Camera {self.name} stopped responding, reconnecting')
+        if self.preview is not None:
+            self.preview.use_ring()
+        if self.camera is not None:
+            try:
+                self.camera.stop_acquisition()
+                self.camera.close_device()
+            except Exception:
+                pass
+            self.camera = None
+        self.camera_open = False
+        self.status = 'disconnected'
+        self._retry_at = time.monotonic() + self._backoff
+
+    def status_text(self):
+        if self.acq_process is not None:
+            if self.acq_process.start_delay is None and not self.acq_process.done():
+                return('starting (acquisition process)')
+            return('recording (acquisition process)')
+        if self.currently_recording.is_set():
+            return('recording')
+        if self._retry_at is not None:
+            return(f'{self.status}, retrying in {max(0, self._retry_at - time.monotonic()):.0f} s')
+        return(self.status)
+
+    def close(self):
+        self._generation += 1
+        self._retry_at = None
+        self.stop_preview()
+        if not self.camera == None:
+            self.camera.close_device()
+            self.camera = None
+        self.camera_open = False
+        self.status = 'closed'
+
+    def apply_settings(self):
+        '''
+        Apply a changed settings file to the open camera, setting only the parameters that differ
+        Returns:
+            applied (bool): False if the camera had to be opened again instead
+        '''
+        if not self.camera_open or self.camera is None or self.busy():
+            self.close()
+            self.open()
+            return(False)
+        if self.preview is not None:
+            #waits for a grab in progress to finish
+            self.preview.use_ring()
+        try:
+            change = ximea_utils.apply_cam_settings(self.camera, self.yaml_loc, acquiring=True)
+        except Exception as e:
+            self.logger.info(f'Could not apply {self.yaml_loc} to {self.name}, reopening it: {e}')
+            self.close()
+            self.open()
+            return(False)
+        self.logger.info(f'Applied {len(change.applied)} changed settings to {self.name}'
+                         + (f', restarted acquisition for {", ".join(change.restart)}' if change.restart else ''))
+        self.alloc_frame_ring()
+        #the settings file sets the whole sensor, put the ROI back
+        self.set_readout()
+        if self.preview is not None:
+            self.preview.use_camera()
+        return(True)
+
+    def geometry(self):
+        '''
+        ROI and decimation the camera records with, from the plugin's mode and this camera's roi
+        '''
+        return(ximea_roi.make_geometry(self.plugin.roi_mode, self.sensor_shape, self.roi, self.plugin.decimation))
+
+    def placed_roi(self):
+        '''
+        Where roi lies on the sensor, rounded as the ROI mode will record it ('software' in 'full' mode)
+        '''
+        mode = 'software' if self.plugin.roi_mode == 'full' else self.plugin.roi_mode
+        return(ximea_roi.make_geometry(mode, self.sensor_shape, self.roi, self.plugin.decimation))
+
+    def set_readout(self):
+        '''
+        Set the open camera's readout window for the current geometry
+        '''
+        if not self.camera_open or self.camera is None:
+            return
+        geometry = self.geometry()
+        try:
+            if ximea_roi.apply_hardware_roi(self.camera, geometry, acquiring=True):
+                g = geometry if geometry.mode == 'hardware' else ximea_roi.make_geometry('full', geometry.sensor_shape)
+                self.logger.info(f'Set the readout window of {self.name} to {g.width}x{g.height} at ({g.x}, {g.y})')
+        except Exception as e:
+            self.logger.info(f'Could not set the readout window of {self.name}: {e}')
+
+    def apply_roi(self):
+        '''
+        Put a changed ROI, ROI mode or decimation into effect on the camera and the frame ring
+        '''
+        if self.busy():
+            return
+        if self.preview is not None:
+            #waits for a grab in progress to finish
+            self.preview.use_ring()
+        self.alloc_frame_ring()
+        self.set_readout()
+        if self.preview is not None and self.camera_open:
+            self.preview.use_camera()
+
+    def framerate(self):
+        '''
+        Framerate in the settings file, None if it has none
+        '''
+        try:
+            framerate = ximea_settings.load_settings(self.yaml_loc).get('framerate')
+        except Exception:
+            return(None)
+        return(None if framerate is None else float(framerate))
+
+    def data_rate(self):
+        '''
+        MB/s this camera will write, None if the settings file has no framerate
+        '''
+        framerate = self.framerate()
+        return(None if framerate is None else
+               ximea_roi.data_rate(self.geometry(), framerate, ximea_pixels.bytes_per_pixel(self.frame_format)))
+
+    def rate_text(self):
+        framerate = self.framerate()
+        if framerate is None:
+            return(f'unknown, no framerate in {os.path.basename(self.yaml_loc)}')
+        return(ximea_roi.rate_text(self.geometry(), framerate, ximea_pixels.bytes_per_pixel(self.frame_format)))
+
+    def alloc_frame_ring(self):
+        '''
+        (Re)allocate the preallocated frame ring to match the frame size and format in the yaml file and the ROI
+        '''
+        plugin = self.plugin
+        sensor_shape = self.sensor_shape
+        try:
+            self.sensor_shape = ximea_ring.frame_shape_from_yaml(self.yaml_loc, self.sensor_shape)
+        except Exception as e:
+            self.logger.info(f'Could not read frame size from {self.yaml_loc}, using {self.sensor_shape}: {e}')
+        if self.sensor_shape != sensor_shape:
+            #shared blocks are sized for the sensor
+            self._shares_pending.update(self.shares)
+        try:
+            self.frame_format = ximea_pixels.format_from_file(self.yaml_loc)
+        except Exception as e:
+            self.logger.error(f'Could not read the pixel format of {self.name} from {self.yaml_loc}, '
+                              f'using {self.frame_format.bits} bit: {e}')
+        self.imshape = ximea_roi.frame_shape(self.geometry())
+        #packed frames are kept as bytes, (height, width * bits / 8)
+        stored_shape = ximea_pixels.stored_shape(self.imshape, self.frame_format)
+        ring_class = ximea_ring.SharedFrameRing if plugin.acquisition_process else ximea_ring.FrameRing
+        if (self.frame_ring is None or self.frame_ring.imshape != stored_shape
+                or type(self.frame_ring) is not ring_class):
+            if self.preview is not None:
+                self.preview.frame_ring = None #stop the preview reading a ring that is going away
+            self.free_frame_ring() #let the old ring go before allocating the new one
+            self.frame_ring = ring_class(plugin.ring_slots, stored_shape, plugin.ring_policy)
+            self.logger.info(f'Allocated {plugin.ring_slots} frame slots of {self.imshape} {self.frame_format.bits} bit '
+                             f'for {self.name} ({plugin.ring_policy} when full)')
+        if self.preview is not None:
+            self.preview.frame_format = self.frame_format
+            self.preview.frame_ring = self.frame_ring
+
+    def free_frame_ring(self):
+        self.publisher.detach()
+        if isinstance(self.frame_ring, ximea_ring.SharedFrameRing):
+            self.frame_ring.destroy()
+        self.frame_ring = None
+
+    def start_preview(self):
+        '''
+        Start producing preview images in the background, from the camera or, while recording, the frame ring
+        '''
+        if self.preview is not None or not self.camera_open:
+            return
+        self.preview = ximea_preview.PreviewWorker(self.camera, self.image_handle, self.frame_ring,
+                                                   self.currently_recording, self.logger, max_fps=self.plugin.preview_fps,
+                                                   frame_format=self.frame_format)
+        if self.currently_recording.is_set() or self.acq_process is not None:
+            self.preview.use_ring()
+        self.preview.start()
+
+    def stop_preview(self):
+        if self.preview is not None:
+            self.preview.stop()
+            self.preview = None
+
+    def release_camera(self):
+        '''
+        Close our camera handle so the acquisition process can open the camera
+        '''
+        if self.preview is not None:
+            self.preview.use_ring()
+        if self.camera is not None:
+            self.camera.stop_acquisition()
+            self.camera.close_device()
+            self.camera = None
+
+    def reclaim_camera(self):
+        '''
+        Open the camera again once the acquisition process has exited
+        '''
+        self.acq_process.join()
+        self.acq_process = None
+        self.camera_open = False
+        self.open()
+
+    def link_save_root(self, save_dir):
+        '''
+        Put this camera's frames on the save_root disk, linked into the recording folder
+        '''
+        if not self.save_root:
+            return
+        #recordings are {day}/{number}/ximea, keep day and number so recordings don't collide
+        rec_path = os.path.dirname(save_dir)
+        frames_dir = os.path.join(self.save_root, os.path.basename(os.path.dirname(rec_path)),
+                                  os.path.basename(rec_path), self.name)
+        try:
+            os.makedirs(frames_dir, exist_ok=True)
+            os.symlink(frames_dir, os.path.join(save_dir, self.name), target_is_directory=True)
+            self.logger.info(f'Saving {self.name} frames to {frames_dir}')
+        except OSError as e:
+            self.logger.info(f'Could not save {self.name} frames to {self.save_root}, saving with the recording: {e}')
+
+    def start_recording(self, save_dir, g_pool):
+        '''
+        Start recording into save_dir
+        Returns:
+            started (bool): False if the last recording is still being saved, its frames are still in the ring
+        '''
+        plugin = self.plugin
+        if self.busy():
+            self.logger.info(f'Camera {self.name} is still saving its last recording, not recording it again yet')
+            return(False)
+        if self.handles is not None:
+            #both threads have exited, the ring is only reset once they're joined
+            self.handles.acq_thread.join()
+            self.handles.save_thread.join()
+            self.handles = None
+            self._camera_to_return = False
+        self.stop_collecting_event.clear()
+        self.link_save_root(save_dir)
+        if self.preview is not None:
+            self.preview.use_ring()
+        self.compressor = None
+        self.backpressure = plugin.backpressure_policy if plugin.backpressure else None
+        compression = (plugin.compression, int(plugin.compression_level), int(plugin.compression_workers))
+        if plugin.acquisition_process:
+            self.release_camera()
+            self.acq_process = ximea_process.AcquisitionProcess(
+                self.serial_num, self.yaml_loc, self.frame_ring, save_dir, plugin.ims_per_file,
+                self.currently_recording, self.currently_saving, g_pool, self.logger, plugin.write_mode,
+                write_in_child=plugin.write_in_child, compression=compression,
+                backend_name=None if plugin.camera_backend is None else plugin.camera_backend.__name__,
+                cam_name=self.name, sync_interval=plugin.sync_interval, geometry=self.geometry(),
+                backpressure=self.backpressure)
+            self.telemetry = self.acq_process
+            self.acq_process.start()
+            #the child fills the shared ring, the publisher watches it from here
+            self.publisher.attach(self.frame_ring, self.acq_process.clock, self.frame_format)
+            return(True)
+        if plugin.compression != 'none':
+            self.compressor = ximea_compress.FrameCompressor(*compression)
+        self.telemetry = ximea_telemetry.PipelineTelemetry(self.name, save_dir, self.frame_ring)
+        self.handles = ximea_utils.start_ximea_aquisition(self.camera, self.image_handle, self.frame_ring,
+                                                          save_dir, plugin.ims_per_file,
+                                                          self.stop_collecting_event,
+                                                          self.currently_recording,
+                                                          self.currently_saving,
+                                                          g_pool,
+                                                          self.logger,
+                                                          plugin.write_mode,
+                                                          telemetry=self.telemetry,
+                                                          compressor=self.compressor,
+                                                          cam_name=self.name,
+                                                          sync_interval=plugin.sync_interval,
+                                                          settings_file=self.yaml_loc,
+                                                          geometry=self.geometry(),
+                                                          backpressure=self.backpressure,
+                                                          publisher=self.publisher)
+        return(True)
+
+    def stop_recording(self):
+        if self.acq_process is not None:
+            #the camera is opened here again once the process has exited, see poll()
+            self.acq_process.stop()
+            return
+        self.stop_collecting_event.set()
+        #the preview only grabs from the camera again once the acquisition thread has let go of it
+        self._camera_to_return = True
+        self.handles.acq_thread.join(ACQ_STOP_TIMEOUT_S)
+        self.return_camera()
+
+    def return_camera(self):
+        '''
+        Let the preview grab from the camera again, once the last recording's acquisition thread has exited
+        '''
+        if not self._camera_to_return or self.handles.acq_thread.is_alive():
+            return
+        self._camera_to_return = False
+        if self.preview is not None:
+            self.preview.use_camera()
+
+    def busy(self):
+        '''
+        True while frames of the last recording are still being acquired or saved
+        '''
+        if self.acq_process is not None:
+            return(True)
+        return(self.handles is not None and (self.handles.acq_thread.is_alive() or self.handles.save_thread.is_alive()))
+
+    def poll(self):
+        '''
+        Called regularly from the GUI thread: takes over newly opened cameras, takes the
+        camera back from a finished acquisition process and reconnects lost cameras
+        '''
+        if self.acq_process is not None and self.acq_process.done():
+            self.reclaim_camera()
+        while self._open_results:
+            self._take_open_result(*self._open_results.pop(0))
+        if self.camera_open and self._shares_pending:
+            self.make_shares()
+        if self._camera_to_return:
+            self.return_camera()
+        if self.preview is not None:
+            self.preview.max_fps = self.preview_fps()
+        if self.busy():
+            return
+        if (self.camera_open and self.preview is not None and not self.currently_recording.is_set()
+                and self.preview.errors >= DISCONNECT_ERRORS):
+            self.disconnected()
+        if self._retry_at is not None and time.monotonic() >= self._retry_at:
+            self.open()
+
+    def backpressure_level(self):
+        '''
+        Escalation level of the writer backpressure of the recording in progress, 0 if there is none
+        '''
+        if not self.busy() or self.backpressure is None:
+            return(0)
+        if self.acq_process is not None:
+            return((self.acq_process.counters or {}).get('backpressure_level', 0))
+        return(self.telemetry.backpressure_level)
+
+    def preview_fps(self):
+        '''
+        Preview rate, lowered while the writer is falling behind
+        '''
+        return(ximea_backpressure.preview_fps(self.backpressure, self.backpressure_level(), self.plugin.preview_fps))
+
+    def compression_status(self):
+        if self.acq_process is not None:
+            return(self.acq_process.compression_status())
+        if self.compressor is None:
+            return('off' if self.plugin.compression == 'none' else 'idle')
+        return(self.compressor.status_text())
+
+    def telemetry_status(self, key):
+        if self.telemetry is None:
+            return('idle')
+        return(self.telemetry.status()[key])
+
+    def share(self, name, kind='debayered', decimation=1, step=1, n_slots=4):
+        '''
+        Publish this camera's frames to other local processes under name, see ximea_publish.SharedPublication.
+        The block is sized for the sensor, so it is only made once the camera is open and has
+        read its settings file (by poll() if it isn't yet), and made again if the sensor size changes.
+        Returns:
+            publication (SharedPublication): None until the camera is open
+        '''
+        if kind not in ximea_publish.KINDS:
+            raise ValueError(f'Unknown kind {kind}, use one of {ximea_publish.KINDS}')
+        self.shares[name] = {'kind': kind, 'decimation': int(decimation), 'step': int(step), 'n_slots': int(n_slots)}
+        self._shares_pending.add(name)
+        if self.camera_open:
+            self.make_shares()
+        return(next((p for p in self.publisher.shares if p.name == name), None))
+
+    def make_shares(self):
+        '''
+        Make the shared blocks asked for since the camera opened or its sensor size changed
+        '''
+        for name in sorted(self._shares_pending):
+            try:
+                self.publisher.share(name, sensor_shape=self.sensor_shape, **self.shares[name])
+            except OSError as e:
+                self.logger.info(f'Could not share {self.name} frames as {name}: {e}')
+        self._shares_pending.clear()
+
+    def cleanup(self):
+        if self.acq_process is not None:
+            self.acq_process.stop()
+            self.acq_process.join()
+            self.acq_process = None
+        self.publisher.close()
+        self.close()
+        #a camera still being opened is closed as soon as it is
+        if self._opener is not None:
+            self._opener.join(timeout=5)
+            while self._open_results:
+                self._take_open_result(*self._open_results.pop(0))
+        self.free_frame_ring()
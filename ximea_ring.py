@@ -0,0 +1,319 @@
+import multiprocessing
+import threading
+import time
+from collections import deque
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import ximea_settings
+
+#what to do with a new frame when every slot in the ring is in use
+RING_POLICIES = ('block', 'drop_newest', 'drop_oldest')
+
+#per slot metadata, filled by the acquisition thread alongside the pixels
+slot_meta_dtype = np.dtype([('nframe', np.int64),
+                            ('tsSec', np.int64),
+                            ('tsUSec', np.int64),
+                            ('t_host', np.float64)])
+
+def frame_shape_from_yaml(config_file, default=(1544, 2064)):
+    '''
+    Read the frame shape the camera will produce from its settings file
+    Params:
+        config_file (str): path to the camera .yaml settings file
+        default (tuple): (height, width) to use if the file doesn't set them
+    Returns:
+        imshape (tuple): (height, width) of a single raw frame
+    '''
+    cam_props = ximea_settings.load_settings(config_file)
+    height = int(cam_props.get('height', default[0]))
+    width = int(cam_props.get('width', default[1]))
+    return((height, width))
+
+class FrameRing():
+    '''
+    Fixed pool of preallocated frame slots shared between the acquisition
+    thread (producer) and the save thread (consumer).
+
+    The producer asks for a free slot with acquire(), copies a frame into
+    frames[slot], and hands it over with commit(). The consumer takes ready
+    slots with get_batch() and gives them back with release() once they are
+    on disk. Memory use is fixed at n_slots frames no matter how far the
+    writer falls behind; what happens when the ring is full is set by policy:
+        block       - producer waits for the writer to release a slot
+        drop_newest - the incoming frame is discarded
+        drop_oldest - the oldest frame not yet taken by the writer is discarded
+    Discarded frames are counted in self.dropped, frames handed to the writer in self.taken.
+    The frame counter of the last frame drop_oldest discarded is kept in evicted, for the
+    producer.
+    '''
+    evicted = None
+
+    def __init__(self, n_slots, imshape, policy='drop_oldest', dtype=np.uint8):
+        if policy not in RING_POLICIES:
+            raise ValueError(f'Unknown ring policy {policy}, use one of {RING_POLICIES}')
+        self.n_slots = int(n_slots)
+        self.imshape = tuple(imshape)
+        self.policy = policy
+        self._allocate(np.dtype(dtype))
+        self.frames.fill(0) #touch every page now rather than during the first recording
+        self.frame_nbytes = self.frames[0].nbytes
+        self.reset()
+
+    def _allocate(self, dtype):
+        self.frames = np.empty((self.n_slots, *self.imshape), dtype=dtype)
+        self.meta = np.zeros(self.n_slots, dtype=slot_meta_dtype)
+        #bumped every time a slot is handed to the producer, lets readers detect a reused slot
+        self._slot_seq = np.zeros(self.n_slots, dtype=np.int64)
+        self._lock = threading.Lock()
+        self._slot_freed = threading.Condition(self._lock)
+        self._frame_ready = threading.Condition(self._lock)
+        self._free = deque()
+        self._ready = deque()
+
+    def depth(self):
+        '''
+        Number of frames waiting for the writer
+        '''
+        return(len(self._ready))
+
+    def in_use(self):
+        '''
+        Number of slots holding frames, waiting for the writer or being written
+        '''
+        return(self.n_slots - len(self._free))
+
+    def acquire(self, timeout=None):
+        '''
+        Get a free slot for the next frame.
+        Params:
+            timeout (float): only used by the 'block' policy, seconds to wait for a slot
+        Returns:
+            slot (int): index into self.frames, or None if the frame should be dropped
+        '''
+        with self._lock:
+            slot = None
+            if self._free:
+                slot = self._free.popleft()
+            elif self.policy == 'block':
+                if self._slot_freed.wait_for(lambda: self._free, timeout):
+                    slot = self._free.popleft()
+            elif self.policy == 'drop_oldest' and self._ready:
+                self.dropped += 1
+                slot = self._ready.popleft()
+                self.evicted = int(self.meta[slot]['nframe'])
+            if slot is None:
+                #drop_newest, a block that timed out, or drop_oldest with every slot held by the writer
+                self.dropped += 1
+                return(None)
+            self._slot_seq[slot] += 1
+            if slot == self._latest:
+                self._latest = None
+            return(slot)
+
+    def commit(self, slot, nframe, tsSec, tsUSec, t_host=None):
+        '''
+        Hand a filled slot to the writer
+        '''
+        self.meta[slot] = (nframe, tsSec, tsUSec, time.time() if t_host is None else t_host)
+        with self._lock:
+            self._ready.append(slot)
+            self._latest = slot
+            self.committed += 1
+            depth = len(self._ready)
+            if depth > self.max_depth:
+                self.max_depth = depth
+            self._frame_ready.notify()
+
+    def get_batch(self, max_frames, timeout=None):
+        '''
+        Take up to max_frames ready slots, oldest first.
+        Params:
+            max_frames (int): most slots to return
+            timeout (float): seconds to wait for at least one frame (None waits forever)
+        Returns:
+            slots (list of int): empty if the timeout ran out or the ring is closed and drained
+        '''
+        with self._lock:
+            if not self._ready:
+                self._frame_ready.wait_for(lambda: self._ready or self.closed, timeout)
+            n = min(max_frames, len(self._ready))
+            self.taken += n
+            return([self._ready.popleft() for _ in range(n)])
+
+    def peek_latest(self):
+        '''
+        Find the most recently committed frame without taking it from the writer.
+        The slot can be reused by the producer at any time, read frames[slot] and
+        then check still_valid() before trusting what was read.
+        Returns:
+            (slot, seq) or None if there is no frame yet
+        '''
+        with self._lock:
+            if self._latest is None:
+                return(None)
+            return(self._latest, int(self._slot_seq[self._latest]))
+
+    def still_valid(self, slot, seq):
+        '''
+        True if the slot returned by peek_latest() hasn't been handed back to the producer since
+        '''
+        with self._lock:
+            return(self._slot_seq[slot] == seq)
+
+    def release(self, slots):
+        '''
+        Give slots back to the producer once their frames are written
+        '''
+        with self._lock:
+            self._free.extend(slots)
+            self._slot_freed.notify(len(slots))
+
+    def close(self):
+        '''
+        Producer is finished, wake the writer so it can drain what is left and exit
+        '''
+        with self._lock:
+            self.closed = True
+            self._frame_ready.notify_all()
+
+    def reset(self):
+        '''
+        Return every slot to the free pool and clear counters, used between recordings
+        '''
+        with self._lock:
+            self._free.clear()
+            self._free.extend(range(self.n_slots))
+            self._ready.clear()
+            self._latest = None
+            self.closed = False
+            self.committed = 0
+            self.taken = 0
+            self.dropped = 0
+            self.max_depth = 0
+
+class _SharedSlotQueue():
+    '''
+    The few deque operations FrameRing uses, on a FIFO of slot numbers kept in a
+    shared int64 array laid out as [head, count, slot, slot, ...]
+    '''
+    def __init__(self, buf):
+        self._buf = buf
+        self._n = len(buf) - 2
+
+    def __len__(self):
+        return(int(self._buf[1]))
+
+    def popleft(self):
+        head = self._buf[0]
+        slot = int(self._buf[2 + head])
+        self._buf[0] = (head + 1) % self._n
+        self._buf[1] -= 1
+        return(slot)
+
+    def append(self, slot):
+        self._buf[2 + (self._buf[0] + self._buf[1]) % self._n] = slot
+        self._buf[1] += 1
+
+    def extend(self, slots):
+        for slot in slots:
+            self.append(slot)
+
+    def clear(self):
+        self._buf[:2] = 0
+
+class SharedFrameRing(FrameRing):
+    '''
+    FrameRing whose frames, metadata and bookkeeping all live in one
+    multiprocessing.shared_memory block, guarded by multiprocessing locks, so the
+    producer and consumer can be in different processes and still hand frames over
+    without copying them.
+
+    Create it in the parent process and pass it to the child as a Process argument,
+    the child attaches to the same memory. The parent calls destroy() once nothing
+    uses the ring any more.
+    '''
+    #counters kept at the start of the shared state block
+    _CLOSED, _COMMITTED, _DROPPED, _MAX_DEPTH, _LATEST, _TAKEN = range(6)
+    _N_COUNTERS = 6
+
+    def __init__(self, n_slots, imshape, policy='drop_oldest', dtype=np.uint8, mp_context=None):
+        ctx = mp_context or multiprocessing.get_context('spawn')
+        self._lock = ctx.Lock()
+        self._slot_freed = ctx.Condition(self._lock)
+        self._frame_ready = ctx.Condition(self._lock)
+        self._shm = None
+        super().__init__(n_slots, imshape, policy, dtype)
+
+    def _layout(self, dtype):
+        '''
+        Byte offsets of the state, metadata and frames in the shared block, frames start on a page
+        '''
+        n_state = self._N_COUNTERS + 3 * self.n_slots + 4
+        meta_at = n_state * 8
+        frames_at = -(-(meta_at + self.n_slots * slot_meta_dtype.itemsize) // 4096) * 4096
+        size = frames_at + self.n_slots * int(np.prod(self.imshape)) * dtype.itemsize
+        return(n_state, meta_at, frames_at, size)
+
+    def _allocate(self, dtype):
+        self._dtype = dtype
+        size = self._layout(dtype)[3]
+        self._shm = shared_memory.SharedMemory(create=True, size=size)
+        self._owner = True
+        self._map()
+
+    def _map(self):
+        n_state, meta_at, frames_at, _ = self._layout(self._dtype)
+        buf = self._shm.buf
+        self._state = np.ndarray(n_state, dtype=np.int64, buffer=buf)
+        n = self._N_COUNTERS
+        self._free = _SharedSlotQueue(self._state[n:n + self.n_slots + 2])
+        self._ready = _SharedSlotQueue(self._state[n + self.n_slots + 2:n + 2 * self.n_slots + 4])
+        self._slot_seq = self._state[n + 2 * self.n_slots + 4:]
+        self.meta = np.ndarray(self.n_slots, dtype=slot_meta_dtype, buffer=buf, offset=meta_at)
+        self.frames = np.ndarray((self.n_slots, *self.imshape), dtype=self._dtype, buffer=buf, offset=frames_at)
+        self.frame_nbytes = self.frames[0].nbytes
+
+    #FrameRing keeps these as plain attributes, here they have to be in the shared block
+    closed = property(lambda self: bool(self._state[self._CLOSED]),
+                      lambda self, v: self._state.__setitem__(self._CLOSED, v))
+    committed = property(lambda self: int(self._state[self._COMMITTED]),
+                         lambda self, v: self._state.__setitem__(self._COMMITTED, v))
+    taken = property(lambda self: int(self._state[self._TAKEN]),
+                     lambda self, v: self._state.__setitem__(self._TAKEN, v))
+    dropped = property(lambda self: int(self._state[self._DROPPED]),
+                       lambda self, v: self._state.__setitem__(self._DROPPED, v))
+    max_depth = property(lambda self: int(self._state[self._MAX_DEPTH]),
+                         lambda self, v: self._state.__setitem__(self._MAX_DEPTH, v))
+    _latest = property(lambda self: None if self._state[self._LATEST] < 0 else int(self._state[self._LATEST]),
+                       lambda self, v: self._state.__setitem__(self._LATEST, -1 if v is None else v))
+
+    def __getstate__(self):
+        return({'n_slots': self.n_slots, 'imshape': self.imshape, 'policy': self.policy, 'dtype': self._dtype.str,
+                'name': self._shm.name, 'locks': (self._lock, self._slot_freed, self._frame_ready)})
+
+    def __setstate__(self, state):
+        self.n_slots = state['n_slots']
+        self.imshape = state['imshape']
+        self.policy = state['policy']
+        self._dtype = np.dtype(state['dtype'])
+        self._lock, self._slot_freed, self._frame_ready = state['locks']
+        self._shm = shared_memory.SharedMemory(name=state['name'])
+        self._owner = False
+        self._map()
+
+    def destroy(self):
+        '''
+        Unmap the shared memory, and free it if this process created it
+        '''
+        if self._shm is None:
+            return
+        self.frames = self.meta = self._state = self._slot_seq = self._free = self._ready = None
+        try:
+            self._shm.close()
+        except BufferError:
+            pass #someone still holds a view of a frame, the mapping goes when they do
+        if self._owner:
+            self._shm.unlink()
+        self._shm = None
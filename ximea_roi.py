@@ -0,0 +1,113 @@
+"""
+Recording only part of the sensor, or only some of the frames.
+
+    full      frames as configured in the settings file
+    hardware  the camera only reads out the ROI (offsetX, offsetY, width and height are
+              set through ximea_settings), which also lowers the USB bandwidth
+    software  the camera delivers whole frames and the acquisition thread copies just
+              the ROI into the frame ring, so the ROI can be placed on the full preview
+
+Every mode can also keep only one frame in decimation (by camera frame counter).
+The geometry goes into every chunk header (see ximea_chunk), so sensor coordinates
+can be recovered from any recorded frame.
+"""
+
+from collections import namedtuple
+
+import ximea_settings
+
+ROI_MODES = ('full', 'hardware', 'software')
+
+#(y, x) steps ROI offsets and sizes are rounded to: whole Bayer cells, so the colours
+#stay where the demosaic expects them, 4 pixels across so a software crop of 10 bit
+#packed frames falls on whole bytes (see ximea_pixels), and 16 for the camera's readout
+SOFTWARE_ALIGN = (2, 4)
+HARDWARE_ALIGN = (2, 16)
+
+#sensor_shape (height, width) is the frame without a ROI, x, y, width, height the ROI in it
+roi_geometry = namedtuple('roi_geometry', 'mode sensor_shape x y width height decimation')
+
+def make_geometry(mode, sensor_shape, roi=None, decimation=1):
+    '''
+    Work out what a recording mode will record
+    Params:
+        mode (str): one of ROI_MODES
+        sensor_shape (tuple): (height, width) of frames without a ROI
+        roi (tuple): (x, y, width, height) in sensor pixels, the whole sensor if None, unused in 'full' mode
+        decimation (int): keep one frame in this many
+    Returns:
+        geometry (roi_geometry): the ROI rounded to what the mode supports and kept on the sensor
+    '''
+    if mode not in ROI_MODES:
+        raise ValueError(f'Unknown ROI mode {mode}, use one of {ROI_MODES}')
+    height, width = (int(v) for v in sensor_shape)
+    decimation = max(1, int(decimation))
+    if mode == 'full' or roi is None:
+        return(roi_geometry(mode, (height, width), 0, 0, width, height, decimation))
+    align_y, align_x = HARDWARE_ALIGN if mode == 'hardware' else SOFTWARE_ALIGN
+    roi_w = min(width // align_x * align_x, max(align_x, int(roi[2]) // align_x * align_x))
+    roi_h = min(height // align_y * align_y, max(align_y, int(roi[3]) // align_y * align_y))
+    x = min(max(0, int(roi[0]) // align_x * align_x), (width - roi_w) // align_x * align_x)
+    y = min(max(0, int(roi[1]) // align_y * align_y), (height - roi_h) // align_y * align_y)
+    return(roi_geometry(mode, (height, width), x, y, roi_w, roi_h, decimation))
+
+def frame_shape(geometry):
+    '''
+    (height, width) of the frames that are recorded
+    '''
+    return((geometry.height, geometry.width))
+
+def crop(geometry):
+    '''
+    (x, y, width, height) the acquisition thread copies out of each frame, None if it keeps whole frames
+    '''
+    if geometry is None or geometry.mode != 'software':
+        return(None)
+    return((geometry.x, geometry.y, geometry.width, geometry.height))
+
+def data_rate(geometry, framerate, bytes_per_pixel=1):
+    '''
+    MB/s a camera running at framerate writes in this mode
+    '''
+    return(geometry.width * geometry.height * bytes_per_pixel * framerate / geometry.decimation / 1e6)
+
+def rate_text(geometry, framerate, bytes_per_pixel=1):
+    mb_per_s = data_rate(geometry, framerate, bytes_per_pixel)
+    return(f'{geometry.width}x{geometry.height} at {framerate / geometry.decimation:.0f} fps: '
+           f'{mb_per_s:.0f} MB/s, {mb_per_s * 3.6:.0f} GB/h')
+
+def apply_hardware_roi(camera, geometry, acquiring=False):
+    '''
+    Set the camera's readout window for a geometry, the whole sensor unless the mode is 'hardware'.
+    Offsets go to 0 before the size changes so the window stays on the sensor whichever way it moves.
+    Returns:
+        restarted (bool): acquisition had to be stopped for the new size
+    '''
+    if geometry.mode == 'hardware':
+        x, y, width, height = geometry.x, geometry.y, geometry.width, geometry.height
+    else:
+        (height, width), x, y = geometry.sensor_shape, 0, 0
+    settings = ximea_settings.CameraSettings(camera)
+    restarted = False
+    for props in ({'offsetX': 0, 'offsetY': 0}, {'width': width, 'height': height}, {'offsetX': x, 'offsetY': y}):
+        change = settings.apply(props, acquiring)
+        if change.failed:
+            prop, e = change.failed[0]
+            raise ValueError(f'Could not set {prop}: {e}')
+        restarted = restarted or bool(change.restart)
+    return(restarted)
+
+def sensor_to_preview(geometry, x, y):
+    '''
+    Position of sensor pixel (x, y) in a full sensor preview, as fractions from its bottom left
+    (previews are rotated 180 degrees like decode_ximea_frame)
+    '''
+    height, width = geometry.sensor_shape
+    return(1 - x / width, y / height)
+
+def preview_to_sensor(geometry, fx, fy):
+    '''
+    Sensor pixel at fractions (fx, fy) from the bottom left of a full sensor preview
+    '''
+    height, width = geometry.sensor_shape
+    return(int((1 - fx) * width), int(fy * height))
@@ -0,0 +1,201 @@
+"""
+Applying camera settings files.
+
+CameraSettings works out which setter (and getter) each settings file property has
+once per camera model and keeps that plan. Applying a file reads the camera's current
+values back and sets only the ones that differ, in PARAM_ORDER so that limits are in
+place before the values they bound (bandwidth limit before framerate before exposure).
+Properties the camera only takes with acquisition stopped are reported, and apply()
+stops and restarts acquisition around them when the camera is acquiring.
+
+    settings = CameraSettings(camera)
+    change = settings.apply(load_settings('task_b.yaml'), acquiring=True)
+    change.applied, change.restart, change.failed, change.unknown
+
+Switching between the settings files of two tasks then only touches the parameters
+that differ instead of reopening the camera.
+"""
+
+import math
+import os
+import threading
+from collections import namedtuple
+
+import yaml
+
+#order parameters are set in, anything not listed goes after these in file order
+PARAM_ORDER = (
+    #pixel format and geometry decide the payload size everything below is checked against
+    'imgdataformat', 'sensor_bit_depth', 'output_bit_depth', 'image_data_bit_depth', 'is_output_bit_packing',
+    'output_bit_packing_type',
+    'width', 'height', 'offsetX', 'offsetY', 'downsampling', 'downsampling_type',
+    #transport and buffering
+    'transport_data_target', 'acq_buffer_size_unit', 'acq_buffer_size', 'buffers_queue_size', 'buffer_policy',
+    #bandwidth limits the framerate
+    'is_auto_bandwidth_calculation', 'limit_bandwidth_mode', 'limit_bandwidth',
+    #triggering and timing
+    'trigger_selector', 'trigger_source', 'exposure_burst_count', 'acq_frame_burst_count',
+    'acq_timing_mode', 'framerate',
+    #the framerate limits the exposure
+    'is_aeag', 'exposure', 'gain_selector', 'gain',
+)
+
+#parameters the camera only accepts while not acquiring
+RESTART_PARAMS = frozenset((
+    'imgdataformat', 'sensor_bit_depth', 'output_bit_depth', 'image_data_bit_depth', 'is_output_bit_packing',
+    'output_bit_packing_type',
+    'width', 'height', 'downsampling', 'downsampling_type',
+    'transport_data_target', 'acq_buffer_size_unit', 'acq_buffer_size', 'buffers_queue_size',
+))
+
+#what apply() did: applied (list of properties set), restart (the ones that needed acquisition
+#stopped), failed (list of (property, error)), unknown (properties the camera doesn't have)
+settings_change = namedtuple('settings_change', 'applied restart failed unknown')
+
+_settings_cache = {}
+_plans = {}
+_plans_lock = threading.Lock()
+
+def load_settings(settings_file):
+    '''
+    Read a camera settings file, cached until the file changes
+    Returns:
+        props (dict): every property in the file, the 'recording' section included
+    '''
+    mtime = os.path.getmtime(settings_file)
+    cached = _settings_cache.get(settings_file)
+    if cached is None or cached[0] != mtime:
+        with open(settings_file, 'r') as f:
+            cached = (mtime, yaml.safe_load(f) or {})
+        _settings_cache[settings_file] = cached
+    return(dict(cached[1]))
+
+def camera_params(props):
+    '''
+    The properties of a settings file that are camera parameters, in the order to set them
+    '''
+    names = [name for name in props if name != 'recording']
+    rank = {name: i for i, name in enumerate(PARAM_ORDER)}
+    names.sort(key=lambda name: rank.get(name, len(PARAM_ORDER)))
+    return({name: props[name] for name in names})
+
+def _model(camera):
+    try:
+        name = camera.get_device_name()
+    except Exception:
+        name = None
+    return((type(camera).__name__, name.decode() if isinstance(name, bytes) else name))
+
+def setter_plan(camera):
+    '''
+    How each property is set and read on this camera's model, worked out on first use
+    Returns:
+        plan (dict): property -> ('value', setter, getter) or ('switch', enable, disable, getter),
+                     getter is None where the camera has none
+    '''
+    key = _model(camera)
+    with _plans_lock:
+        plan = _plans.get(key)
+        if plan is None:
+            names = set(dir(camera))
+            plan = {}
+            for name in names:
+                if name.startswith('set_'):
+                    prop = name[4:]
+                    getter = f'get_{prop}'
+                    plan[prop] = ('value', name, getter if getter in names else None)
+                elif name.startswith('enable_') and f'disable_{name[7:]}' in names:
+                    prop = f'is_{name[7:]}'
+                    plan.setdefault(prop, ('switch', name, f'disable_{name[7:]}', prop if prop in names else None))
+            _plans[key] = plan
+    return(plan)
+
+def same_value(current, wanted):
+    '''
+    Whether a value read back from the camera matches the one in the settings file
+    '''
+    if isinstance(current, bytes):
+        current = current.decode()
+    if isinstance(wanted, bool) or isinstance(current, bool):
+        return(bool(current) == bool(wanted))
+    if isinstance(wanted, (int, float)) and isinstance(current, (int, float)):
+        return(math.isclose(current, wanted, rel_tol=1e-6, abs_tol=1e-9))
+    return(str(current) == str(wanted))
+
+class CameraSettings():
+    '''
+    Applies settings files to one open camera, setting only what differs from its current state
+    '''
+    def __init__(self, camera):
+        self.camera = camera
+        self.plan = setter_plan(camera)
+
+    def read(self, props):
+        '''
+        Current values of the properties the camera can report
+        Returns:
+            current (dict): property -> value, properties that can't be read are left out
+        '''
+        current = {}
+        for prop in props:
+            entry = self.plan.get(prop)
+            if entry is None or entry[-1] is None:
+                continue
+            try:
+                current[prop] = getattr(self.camera, entry[-1])()
+            except Exception:
+                pass
+        return(current)
+
+    def diff(self, props):
+        '''
+        Parameters that differ from the camera's current values
+        Returns:
+            changes (dict): property -> wanted value, in the order to set them
+            unknown (list): properties the camera has no setter for
+        '''
+        params = camera_params(props)
+        unknown = [prop for prop in params if prop not in self.plan]
+        current = self.read([prop for prop in params if prop in self.plan])
+        changes = {prop: value for prop, value in params.items()
+                   if prop in self.plan and not (prop in current and same_value(current[prop], value))}
+        return(changes, unknown)
+
+    def _set(self, prop, value):
+        entry = self.plan[prop]
+        if entry[0] == 'value':
+            getattr(self.camera, entry[1])(value)
+        else:
+            getattr(self.camera, entry[1] if value else entry[2])()
+
+    def apply(self, props, acquiring=False, force=False):
+        '''
+        Set the parameters of a settings file that differ from the camera's
+        Params:
+            props (dict): settings, from load_settings
+            acquiring (bool): the camera is acquiring, stop and restart it around parameters that need it
+            force (bool): set every parameter, whatever its current value
+        Returns:
+            change (settings_change)
+        '''
+        if force:
+            params = camera_params(props)
+            changes = {prop: value for prop, value in params.items() if prop in self.plan}
+            unknown = [prop for prop in params if prop not in self.plan]
+        else:
+            changes, unknown = self.diff(props)
+        restart = [prop for prop in changes if prop in RESTART_PARAMS]
+        applied, failed = [], []
+        if restart and acquiring:
+            self.camera.stop_acquisition()
+        try:
+            for prop, value in changes.items():
+                try:
+                    self._set(prop, value)
+                    applied.append(prop)
+                except Exception as e:
+                    failed.append((prop, e))
+        finally:
+            if restart and acquiring:
+                self.camera.start_acquisition()
+        return(settings_change(applied, restart, failed, unknown))
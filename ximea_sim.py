@@ -0,0 +1,329 @@
+"""
+Simulated stand in for ximea.xiapi so the acquisition and saving pipeline can be
+run and measured without a camera attached.
+
+SimCamera and SimImage implement the parts of xiapi.Camera / xiapi.Image that
+ximea_utils uses. Frames are either synthetic RG Bayer images produced at the
+configured framerate and resolution, or replayed with their original timing from
+an existing recording, compressed or not, whose frame size and format match the
+camera's settings. Delivery jitter, stalls and sensor side frame drops can be
+injected. With 10 or 12 bit packing set up (see ximea_pixels) frames are delivered
+packed.
+
+Use it anywhere a backend module is accepted:
+    backend = ximea_sim.make_backend(framerate=250, jitter=50e-6, stall_prob=1e-3)
+    camera, image, ok = ximea_utils.init_camera('SIM0001', 'cy.yaml', logger, backend=backend)
+"""
+
+import ctypes
+import time
+from functools import partial
+from types import SimpleNamespace
+
+import numpy as np
+
+import ximea_pixels
+import ximea_reader
+
+class Xi_error(Exception):
+    '''
+    Matches xiapi.Xi_error, status 10 is a timeout
+    '''
+    def __init__(self, status):
+        self.status = status
+        super().__init__(f'ERROR {status}: ' + ('Timeout' if status == 10 else 'Simulated camera error'))
+
+#parameters the simulated camera accepts through set_/get_, with their defaults
+DEFAULT_PARAMS = {
+    'width': 2064,
+    'height': 1544,
+    'offsetX': 0,
+    'offsetY': 0,
+    'framerate': 200.0,
+    'exposure': 4850,
+    'gain': 0.0,
+    'gain_selector': 'XI_GAIN_SELECTOR_ALL',
+    'imgdataformat': 'XI_RAW8',
+    'image_data_bit_depth': 'XI_BPP_8',
+    'output_bit_depth': 'XI_BPP_8',
+    'sensor_bit_depth': 'XI_BPP_8',
+    'output_bit_packing_type': 'XI_DATA_PACK_XI_GROUPING',
+    'exposure_burst_count': 1,
+    'trigger_selector': 'XI_TRG_SEL_FRAME_START',
+    'trigger_source': 'XI_TRG_OFF',
+    'acq_frame_burst_count': 1,
+    'transport_data_target': 'XI_TRANSPORT_DATA_TARGET_CPU_RAM',
+    'acq_buffer_size': 100000000,
+    'acq_buffer_size_unit': 1,
+    'buffers_queue_size': 2,
+    'limit_bandwidth': 6400,
+    'limit_bandwidth_mode': 'XI_ON',
+    'buffer_policy': 'XI_BP_UNSAFE',
+    'acq_timing_mode': 'XI_ACQ_TIMING_MODE_FRAME_RATE_LIMIT',
+}
+
+#boolean parameters, exposed as enable_/disable_/is_ like xiapi
+DEFAULT_SWITCHES = {
+    'output_bit_packing': False,
+    'aeag': False,
+    'auto_bandwidth_calculation': False,
+}
+
+def synthetic_bayer_frames(imshape, n_frames=16, seed=0):
+    '''
+    Make a short loop of RG Bayer frames of a dark pupil moving over a bright, noisy iris
+    Params:
+        imshape (tuple): (height, width) of the raw frame
+        n_frames (int): number of distinct frames in the loop
+    Returns:
+        frames (np.array): (n_frames, height, width) uint8
+    '''
+    rng = np.random.default_rng(seed)
+    h, w = imshape
+    yy, xx = np.mgrid[0:h, 0:w].astype(np.float32)
+    base = 140 + 60 * (xx / max(w, 1)) + rng.normal(0, 6, (h, w))
+    frames = np.empty((n_frames, h, w), dtype=np.uint8)
+    r = 0.08 * min(h, w)
+    for k in range(n_frames):
+        a = 2 * np.pi * k / n_frames
+        cy, cx = h / 2 + 0.2 * h * np.sin(a), w / 2 + 0.2 * w * np.cos(a)
+        im = base.copy()
+        im[(yy - cy)**2 + (xx - cx)**2 < r**2] = 20
+        frames[k] = np.clip(im, 0, 255)
+    #attenuate the colour sites differently, the way a colour filter array would
+    frames[:, 0::2, 1::2] = frames[:, 0::2, 1::2] * 0.9
+    frames[:, 1::2, 0::2] = frames[:, 1::2, 0::2] * 0.9
+    frames[:, 1::2, 1::2] = frames[:, 1::2, 1::2] * 0.6
+    return(frames)
+
+def load_replay(replay_dir, cam_name, imshape):
+    '''
+    Index an existing recording for replay
+    Params:
+        replay_dir (str): the recording's ximea folder (holds timestamps_{cam_name}.tsv)
+        cam_name (str): camera name used in the recording
+        imshape (tuple): (height, width) of the recorded frames
+    Returns:
+        rec (XimeaRecording): the recording, rec.raw(i) gives frame i as the camera delivered it
+        nframes (np.array): camera frame counter of every recorded frame
+        camtimes (np.array): camera time in seconds of every recorded frame
+    '''
+    rec = ximea_reader.XimeaRecording(replay_dir, cam_name, imshape)
+    return(rec, rec.nframe, rec.cam_times)
+
+class SimImage():
+    '''
+    Stand in for xiapi.Image. After SimCamera.get_image, bp points at the frame pixels
+    (like XI_BP_UNSAFE, the memory belongs to the camera and is reused)
+    '''
+    def __init__(self):
+        self.bp = None
+        self.width = 0
+        self.height = 0
+        self.nframe = 0
+        self.tsSec = 0
+        self.tsUSec = 0
+        self.frm = 'XI_RAW8'
+        self._pixels = None
+
+    def get_bytes_per_pixel(self):
+        return(self._pixels.itemsize if self._pixels is not None else 1)
+
+    def get_image_data_raw(self):
+        return(ctypes.string_at(self.bp, self._pixels.nbytes))
+
+    def get_image_data_numpy(self):
+        return(self._pixels)
+
+    def _point_at(self, pixels, nframe, t_cam, width=None):
+        '''
+        width is in pixels, for packed frames it is less than pixels.shape[1] bytes
+        '''
+        self._pixels = pixels
+        self.bp = pixels.ctypes.data
+        self.height, self.width = pixels.shape
+        if width is not None:
+            self.width = width
+        self.nframe = int(nframe)
+        self.tsSec = int(t_cam)
+        self.tsUSec = int(round((t_cam - self.tsSec) * 1e6))
+        if self.tsUSec == 1000000:
+            self.tsSec, self.tsUSec = self.tsSec + 1, 0
+
+class SimCamera():
+    '''
+    Stand in for xiapi.Camera.
+
+    Params:
+        framerate, width, height: pin these, set_ calls from a settings file are then ignored
+        jitter (float): standard deviation in seconds of frame delivery time
+        stall_prob (float): chance per frame of a delivery stall
+        stall_s (float): length of a stall in seconds
+        drop_prob (float): chance per frame that the sensor skips a frame (nframe gap)
+        replay_dir (str): replay this recording instead of synthesising frames
+        replay_cam (str): camera name in the replayed recording
+        replay_loop (bool): start the replay over when it runs out, else time out
+        realtime (bool): pace frames at the framerate, False delivers as fast as asked
+        seed (int): seed for the injected randomness
+    Frames that the caller doesn't collect before buffers_queue_size newer ones have been
+    exposed are lost, as with the real driver, and show up as gaps in nframe.
+    '''
+    def __init__(self, framerate=None, width=None, height=None,
+                 jitter=0.0, stall_prob=0.0, stall_s=0.05, drop_prob=0.0,
+                 replay_dir=None, replay_cam='ximea', replay_loop=True, realtime=True, seed=0):
+        self.pinned = {k: v for k, v in (('framerate', framerate), ('width', width), ('height', height)) if v is not None}
+        self.params = dict(DEFAULT_PARAMS, **self.pinned)
+        self.switches = dict(DEFAULT_SWITCHES)
+        self.jitter = jitter
+        self.stall_prob = stall_prob
+        self.stall_s = stall_s
+        self.drop_prob = drop_prob
+        self.replay_dir = replay_dir
+        self.replay_cam = replay_cam
+        self.replay_loop = replay_loop
+        self.realtime = realtime
+        self.rng = np.random.default_rng(seed)
+        self.serial_num = None
+        self.is_open = False
+        self.acquiring = False
+        self._t_open = time.perf_counter()
+
+    def open_device_by_SN(self, serial_num):
+        self.serial_num = serial_num
+        self.is_open = True
+        self._t_open = time.perf_counter()
+
+    def open_device(self):
+        self.open_device_by_SN('SIM00000')
+
+    def close_device(self):
+        self.acquiring = False
+        self.is_open = False
+
+    def get_device_name(self):
+        return('SIM-XiC')
+
+    def set_param(self, param, value):
+        if param not in self.params:
+            raise Xi_error(100)
+        if param not in self.pinned:
+            self.params[param] = value
+
+    def get_param(self, param, buffer_size=256):
+        if param == 'timestamp':
+            return(int(self._cam_time() * 1e9))
+        if param not in self.params:
+            raise Xi_error(100)
+        return(self.params[param])
+
+    def _cam_time(self):
+        return(time.perf_counter() - self._t_open)
+
+    def start_acquisition(self):
+        imshape = (int(self.params['height']), int(self.params['width']))
+        self.frame_format = ximea_pixels.format_from_settings(
+            dict(self.params, is_output_bit_packing=self.switches['output_bit_packing']))
+        if self.replay_dir is not None:
+            self._replay, self._replay_nframes, self._replay_times = load_replay(self.replay_dir, self.replay_cam, imshape)
+            #frames are delivered as stored, they have to be what this camera is set up to deliver
+            if self._replay.imshape != imshape or self._replay.frame_format != self.frame_format:
+                raise ValueError(f'{self.replay_dir} holds {self._replay.imshape} {self._replay.frame_format.bits} bit '
+                                 f'frames, the camera is set to {imshape} {self.frame_format.bits} bit')
+            if not len(self._replay):
+                raise ValueError(f'{self.replay_dir} has no {self.replay_cam} frames to replay')
+            self._n_source = len(self._replay_times)
+        else:
+            self._frames = synthetic_bayer_frames(imshape)
+            if self.frame_format.packing != 'none':
+                #spread the 8 bit values over the whole bit depth, then pack them
+                bits = self.frame_format.bits
+                pixels = (self._frames.astype(np.uint16) << (bits - 8)) | (self._frames >> (16 - bits))
+                self._frames = ximea_pixels.pack(pixels, self.frame_format)
+            self._n_source = len(self._frames)
+        self._t_start = self._cam_time()
+        self._next_index = 0
+        self._skipped = 0
+        self.acquiring = True
+
+    def stop_acquisition(self):
+        self.acquiring = False
+
+    def _exposure_time(self, k):
+        '''
+        Camera time at which source frame k (counting loops) was exposed
+        '''
+        if self.replay_dir is None:
+            return(self._t_start + k / float(self.params['framerate']))
+        loop, i = divmod(k, self._n_source)
+        span = self._replay_times[-1] - self._replay_times[0] + 1.0 / float(self.params['framerate'])
+        return(self._t_start + loop * span + self._replay_times[i] - self._replay_times[0])
+
+    def _source_frame(self, k):
+        i = k % self._n_source
+        if self.replay_dir is None:
+            return(self._frames[i], k + 1)
+        loop = k // self._n_source
+        nframe = self._replay_nframes[i] + loop * (self._replay_nframes[-1] + 1)
+        #decompressed if the recording is, packed frames stay packed
+        return(self._replay.raw(i), nframe)
+
+    def get_image(self, image, timeout=None):
+        '''
+        Wait for the next frame and point image at it
+        '''
+        if not self.acquiring:
+            raise Xi_error(45)
+        if self.replay_dir is not None and not self.replay_loop and self._next_index >= self._n_source:
+            raise Xi_error(10)
+        k = self._next_index
+        if self.realtime:
+            #frames the caller was too slow to collect were overwritten in the camera's buffers
+            newest = k
+            now = self._cam_time()
+            while self._exposure_time(newest + 1) <= now:
+                newest += 1
+            k = max(k, newest - int(self.params['buffers_queue_size']) + 1)
+        while self.drop_prob and self.rng.random() < self.drop_prob:
+            k += 1
+        self._next_index = k + 1
+
+        t_exposed = self._exposure_time(k)
+        if self.realtime:
+            t_ready = t_exposed + abs(self.rng.normal(0, self.jitter)) if self.jitter else t_exposed
+            if self.stall_prob and self.rng.random() < self.stall_prob:
+                t_ready += self.stall_s
+            wait = t_ready - self._cam_time()
+            if timeout is not None and wait > timeout / 1000:
+                time.sleep(timeout / 1000)
+                raise Xi_error(10)
+            if wait > 0:
+                time.sleep(wait)
+        pixels, nframe = self._source_frame(k)
+        image._point_at(pixels, nframe, t_exposed, ximea_pixels.pixel_shape(pixels.shape, self.frame_format)[1])
+
+def _add_accessors(cls):
+    '''
+    Give the class real set_/get_/enable_/disable_/is_ methods for every simulated parameter,
+    ximea_settings finds them with dir()
+    '''
+    for prop in DEFAULT_PARAMS:
+        setattr(cls, f'set_{prop}', lambda self, value, prop=prop: self.set_param(prop, value))
+        setattr(cls, f'get_{prop}', lambda self, prop=prop: self.get_param(prop))
+    for prop in DEFAULT_SWITCHES:
+        setattr(cls, f'enable_{prop}', lambda self, prop=prop: self.switches.__setitem__(prop, True))
+        setattr(cls, f'disable_{prop}', lambda self, prop=prop: self.switches.__setitem__(prop, False))
+        setattr(cls, f'is_{prop}', lambda self, prop=prop: self.switches[prop])
+
+_add_accessors(SimCamera)
+
+#module level names mirroring xiapi, so the module itself works as a backend
+Camera = SimCamera
+Image = SimImage
+
+def make_backend(**options):
+    '''
+    Build an xiapi-like backend whose cameras use the given SimCamera options
+    Returns:
+        backend (namespace): with Camera, Image and Xi_error like the xiapi module
+    '''
+    return(SimpleNamespace(Camera=partial(SimCamera, **options), Image=SimImage, Xi_error=Xi_error))
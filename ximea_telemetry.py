@@ -0,0 +1,180 @@
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+#write latency histogram bin edges, in milliseconds
+LATENCY_EDGES_MS = np.array([0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, np.inf])
+
+class PipelineTelemetry():
+    '''
+    Counters for one camera's acquisition and save threads.
+
+    Each counter has a single writer (the acquisition thread or the save thread) and is a
+    plain attribute, so updating them costs a few integer operations and no locks. The
+    acquisition thread calls frame_acquired() per frame, the save thread calls
+    frames_written() once per batch. Readers (the menu, the end of recording summary) may
+    see values that are a frame out of date, which is fine for monitoring.
+    '''
+    def __init__(self, cam_name, save_dir, frame_ring):
+        self.cam_name = cam_name
+        self.save_dir = save_dir
+        self.frame_ring = frame_ring
+        self.t_start = time.time()
+        self.t_end = None
+        self._extra = None
+
+        #acquisition thread
+        self.frames_acquired = 0
+        self.nframe_gaps = 0
+        self.frames_missing = 0
+        self._last_nframe = None
+        #kept by a ximea_backpressure.BackpressureController in the acquisition thread
+        self.backpressure_level = 0
+        self.backpressure_state = 'off'
+        self.frames_decimated = 0
+        self.frames_shed = 0
+
+        #save thread
+        self.frames_saved = 0
+        self.bytes_saved = 0
+        self.latency_hist = np.zeros(len(LATENCY_EDGES_MS) - 1, dtype=np.int64)
+        self.latency_max_ms = 0.0
+        self.disk_free = None
+        self._t_disk_checked = 0
+
+        #for rates shown in the menu
+        self._last_sample = (self.t_start, 0, 0)
+        self.acquired_fps = 0.0
+        self.saved_fps = 0.0
+
+    def frame_acquired(self, nframe):
+        '''
+        Called by the acquisition thread for every frame the camera hands over
+        '''
+        self.frames_acquired += 1
+        if self._last_nframe is not None and nframe != self._last_nframe + 1:
+            self.nframe_gaps += 1
+            self.frames_missing += max(0, nframe - self._last_nframe - 1)
+        self._last_nframe = nframe
+
+    def update_acquired(self, counters):
+        '''
+        Take the acquisition counters from a PipelineTelemetry in another process
+        (see acquisition_counters in ximea_process). If the summary was already
+        written they arrived late, so write it again.
+        '''
+        self.frames_acquired = counters['frames_acquired']
+        self.nframe_gaps = counters['nframe_gaps']
+        self.frames_missing = counters['frames_missing']
+        self.backpressure_level = counters.get('backpressure_level', 0)
+        self.backpressure_state = counters.get('backpressure_state', 'off')
+        self.frames_decimated = counters.get('frames_decimated', 0)
+        self.frames_shed = counters.get('frames_shed', 0)
+        if self.t_end is not None:
+            self.write_summary(self._extra, t_end=self.t_end)
+
+    def frames_written(self, meta, t_written, nbytes=0):
+        '''
+        Called by the save thread after every batch
+        Params:
+            meta (np.array): FrameRing.meta of the frames written
+            t_written (float): time.time() the batch was on its way to disk
+            nbytes (int): bytes written for the batch
+        '''
+        self.frames_saved += len(meta)
+        self.bytes_saved += nbytes
+        latency_ms = (t_written - meta['t_host']) * 1e3
+        np.add.at(self.latency_hist, np.searchsorted(LATENCY_EDGES_MS, latency_ms, side='right') - 1, 1)
+        self.latency_max_ms = max(self.latency_max_ms, float(latency_ms.max()))
+        if t_written - self._t_disk_checked > 1:
+            self.disk_free = shutil.disk_usage(self.save_dir).free
+            self._t_disk_checked = t_written
+
+    def latency_percentile(self, p):
+        '''
+        Upper edge of the histogram bin holding the p-th percentile write latency, in ms
+        '''
+        total = self.latency_hist.sum()
+        if not total:
+            return(0.0)
+        i = int(np.searchsorted(np.cumsum(self.latency_hist), total * p / 100.0))
+        return(float(min(LATENCY_EDGES_MS[i + 1], self.latency_max_ms)))
+
+    def update_rates(self, min_interval=0.5):
+        '''
+        Recompute the frame rates from the counters, at most every min_interval seconds
+        '''
+        now = time.time()
+        t, acquired, saved = self._last_sample
+        if now - t < min_interval:
+            return
+        self.acquired_fps = (self.frames_acquired - acquired) / (now - t)
+        self.saved_fps = (self.frames_saved - saved) / (now - t)
+        self._last_sample = (now, self.frames_acquired, self.frames_saved)
+
+    def status(self):
+        '''
+        Short strings for the plugin menu
+        '''
+        self.update_rates()
+        free = 'n/a' if self.disk_free is None else f'{self.disk_free / 1e9:.1f} GB'
+        return({
+            'rates': f'{self.acquired_fps:.1f} acquired / {self.saved_fps:.1f} saved fps',
+            'queue': f'{self.frame_ring.depth()} now, {self.frame_ring.max_depth} max of {self.frame_ring.n_slots}',
+            'dropped': f'{self.frame_ring.dropped} dropped, {self.frames_missing} missing in {self.nframe_gaps} gaps',
+            'backpressure': f'{self.backpressure_state}, {self.frames_decimated} decimated, {self.frames_shed} shed',
+            'latency': f'p50 {self.latency_percentile(50):.0f} / p99 {self.latency_percentile(99):.0f} / max {self.latency_max_ms:.0f} ms',
+            'disk': f'{self.bytes_saved / 1e9:.2f} GB written, {free} free',
+        })
+
+    def summary(self):
+        '''
+        Everything measured for the recording, for {cam_name}_perf.json
+        '''
+        t_end = self.t_end or time.time()
+        duration = max(t_end - self.t_start, 1e-9)
+        return({
+            'cam_name': self.cam_name,
+            't_start': self.t_start,
+            't_end': t_end,
+            'duration_s': duration,
+            'frames_acquired': self.frames_acquired,
+            'frames_saved': self.frames_saved,
+            'frames_dropped_ring': self.frame_ring.dropped,
+            'frames_decimated': self.frames_decimated,
+            'frames_shed': self.frames_shed,
+            'nframe_gaps': self.nframe_gaps,
+            'frames_missing': self.frames_missing,
+            'acquired_fps': self.frames_acquired / duration,
+            'saved_fps': self.frames_saved / duration,
+            'queue_max_depth': self.frame_ring.max_depth,
+            'queue_slots': self.frame_ring.n_slots,
+            'bytes_saved': self.bytes_saved,
+            'saved_mb_per_s': self.bytes_saved / duration / 1e6,
+            'disk_free_bytes': shutil.disk_usage(self.save_dir).free,
+            'write_latency_ms': {
+                'p50': self.latency_percentile(50),
+                'p90': self.latency_percentile(90),
+                'p99': self.latency_percentile(99),
+                'max': self.latency_max_ms,
+                'hist_edges': [float(e) for e in LATENCY_EDGES_MS],
+                'hist_counts': [int(c) for c in self.latency_hist],
+            },
+        })
+
+    def write_summary(self, extra=None, t_end=None):
+        '''
+        Write {cam_name}_perf.json next to the recording
+        Params:
+            extra (dict): more entries to include, e.g. compression stats
+            t_end (float): end of the recording, now by default
+        '''
+        self.t_end = t_end or time.time()
+        self._extra = extra
+        summary = self.summary()
+        summary.update(extra or {})
+        with open(os.path.join(self.save_dir, f'{self.cam_name}_perf.json'), 'w') as f:
+            json.dump(summary, f, indent=2)
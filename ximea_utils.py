@@ -4,8 +4,12 @@ import queue as queue
 import time
 import os as os
 import numpy as np
-from ximea import xiapi
-from collections import namedtuple
+try:
+    from ximea import xiapi
+except ImportError:
+    #no camera API installed, only a simulated backend (ximea_sim) can be used
+    xiapi = None
+from collections import namedtuple, deque
 import yaml
 import mmap
 import copy
@@ -19,7 +23,17 @@ import cv2
 import struct
 import base64
 
-frame_data = namedtuple("frame_data", "raw_data nframe tsSec tsUSec")
+import ximea_backpressure
+import ximea_chunk
+import ximea_clock
+import ximea_metadata
+import ximea_pixels
+import ximea_roi
+import ximea_settings
+import ximea_writer
+
+#threads started by start_ximea_aquisition, join both to wait for a recording to be fully on disk
+acquisition_handles = namedtuple("acquisition_handles", "frame_ring acq_thread save_thread")
 
 def write_sync_queue(sync_queue, cam_name, save_folder):
     '''
@@ -33,15 +47,14 @@ def write_sync_queue(sync_queue, cam_name, save_folder):
     '''
     sync_file_name = os.path.join(save_folder, f"timestamp_camsync_{cam_name}.tsv")
     with open(sync_file_name, 'w') as sync_file:
-        sync_file.write(f"cam\ttime_sync\ttime_cam\ttime_wall\n")
+        sync_file.write(f"cam\ttime_sync\ttime_cam\ttime_wall\tbracket\n")
     #open it for appending
     sync_file = open(sync_file_name, 'a+')
 
-    start_sync_string = sync_queue.get()
-    sync_file.write(start_sync_string)
-
-    end_sync_string = sync_queue.get()
-    sync_file.write(end_sync_string)
+    #pre, the samples taken while recording, post
+    while not sync_queue.empty():
+        sync_file.write(sync_queue.get())
+    sync_file.close()
 
     return()
 
@@ -64,132 +77,232 @@ def get_sync_string(cam_name, cam_handle, save_dir, g_pool):
     Returns:
         sync_string (str): string to write to file with cam name, time, and wall time
     '''
-    t_wall_1 = time.time()
-    t_sync_1 = g_pool.get_timestamp()
-    t_cam = cam_handle.get_param('timestamp')
-    t_cam = t_cam/(1e9) #this is returned in nanoseconds, change to seconds
-    t_sync_2 = g_pool.get_timestamp()
-    t_wall_2 = time.time()
-    t_sync = np.mean((t_sync_1, t_sync_2)) #take middle of two wall times
-    t_wall = np.mean((t_wall_1, t_wall_2)) #take middle of two wall times
-    sync_string = f'{cam_name}\t{t_sync}\t{t_cam}\t{t_wall}\n'
+    t_sync, t_cam, t_wall, bracket = ximea_clock.bracketed_sample(cam_handle, g_pool)
+    sync_string = f'{cam_name}\t{t_sync}\t{t_cam}\t{t_wall}\t{bracket}\n'
     return(sync_string)
 
-def apply_cam_settings(cam, config_file):
+def apply_cam_settings(cam, config_file, acquiring=False):
     """
     Apply settings to the camera from a config file.
+    Only the parameters that differ from the camera's current values are set, see ximea_settings.
 
     Params:
         camera (XimeaCamera instance): camera handle
         config_file (str): string filename of the config file for the camera
+        acquiring (bool): the camera is acquiring, restart it around parameters that need that
+    Returns:
+        change (ximea_settings.settings_change): what was set, and what needed a restart
     """
-    with open(config_file, 'r') as f:
-        cam_props = yaml.safe_load(f)
-
-    for prop, value in cam_props.items():
-        #print(prop, value)
-        if f"set_{prop}" in dir(cam):
-            try:
-                cam.__getattribute__(f"set_{prop}")(value)
-            except Exception as e:
-                print(e)
-        elif prop in dir(cam) and "is_" in prop:
-            en_dis = "enable_" if value else "disable_"
-            try:
-                cam.__getattribute__(f"{en_dis}{prop.replace('is_', '')}")()
-            except Exception as e:
-                print(e)
-
-        else:
-            print(f"Camera doesn't have a set_{prop}")
+    change = ximea_settings.CameraSettings(cam).apply(ximea_settings.load_settings(config_file), acquiring)
+    for prop in change.unknown:
+        print(f"Camera doesn't have a set_{prop}")
+    for prop, e in change.failed:
+        print(f'{prop}: {e}')
+    return(change)
+
+def read_recording_options(config_file):
+    '''
+    Read the options for the recording pipeline (compression etc.) kept in the
+    'recording' section of a camera settings file
+    Params:
+        config_file (str): string filename of the config file for the camera
+    Returns:
+        options (dict): empty if the file has no 'recording' section
+    '''
+    return(dict(ximea_settings.load_settings(config_file).get('recording') or {}))
 
-def init_camera(cam_id, settings_file, logger):
+def init_camera(cam_id, settings_file, logger, backend=None, on_status=None):
     '''
     Initialize a ximea camera for use (recoring and preview) by external scripts
     Params:
         cam_id (str): Serial number of camera to opening
         setttings_file (str): Path to settings file for camera
         logger (instace of class logger): used to pass messages to gui
+        backend (module): provides Camera and Image, xiapi by default or ximea_sim for a simulated camera
+        on_status (function): optional, called with 'opening', 'configuring' and 'starting' as each step begins
+                              and with 'error: ...' if one fails
     Returns:
         camera (instace of class Ximea Camera): A camera that produces Images
         iamge_handle (Ximea Camera image): handle to point to images from camera
         open_success (bool): Were we able to open the camera?
     '''
+    if on_status is None:
+        on_status = lambda status: None
+    camera = None
     try:
+        if backend is None:
+            backend = xiapi
         logger.info(f'Opening Ximea Camera {cam_id}')
-        camera = xiapi.Camera()
+        on_status('opening')
+        camera = backend.Camera()
         camera.open_device_by_SN(cam_id)
         logger.info('Sucessfully Opened Camera')
+        on_status('configuring')
         apply_cam_settings(camera, settings_file)
         logger.info('Sucessfully Applied Settings to Camera')
+        on_status('starting')
         camera.start_acquisition()
-        image = xiapi.Image()
+        image = backend.Image()
         logger.info('Sucessfully Started Aquisition')
         return(camera, image, True)
-    except:
-        logger.info('Problem initializing camera.')
-        camera.stop_acquisition()
-        camera.close_device()
+    except Exception as e:
+        logger.info(f'Problem initializing camera {cam_id}: {e}')
+        on_status(f'error: {e}')
+        if camera is not None:
+            try:
+                camera.stop_acquisition()
+                camera.close_device()
+            except Exception:
+                pass
         return(None, None, False)
 
-def decode_ximea_frame(camera, image_handle, imshape, logger, norm=True):
+def decode_ximea_frame(camera, image_handle, imshape, logger, norm=True, frame_format=ximea_pixels.RAW8):
     '''
-    Get a single frame from ximea cameras
+    Get a single frame from ximea cameras, the top 8 bits of 10 and 12 bit packed frames
     '''
     camera.get_image(image_handle)
     im = image_handle.get_image_data_raw()
     im = np.frombuffer(im,dtype='uint8') #.byteswap()
-    im = im.reshape(imshape)
+    im = im.reshape(ximea_pixels.stored_shape(imshape, frame_format))
+    im = ximea_pixels.unpack_msb8(im, frame_format)
     im = cv2.cvtColor(im, cv2.COLOR_BayerRG2BGR)
     im = cv2.flip(im, -1)
     if(norm):
         im = cv2.normalize(im, None, 0, 255, cv2.NORM_MINMAX)
     return(im)
 
-def save_queue_worker(cam_name, save_queue_out, save_folder, ims_per_file, stop_collecting_event, currently_saving, logger):
+def copy_image_into(image_handle, dst, roi=None, frame_format=ximea_pixels.RAW8):
+    '''
+    Copy the pixels of the last grabbed image straight into a preallocated array
+    Params:
+        image_handle (Ximea Image): image filled by camera.get_image
+        dst (np.array): destination, usually a FrameRing slot
+        roi (tuple): optional (x, y, width, height) to copy out of the image, the size of dst
+        frame_format (frame_format): how the image's pixels are packed, packed frames are copied packed
+    '''
+    bp = getattr(image_handle, 'bp', None)
+    if frame_format.packing == 'none':
+        row_nbytes = image_handle.width * image_handle.get_bytes_per_pixel()
+    else:
+        row_nbytes = ximea_pixels.row_nbytes(image_handle.width, frame_format)
+    if roi is not None:
+        x, y, width, height = roi
+        shape = (image_handle.height, row_nbytes)
+        if bp:
+            #look at the driver's buffer in place, only the ROI rows are read
+            src = np.ctypeslib.as_array((ctypes.c_uint8 * (shape[0] * shape[1])).from_address(bp)).reshape(shape)
+        else:
+            src = np.frombuffer(image_handle.get_image_data_raw(), dtype=np.uint8).reshape(shape)
+        x0 = ximea_pixels.row_nbytes(x, frame_format)
+        np.copyto(dst, src[y:y + height, x0:x0 + ximea_pixels.row_nbytes(width, frame_format)])
+    elif bp and image_handle.height * row_nbytes == dst.nbytes:
+        #copy from the driver's buffer without building an intermediate bytes object
+        ctypes.memmove(dst.ctypes.data, bp, dst.nbytes)
+    else:
+        dst.reshape(-1)[:] = np.frombuffer(image_handle.get_image_data_raw(), dtype=dst.dtype)
+
+def save_queue_worker(cam_name, frame_ring, save_folder, ims_per_file, stop_collecting_event, currently_saving, logger,
+                      write_mode='direct', write_batch=8, telemetry=None, compressor=None, clock=None, settings_file=None,
+                      geometry=None):
+    '''
+    Write frames from the ring to disk until the acquisition thread closes it and it is drained.
+    Params:
+        cam_name (str): name of camera - used for folder and filenames
+        frame_ring (FrameRing): ring filled by aquire_camera_worker
+        save_folder (str): directory to save frames and timestamps
+        ims_per_file (int): number of frames per .bin file
+        write_mode (str): 'buffered', 'direct' or 'sync', see ximea_writer.WRITE_MODES
+        write_batch (int): most frames handed to the disk in one call
+        telemetry (PipelineTelemetry): optional, counts written frames and writes {cam_name}_perf.json at the end
+        compressor (FrameCompressor): optional, compress frames on its worker pool before writing
+        clock (ClockSync): optional, the acquisition thread's clock fit, gives every frame its Pupil time
+        settings_file (str): the camera's .yaml, described in every chunk header
+        geometry (roi_geometry): ROI and decimation the frames were recorded with, for the chunk headers
+    '''
+    writer = None
     try:
         if not os.path.exists(os.path.join(save_folder, cam_name)):
             os.makedirs(os.path.join(save_folder, cam_name))
             #os.chmod(save_folder, stat.S_IRWXO)
-        ts_file_name = os.path.join(save_folder, f"timestamps_{cam_name}.tsv")
-        #make a new blank timestamp file
-        with open(ts_file_name, 'w') as ts_file:
-            ts_file.write(f"i\tframe\tcamtime\n")
-        #open it for appending
-        ts_file = open(ts_file_name, 'a+')
-        i = 0
-        logger.info('Started Saving...')
+        header = ximea_chunk.make_header(frame_ring.imshape, 'none' if compressor is None else compressor.codec,
+                                         settings_file, geometry)
+        writer = ximea_writer.ChunkWriter(os.path.join(save_folder, cam_name), ims_per_file,
+                                          header, mode=write_mode,
+                                          staging_frames=write_batch,
+                                          extension='bin' if compressor is None else compressor.extension,
+                                          logger=logger)
+
+        def write_slots(slots, payloads):
+            bytes_before = writer.bytes_written
+            slot_meta = frame_ring.meta[slots]
+            t_pupil = None
+            if clock is not None:
+                t_pupil = clock.to_pupil(slot_meta['tsSec'] + slot_meta['tsUSec'] * 1e-6)
+            writer.write_frames(payloads, ximea_metadata.make_records(writer.n_written, slot_meta, t_pupil))
+            if telemetry is not None:
+                telemetry.frames_written(slot_meta, time.time(), writer.bytes_written - bytes_before)
+            frame_ring.release(slots)
+
+        logger.info(f'Started Saving ({writer.mode}{"" if compressor is None else ", " + compressor.codec})...')
         currently_saving.set()
-        if(ims_per_file == 1):
-            while (not stop_collecting_event.is_set())  or save_queue_out.empty():
-                bin_file_name = os.path.join(save_folder, cam_name, f'frame_{i}.bin')
-                f = os.open(bin_file_name, os.O_WRONLY | os.O_CREAT , 0o777 | os.O_TRUNC | os.O_SYNC | os.O_DIRECT)
-                image = save_queue_out.get(True, 1)
-                os.write(f, image.raw_data)
-                ts_file.write(f"{i}\t{image.nframe}\t{image.tsSec}.{str(image.tsUSec).zfill(6)}\n")
-                i+=1
-        else:
-            while (not stop_collecting_event.is_set())  or save_queue_out.empty():
-                fstart=i*ims_per_file
-                bin_file_name = os.path.join(save_folder, cam_name, f'frames_{fstart}_{fstart+ims_per_file-1}.bin')
-                f = os.open(bin_file_name, os.O_WRONLY | os.O_CREAT , 0o777 | os.O_TRUNC | os.O_SYNC | os.O_DIRECT)
-                for j in range(ims_per_file):
-                    image = save_queue_out.get(True, 1)
-                    os.write(f, image.raw_data)
-                    ts_file.write(f"{fstart+j}\t{image.nframe}\t{image.tsSec}.{str(image.tsUSec).zfill(6)}\n")
-                os.close(f)
-                i+=1
+        #frames handed to the compressor and not yet written, in recording order
+        pending = deque()
+        max_pending = 0 if compressor is None else 2 * compressor.n_workers * write_batch
+        while True:
+            room = write_batch if compressor is None else min(write_batch, max_pending - len(pending))
+            slots = frame_ring.get_batch(room, timeout=0.1 if pending else 1) if room > 0 else []
+            if compressor is None:
+                if slots:
+                    write_slots(slots, [frame_ring.frames[slot] for slot in slots])
+            else:
+                pending.extend((slot, compressor.submit(frame_ring.frames[slot])) for slot in slots)
+                #write what has finished, or wait for the oldest frame if we're full or idle
+                done = []
+                while pending and len(done) < write_batch and (pending[0][1].done() or not slots):
+                    slot, future = pending.popleft()
+                    done.append((slot, future.result()))
+                if done:
+                    for slot, payload in done:
+                        compressor.count(frame_ring.frame_nbytes, len(payload))
+                    write_slots([slot for slot, _ in done], [payload for _, payload in done])
+            if not slots and not pending and frame_ring.closed and frame_ring.depth() == 0:
+                break
+        writer.close()
+        #the text version of the timestamps, for anything that reads the old format
+        ximea_metadata.records_to_tsv(ximea_chunk.load_records(writer.chunk_names),
+                                      os.path.join(save_folder, f"timestamps_{cam_name}.tsv"))
 
         logger.info(f"Finished Saving Frames from {cam_name}")
-        currently_saving.clear()
+        if compressor is not None:
+            logger.info(f'Compression: {compressor.status_text()}')
 
     except Exception as e:
-        print(f'Exception!: e')
-        print('Exiting Save Thread')
+        logger.info(f'Exception in save thread: {e}')
+        logger.info('Exiting Save Thread')
+
+    finally:
+        if writer is not None:
+            try:
+                writer.close()
+            except Exception as e:
+                logger.info(f'Could not close chunk {writer.chunk_name}: {e}')
+        if compressor is not None:
+            compressor.shutdown()
+        if telemetry is not None:
+            try:
+                extra = {}
+                if compressor is not None:
+                    extra['compression'] = {'codec': compressor.codec, 'ratio': compressor.ratio,
+                                            'worker_mb_per_s': compressor.worker_throughput()}
+                telemetry.write_summary(extra)
+            except Exception as e:
+                logger.info(f'Could not write performance summary: {e}')
         currently_saving.clear()
 
 
-def aquire_camera_worker(camera, image_handle, cam_name, sync_queue, save_queue, save_dir, stop_collecting_event, currently_recording, g_pool, logger):
+def aquire_camera_worker(camera, image_handle, cam_name, sync_queue, frame_ring, save_dir, stop_collecting_event, currently_recording, g_pool, logger,
+                         telemetry=None, clock=None, geometry=None, backpressure=None, frame_format=ximea_pixels.RAW8,
+                         publisher=None):
 
     """
     Acquire frames from a single camera. Can have mulitple instances of this to record from multiple cameras.
@@ -198,14 +311,28 @@ def aquire_camera_worker(camera, image_handle, cam_name, sync_queue, save_queue,
         camera (Ximea Camera) Instance of a ximea camera
         image_handle (Ximea Image) Instance of Ximea camera image
         sync_queue (Mutlithreading.Queue): A queue to sync timestamps of camera and computer
-        save_queue (Mutlithreading.Queue): A queue which accepts xiapi.Images
+        frame_ring (FrameRing): preallocated ring the frames are copied into for the save thread
         stop_collecting (threading.Event): keep collecting until this is set
+        telemetry (PipelineTelemetry): optional, counts acquired frames and nframe gaps
+        clock (ClockSync): samples the camera clock every few seconds while recording, one is made if not given
+        geometry (roi_geometry): optional, software ROI to copy out of each frame and frame decimation
+        backpressure (backpressure_policy): optional, how to back off when the save thread falls behind
+        frame_format (frame_format): bit depth and packing of the camera's frames, see ximea_pixels
+        publisher (FramePublisher): optional, woken for every frame put in the ring, see ximea_publish
 
     """
 
+    if clock is None:
+        clock = ximea_clock.ClockSync(cam_name, camera, g_pool, logger=logger)
+    roi = ximea_roi.crop(geometry)
+    decimation = 1 if geometry is None else geometry.decimation
+    controller = None
     try:
+        if backpressure is not None:
+            controller = ximea_backpressure.BackpressureController(cam_name, frame_ring, backpressure, save_dir, g_pool,
+                                                                   logger, telemetry, decimation)
 
-        sync_str = get_sync_string(cam_name + "_pre", camera, save_dir, g_pool)
+        sync_str = clock.sample(cam_name + "_pre", force=True)
         sync_queue.put(sync_str)
 
         logger.info(f'Begin Recording..')
@@ -213,48 +340,91 @@ def aquire_camera_worker(camera, image_handle, cam_name, sync_queue, save_queue,
 
         while not stop_collecting_event.is_set():
             camera.get_image(image_handle)
-            data = image_handle.get_image_data_raw()
-            save_queue.put(frame_data(data,
-                                   image_handle.nframe,
-                                   image_handle.tsSec,
-                                   image_handle.tsUSec))
+            if telemetry is not None:
+                telemetry.frame_acquired(image_handle.nframe)
+            #with decimation the other frames are only grabbed to keep the driver's buffers moving
+            if ((decimation == 1 or image_handle.nframe % decimation == 0)
+                    and (controller is None or controller.admit(image_handle.nframe))):
+                dropped = frame_ring.dropped
+                slot = frame_ring.acquire(timeout=1)
+                if controller is not None and frame_ring.dropped != dropped:
+                    controller.ring_dropped(image_handle.nframe if slot is None else frame_ring.evicted)
+                if slot is not None:
+                    copy_image_into(image_handle, frame_ring.frames[slot], roi, frame_format)
+                    frame_ring.commit(slot,
+                                      image_handle.nframe,
+                                      image_handle.tsSec,
+                                      image_handle.tsUSec)
+                    if publisher is not None:
+                        publisher.wake()
+            #a few clock reads every clock.interval seconds, the driver buffers frames meanwhile
+            sync_str = clock.maybe_sample(cam_name + "_sync")
+            if sync_str is not None:
+                sync_queue.put(sync_str)
 
         logger.info(f'Stopping Ximea Collection')
-        sync_str = get_sync_string(cam_name + "_post", camera, save_dir, g_pool)
+        sync_str = clock.sample(cam_name + "_post", force=True)
         sync_queue.put(sync_str)
         write_sync_queue(sync_queue, cam_name, save_dir)
 
     except Exception as e:
         logger.info(f'Detected Exception {e} Stopping Acquisition')
-        sync_str = get_sync_string(cam_name + "_post", camera, save_dir, g_pool)
+        sync_str = clock.sample(cam_name + "_post", force=True)
         sync_queue.put(sync_str)
         write_sync_queue(sync_queue, cam_name, save_dir)
 
     finally:
+        frame_ring.close()
         currently_recording.clear()
+        if controller is not None:
+            controller.close()
+            logger.info(f'Backpressure: {controller.status_text()}, decisions in {controller.log_file_name}')
+        if frame_ring.dropped:
+            logger.info(f'Dropped {frame_ring.dropped} of {frame_ring.committed + frame_ring.dropped} frames, ring was full')
+        logger.info(f'Clock sync: {clock.n_samples} samples, median bracket {clock.median_bracket() * 1e6:.0f} us, '
+                    f'{clock.n_rejected} dropped, {clock.n_jumps} jumps')
         logger.info(f"Camera aquisition finished")
 
-def start_ximea_aquisition(camera, image_handle,
+def start_ximea_aquisition(camera, image_handle, frame_ring,
                             save_dir, ims_per_file,
                             stop_collecting,
                             currently_recording,
                             currently_saving,
                             g_pool,
-                            logger):
-
-    save_queue = queue.Queue()
-    sync_queue = queue.Queue()
+                            logger,
+                            write_mode='direct',
+                            telemetry=None,
+                            compressor=None,
+                            sync_queue=None,
+                            cam_name='ximea',
+                            sync_interval=5.0,
+                            settings_file=None,
+                            geometry=None,
+                            backpressure=None,
+                            publisher=None):
+
+    #the caller has joined the last recording's threads, nothing is left in the ring to save
+    frame_ring.reset()
+    if sync_queue is None:
+        sync_queue = queue.Queue()
+    #sampled by the acquisition thread, used by the save thread to timestamp frames in Pupil time
+    clock = ximea_clock.ClockSync(cam_name, camera, g_pool, interval=sync_interval, logger=logger)
+    frame_format = ximea_pixels.format_from_file(settings_file)
+    if publisher is not None:
+        publisher.attach(frame_ring, clock, frame_format)
 
     if not os.path.exists(save_dir):
         os.makedirs(save_dir)
 
-    cam_name = 'ximea'
     save_proc = threading.Thread(target=save_queue_worker,
-                            args=(cam_name, save_queue,
+                            args=(cam_name, frame_ring,
                                  save_dir, ims_per_file,
                                  stop_collecting,
                                  currently_saving,
-                                 logger))
+                                 logger,
+                                 write_mode),
+                            kwargs={'telemetry': telemetry, 'compressor': compressor, 'clock': clock,
+                                    'settings_file': settings_file, 'geometry': geometry})
 
 
     acq_proc = threading.Thread(target=aquire_camera_worker,
@@ -262,15 +432,18 @@ def start_ximea_aquisition(camera, image_handle,
                                 image_handle,
                                 cam_name,
                                 sync_queue,
-                                save_queue,
+                                frame_ring,
                                 save_dir,
                                 stop_collecting,
                                 currently_recording,
                                 g_pool,
-                                logger))
+                                logger),
+                          kwargs={'telemetry': telemetry, 'clock': clock, 'geometry': geometry,
+                                  'backpressure': backpressure, 'frame_format': frame_format,
+                                  'publisher': publisher})
     save_proc.daemon = True
     save_proc.start()
     acq_proc.daemon = False
     acq_proc.start()
 
-    return(save_queue)
+    return(acquisition_handles(frame_ring, acq_proc, save_proc))
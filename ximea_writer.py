@@ -0,0 +1,259 @@
+import ctypes
+import ctypes.util
+import mmap
+import os
+
+import numpy as np
+
+import ximea_chunk
+import ximea_metadata
+
+#buffered - page cache, let the kernel flush in the background
+#direct   - O_DIRECT, bypass the page cache through page aligned staging buffers
+#sync     - page cache but every write returns only once it is on disk
+WRITE_MODES = ('buffered', 'direct', 'sync')
+
+#O_DIRECT needs buffers, lengths and file offsets aligned to the device block size.
+#Page size is a multiple of every block size we will see.
+DIRECT_ALIGN = mmap.PAGESIZE
+
+#most iovecs the kernel accepts in one writev
+IOV_MAX = os.sysconf('SC_IOV_MAX') if 'SC_IOV_MAX' in os.sysconf_names else 1024
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _fallocate = _libc.fallocate
+    _fallocate.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong)
+    _fallocate.restype = ctypes.c_int
+except (OSError, AttributeError):
+    _fallocate = None
+
+def aligned_buffer(nbytes, align=DIRECT_ALIGN):
+    '''
+    Allocate a zeroed uint8 buffer whose address and length are multiples of align
+    Params:
+        nbytes (int): minimum size of buffer
+        align (int): alignment, must divide the page size
+    Returns:
+        buf (np.array): uint8 array backed by an anonymous mmap (always page aligned)
+    '''
+    nbytes = -(-nbytes // align) * align
+    return(np.frombuffer(mmap.mmap(-1, nbytes), dtype=np.uint8))
+
+def preallocate(fd, nbytes):
+    '''
+    Reserve disk blocks for a file up front so the filesystem doesn't allocate while we stream.
+    Uses fallocate(2) directly rather than posix_fallocate, which silently falls back to
+    writing zeros on filesystems without support.
+    Returns:
+        success (bool): False if the platform or filesystem can't preallocate
+    '''
+    if _fallocate is None or nbytes <= 0:
+        return(False)
+    return(_fallocate(fd, 0, 0, nbytes) == 0)
+
+def writev_all(fd, buffers):
+    '''
+    os.writev until every byte is written, writev is allowed to stop partway through
+    '''
+    views = [memoryview(b).cast('B') for b in buffers]
+    while views:
+        written = os.writev(fd, views[:IOV_MAX])
+        while views and written >= views[0].nbytes:
+            written -= views[0].nbytes
+            views.pop(0)
+        if written:
+            views[0] = views[0][written:]
+
+def pwrite_all(fd, buffer, offset):
+    '''
+    os.pwrite until every byte is written
+    '''
+    view = memoryview(buffer).cast('B')
+    while view.nbytes:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+class ChunkWriter():
+    '''
+    Stream frames into frames_{start}_{end}.bin chunks of ims_per_file frames
+    (or frame_{i}.bin files when ims_per_file is 1), in the self-describing layout of
+    ximea_chunk: a header, every frame preceded by its record, and an index written when
+    the chunk closes. Frames are normally frame_nbytes each; compressed frames can be any
+    size and go to chunks with their codec's extension.
+
+    Frames are handed over in batches with write_frames() so that one system call covers
+    several frames. Each chunk is preallocated when opened and truncated to the bytes
+    actually written when closed, so a recording that stops mid chunk leaves no padding,
+    and the chunk is renamed after the frames it really holds.
+
+    In 'direct' mode frames are packed into a page aligned staging buffer of
+    staging_frames frames and only whole aligned blocks are written, the unaligned
+    tail is carried over to the next write and padded out when the chunk closes.
+    If the filesystem refuses O_DIRECT (tmpfs for example) we fall back to 'buffered'.
+    '''
+    def __init__(self, folder, ims_per_file, header, mode='buffered', preallocate=True, staging_frames=8,
+                 extension='bin', logger=None):
+        if mode not in WRITE_MODES:
+            raise ValueError(f'Unknown write mode {mode}, use one of {WRITE_MODES}')
+        if mode == 'direct' and not hasattr(os, 'O_DIRECT'):
+            mode = 'buffered'
+        self.folder = folder
+        self.ims_per_file = int(ims_per_file)
+        self.header = header
+        self.frame_nbytes = int(header['frame_nbytes'][0])
+        self.mode = mode
+        self.preallocate = preallocate
+        self.extension = extension
+        self.logger = logger
+
+        self.n_written = 0
+        self.bytes_written = 0
+        self.chunks_closed = 0
+        self.chunk_start = 0
+        self.chunk_name = None
+        #every chunk closed so far, under its final name
+        self.chunk_names = []
+        self._fd = None
+        self._chunk_frames = 0
+        self._chunk_bytes = 0
+        self._chunk_records = []
+        self._file_pos = 0
+
+        if self.mode == 'direct':
+            self._staging = aligned_buffer(max(1, staging_frames) * (self.frame_nbytes + ximea_chunk.FRAME_HEADER_DTYPE.itemsize)
+                                           + DIRECT_ALIGN)
+            self._fill = 0
+
+    def _chunk_file_name(self, start, n_frames):
+        if(self.ims_per_file == 1):
+            return(os.path.join(self.folder, f'frame_{start}.{self.extension}'))
+        return(os.path.join(self.folder, f'frames_{start}_{start+n_frames-1}.{self.extension}'))
+
+    def _open_chunk(self):
+        self.chunk_start = self.n_written
+        self.chunk_name = self._chunk_file_name(self.chunk_start, self.ims_per_file)
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+        if self.mode == 'sync':
+            flags |= os.O_DSYNC
+        if self.mode == 'direct':
+            try:
+                self._fd = os.open(self.chunk_name, flags | os.O_DIRECT, 0o777)
+            except OSError as e:
+                if self.logger is not None:
+                    self.logger.info(f'O_DIRECT not supported here ({e}), writing buffered')
+                self.mode = 'buffered'
+        if self._fd is None:
+            self._fd = os.open(self.chunk_name, flags, 0o777)
+        if self.preallocate:
+            #for compressed chunks this is an upper bound, the rest is truncated on close
+            preallocate(self._fd, ximea_chunk.HEADER_SIZE
+                        + self.ims_per_file * (self.frame_nbytes + ximea_chunk.FRAME_HEADER_DTYPE.itemsize))
+        self._chunk_frames = 0
+        self._chunk_bytes = 0
+        self._chunk_records = []
+        self._file_pos = 0
+        self._append([ximea_chunk.header_bytes(self.header, self.chunk_start)])
+
+    def _close_chunk(self):
+        records = np.concatenate(self._chunk_records) if self._chunk_records else np.zeros(0, ximea_metadata.frame_record_dtype)
+        self._append([np.frombuffer(ximea_chunk.index_bytes(records, self._chunk_bytes), dtype=np.uint8)])
+        if self.mode == 'direct' and self._fill:
+            #pad the tail out to a whole block, write it, then cut the padding off again
+            padded = -(-self._fill // DIRECT_ALIGN) * DIRECT_ALIGN
+            self._staging[self._fill:padded] = 0
+            pwrite_all(self._fd, self._staging[:padded], self._file_pos)
+            self._file_pos += self._fill
+            self._fill = 0
+        os.ftruncate(self._fd, self._file_pos)
+        os.close(self._fd)
+        self._fd = None
+        #a recording rarely stops on a chunk boundary, name the last chunk after what it holds
+        final_name = self._chunk_file_name(self.chunk_start, self._chunk_frames)
+        if final_name != self.chunk_name:
+            os.replace(self.chunk_name, final_name)
+            self.chunk_name = final_name
+        self.chunk_names.append(self.chunk_name)
+        self.chunks_closed += 1
+
+    def _append(self, buffers):
+        '''
+        Write buffers at the end of the current chunk
+        '''
+        nbytes = sum(memoryview(b).nbytes for b in buffers)
+        if self.mode == 'direct':
+            self._stage(buffers)
+        else:
+            writev_all(self._fd, buffers)
+            self._file_pos += nbytes
+        self._chunk_bytes += nbytes
+        self.bytes_written += nbytes
+
+    def _stage(self, frames):
+        '''
+        Copy frames into the aligned staging buffer, writing out whole blocks as it fills
+        '''
+        for frame in frames:
+            src = memoryview(frame).cast('B')
+            pos = 0
+            while pos < src.nbytes:
+                n = min(src.nbytes - pos, self._staging.nbytes - self._fill)
+                self._staging[self._fill:self._fill + n] = src[pos:pos + n]
+                self._fill += n
+                pos += n
+                if self._fill == self._staging.nbytes:
+                    self._flush_staging()
+        self._flush_staging()
+
+    def _flush_staging(self):
+        aligned = (self._fill // DIRECT_ALIGN) * DIRECT_ALIGN
+        if not aligned:
+            return
+        pwrite_all(self._fd, self._staging[:aligned], self._file_pos)
+        self._file_pos += aligned
+        tail = self._fill - aligned
+        self._staging[:tail] = self._staging[aligned:self._fill]
+        self._fill = tail
+
+    def write_frames(self, frames, records):
+        '''
+        Append frames to the recording, rolling over to a new chunk every ims_per_file frames.
+        Params:
+            frames (list of buffers): frames or compressed frames, safe to reuse once this returns
+            records (np.array): ximea_metadata.frame_record_dtype record of each frame, from make_records,
+                                its chunk, offset and nbytes are filled in here
+        Returns:
+            records (np.array): the same records
+        '''
+        done = 0
+        while done < len(frames):
+            if self._fd is None:
+                self._open_chunk()
+            n = min(len(frames) - done, self.ims_per_file - self._chunk_frames)
+            batch = frames[done:done + n]
+            batch_records = records[done:done + n]
+            offset = self._chunk_bytes
+            for k, frame in enumerate(batch):
+                nbytes = memoryview(frame).nbytes
+                offset += ximea_chunk.FRAME_HEADER_DTYPE.itemsize
+                batch_records['chunk'][k] = self.chunk_start
+                batch_records['offset'][k] = offset
+                batch_records['nbytes'][k] = nbytes
+                offset += nbytes
+            headers = ximea_chunk.frame_headers(batch_records).view(np.uint8).reshape(n, -1)
+            self._append([b for k, frame in enumerate(batch) for b in (headers[k], frame)])
+            self._chunk_records.append(batch_records.copy())
+            self._chunk_frames += n
+            self.n_written += n
+            done += n
+            if self._chunk_frames == self.ims_per_file:
+                self._close_chunk()
+        return(records)
+
+    def close(self):
+        '''
+        Flush and close the chunk currently being written
+        '''
+        if self._fd is not None:
+            self._close_chunk()